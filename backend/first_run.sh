@@ -14,3 +14,5 @@ start cmd.exe /k "python server.py"
 start cmd.exe /k "python minor_server.py 8001 server1_segments"
 start cmd.exe /k "python minor_server.py 8002 server2_segments"
 start cmd.exe /k "python minor_server.py 8003 server3_segments"
+
+start cmd.exe /k "python download_daemon.py"
\ No newline at end of file
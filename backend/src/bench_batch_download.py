@@ -0,0 +1,145 @@
+import argparse
+import multiprocessing
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from threading import Thread
+
+import client
+import server
+from bench_download_scheduler import throttled_proxy, wait_for_port
+from metadata_store import MetadataStore
+
+BASE_PORT = 8301
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+MODES = ["sequential", "independent", "batch"]
+
+
+def make_catalogue(directory, sizes_mb, seed):
+    rng = random.Random(seed)
+    names = []
+    for i, size in enumerate(sizes_mb):
+        name = f"file{i:02d}_{size}mb.bin"
+        with open(os.path.join(directory, name), "wb") as f:
+            f.write(rng.randbytes(size * 1024 * 1024))
+        names.append(name)
+    return names
+
+
+def new_downloader(name, file_info, out_dir, workers, per_server):
+    return client.FileDownloader(
+        name, os.path.join(out_dir, name), None, None, file_info=file_info,
+        max_workers=workers, max_server_concurrency=per_server,
+        on_progress=lambda done, total: None,
+    )
+
+
+def run_mode(mode, infos, out_dir, workers, per_server):
+    """Return (total seconds, {filename: seconds until it was verified})."""
+    os.makedirs(out_dir)
+    finished = {}
+    started = time.perf_counter()
+
+    def timed(downloader):
+        assert downloader.download()
+        finished[downloader.filename] = time.perf_counter() - started
+
+    downloaders = [new_downloader(n, info, out_dir, workers, per_server) for n, info in infos.items()]
+    if mode == "sequential":
+        for downloader in downloaders:
+            timed(downloader)
+    elif mode == "independent":
+        # Every file on its own scheduler, as separate client processes would run
+        threads = [Thread(target=timed, args=(d,)) for d in downloaders]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    else:
+        def on_file_done(downloader, verified):
+            assert verified
+            finished[downloader.filename] = time.perf_counter() - started
+        client.BatchScheduler(downloaders, workers, per_server, on_file_done=on_file_done).run()
+    return time.perf_counter() - started, finished
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time to download a catalogue of files: one after another, "
+        "each on its own scheduler at once, or all on one BatchScheduler"
+    )
+    parser.add_argument("--sizes-mb", default="1,1,1,2,2,4,8,16,32,64",
+                        help="Comma-separated sizes of the generated files")
+    parser.add_argument("--throttle-mbps", type=float, default=40,
+                        help="Bandwidth of each minor server in MB/s")
+    parser.add_argument("--workers", type=int, default=client.MAX_WORKERS)
+    parser.add_argument("--per-server", type=int, default=client.MAX_SERVER_CONCURRENCY)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    sizes = [int(s) for s in args.sizes_mb.split(",")]
+
+    with tempfile.TemporaryDirectory() as scratch:
+        server.FILE_DIR = os.path.join(scratch, "data")
+        os.makedirs(server.FILE_DIR)
+        names = make_catalogue(server.FILE_DIR, sizes, args.seed)
+        # Every server is reached through its own throttling proxy
+        ports = [BASE_PORT + i for i in range(3)]
+        real_ports = [port + 10 for port in ports]
+        server.MINOR_SERVERS = [
+            {"host": "localhost", "port": port, "dir": os.path.join(scratch, f"server{i + 1}")}
+            for i, port in enumerate(ports)
+        ]
+        for s in server.MINOR_SERVERS:
+            os.makedirs(s["dir"])
+        server.store = MetadataStore(os.path.join(scratch, "segment_cache.json"))
+        infos = {name: server.create_segments(name) for name in names}
+
+        procs = [
+            subprocess.Popen(
+                [sys.executable, os.path.join(SRC_DIR, "minor_server.py"), str(port), s["dir"]],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            for port, s in zip(real_ports, server.MINOR_SERVERS)
+        ]
+        proxies = [
+            multiprocessing.Process(
+                target=throttled_proxy,
+                args=(port, real_port, args.throttle_mbps * 1024 * 1024),
+                daemon=True,
+            )
+            for port, real_port in zip(ports, real_ports)
+        ]
+        for proxy in proxies:
+            proxy.start()
+        try:
+            for port in real_ports + ports:
+                wait_for_port(port)
+            print(f"{len(names)} files, {sum(sizes)} MB, "
+                  f"each minor server throttled to {args.throttle_mbps:g} MB/s")
+            small = [name for name, size in zip(names, sizes) if size <= min(sizes) * 2]
+            print(f"{'mode':<13}{'total s':>9}{'mean done s':>13}{'small done s':>14}")
+            for mode in MODES:
+                total, finished = run_mode(mode, infos, os.path.join(scratch, mode),
+                                           args.workers, args.per_server)
+                mean = statistics.mean(finished.values())
+                small_mean = statistics.mean(finished[name] for name in small)
+                print(f"{mode:<13}{total:>9.2f}{mean:>13.2f}{small_mean:>14.2f}")
+        finally:
+            for proxy in proxies:
+                proxy.terminate()
+            for proc in procs:
+                proc.terminate()
+                proc.wait()
+
+
+if __name__ == "__main__":
+    main()
+
+# Example usage (from src):
+# python bench_batch_download.py
+# python bench_batch_download.py --sizes-mb 1,1,1,1,1,1,1,1,100 --throttle-mbps 20
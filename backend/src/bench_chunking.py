@@ -0,0 +1,115 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+
+import server
+from metadata_store import MetadataStore
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+MODES = ["fixed", "cdc"]
+
+
+def variants(data, edits, seed):
+    """Modified copies of `data`, as a user might produce between two downloads."""
+    rng = random.Random(seed)
+    mid = len(data) // 2
+    scattered = bytearray(data)
+    for _ in range(edits):
+        pos = rng.randrange(len(data) - 100)
+        scattered[pos:pos + 100] = rng.randbytes(100)
+    return {
+        "insert 1 KB": data[:mid] + b"x" * 1024 + data[mid:],
+        "delete 1 KB": data[:mid] + data[mid + 1024:],
+        f"{edits} edits": bytes(scattered),
+        "append 1 MB": data + rng.randbytes(1024 * 1024),
+    }
+
+
+def stored_usage():
+    return sum(server.directory_usage(s["dir"]) for s in server.MINOR_SERVERS)
+
+
+def missing_bytes(original, copy):
+    """Content bytes of `copy` a client holding `original` still has to fetch.
+
+    Fixed segments are reused when their content checksum matches a segment
+    of the original, content-defined chunks when the chunk hash does.
+    """
+    key = "chunk" if "chunk" in copy["segments"][0] else "content_checksum"
+    have = {s[key] for s in original["segments"]}
+    return sum(s["end"] - s["start"] for s in copy["segments"] if s[key] not in have)
+
+
+def measure(mode, copies, scratch):
+    """(stored bytes, fetched bytes) per copy, each stored next to the original."""
+    server.CHUNKING = mode
+    server.MINOR_SERVERS = [
+        {"host": "localhost", "port": 8001 + i, "dir": os.path.join(scratch, mode, f"server{i + 1}")}
+        for i in range(3)
+    ]
+    for s in server.MINOR_SERVERS:
+        os.makedirs(s["dir"])
+    server.store = MetadataStore(os.path.join(scratch, mode, "segment_cache.json"))
+    server.DOWNLOAD_LEASE = 0
+    original = server.create_segments("original.xml")
+    base = stored_usage()
+    results = {}
+    for name in copies:
+        copy = server.create_segments(name)
+        results[name] = (stored_usage() - base, missing_bytes(original, copy))
+        server.evict(name)  # keeps chunks the original shares
+    return base, results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Storage and transfer for modified copies of a file, "
+        "with fixed segments versus content-defined chunks"
+    )
+    parser.add_argument("filename", nargs="?", default="large_file.xml")
+    parser.add_argument("--size-mb", type=int, default=100,
+                        help="Use only the first MB of the file (0 = all of it)")
+    parser.add_argument("--edits", type=int, default=10,
+                        help="Scattered 100-byte edits in the edited copy")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    path = os.path.join(SRC_DIR, server.FILE_DIR, args.filename)
+    if not os.path.exists(path):
+        sys.exit(f"{args.filename} missing, run gen_test_files.py first")
+    with open(path, "rb") as f:
+        data = f.read(args.size_mb * 1024 * 1024) if args.size_mb else f.read()
+
+    with tempfile.TemporaryDirectory() as scratch:
+        server.FILE_DIR = os.path.join(scratch, "data")
+        os.makedirs(server.FILE_DIR)
+        copies = variants(data, args.edits, args.seed)
+        names = {}
+        for i, (label, content) in enumerate(copies.items()):
+            names[f"copy{i}.xml"] = label
+            with open(os.path.join(server.FILE_DIR, f"copy{i}.xml"), "wb") as f:
+                f.write(content)
+        with open(os.path.join(server.FILE_DIR, "original.xml"), "wb") as f:
+            f.write(data)
+
+        mb = 1024 * 1024
+        print(f"{args.filename}: {len(data) / mb:.0f} MB, {server.REPLICATION_FACTOR} replicas per segment")
+        print(f"{'copy':<14}{'mode':<8}{'stored MB':>11}{'fetched MB':>12}")
+        results = {}
+        for mode in MODES:
+            base, results[mode] = measure(mode, names, scratch)
+            print(f"{'original':<14}{mode:<8}{base / mb:>11.1f}{len(data) / mb:>12.1f}")
+        for name, label in names.items():
+            for mode in MODES:
+                stored, fetched = results[mode][name]
+                print(f"{label:<14}{mode:<8}{stored / mb:>11.1f}{fetched / mb:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
+
+# Example usage (from src, after gen_test_files.py):
+# python bench_chunking.py
+# python bench_chunking.py large_file.xml --size-mb 0 --edits 50
@@ -0,0 +1,198 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from threading import Thread
+
+import client
+import server
+from metadata_store import MetadataStore
+
+BASE_PORT = 8201
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class TokenBucket:
+    """Shared byte budget: every connection through the proxy draws from it."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.next_free = 0.0
+
+    async def consume(self, n):
+        now = time.monotonic()
+        self.next_free = max(now, self.next_free) + n / self.rate
+        await asyncio.sleep(self.next_free - now)
+
+
+async def pipe(reader, writer, bucket=None):
+    try:
+        while True:
+            chunk = await reader.read(64 * 1024)
+            if not chunk:
+                break
+            if bucket is not None:
+                await bucket.consume(len(chunk))
+            writer.write(chunk)
+            await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+async def run_proxy(listen_port, target_port, rate):
+    bucket = TokenBucket(rate)
+
+    async def handle(client_reader, client_writer):
+        server_reader, server_writer = await asyncio.open_connection("localhost", target_port)
+        await asyncio.gather(
+            pipe(client_reader, server_writer),
+            pipe(server_reader, client_writer, bucket),
+        )
+
+    proxy = await asyncio.start_server(handle, "localhost", listen_port)
+    async with proxy:
+        await proxy.serve_forever()
+
+
+def throttled_proxy(listen_port, target_port, rate):
+    asyncio.run(run_proxy(listen_port, target_port, rate))
+
+
+def wait_for_port(port):
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("localhost", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Nothing listening on port {port}")
+
+
+def fetch_with_failover(downloader, segment):
+    """Fetch one segment, moving to the next replica after each failed attempt."""
+    replicas = client.replica_servers(segment)
+    for attempt in range(client.MAX_RETRIES):
+        server = replicas[attempt % len(replicas)]
+        try:
+            if downloader.try_download_segment(dict(segment, server=server)) is not None:
+                return
+        except Exception as e:
+            print(f"Segment {segment['id']} (attempt {attempt + 1}): {e}", file=sys.stderr)
+
+
+def unbounded_download(downloader):
+    """The previous FileDownloader.download: one thread per missing segment."""
+    threads = []
+    downloader.open_output()
+    for segment in downloader.segments:
+        if segment['id'] not in downloader.downloaded_segments:
+            thread = Thread(target=fetch_with_failover, args=(downloader, segment))
+            thread.start()
+            threads.append(thread)
+    for thread in threads:
+        thread.join()
+    downloader.close_output()
+    downloader.pbar.close()
+    downloader.finish_download()
+
+
+def timed_download(filename, file_info, mode, workdir, workers, per_server):
+    # FileDownloader keeps its segments and resume file in the working directory
+    os.makedirs(workdir)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        downloader = client.FileDownloader(
+            filename, "output", None, None, file_info=file_info,
+            max_workers=workers, max_server_concurrency=per_server,
+        )
+        started = time.perf_counter()
+        if mode == "unbounded":
+            unbounded_download(downloader)
+        else:
+            downloader.download()
+        elapsed = time.perf_counter() - started
+        assert os.path.getsize("output") == file_info["file_size"]
+    finally:
+        os.chdir(cwd)
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Download time with one throttled minor server: "
+        "thread per segment versus the bounded AIMD scheduler"
+    )
+    parser.add_argument("filename", nargs="?", default="large_file.xml")
+    parser.add_argument("--throttle-mbps", type=float, default=20,
+                        help="Bandwidth of the throttled server in MB/s")
+    parser.add_argument("--workers", type=int, default=client.MAX_WORKERS)
+    parser.add_argument("--per-server", type=int, default=client.MAX_SERVER_CONCURRENCY)
+    args = parser.parse_args()
+
+    server.FILE_DIR = os.path.join(SRC_DIR, server.FILE_DIR)
+    if not os.path.exists(os.path.join(server.FILE_DIR, args.filename)):
+        sys.exit(f"{args.filename} missing, run gen_test_files.py first")
+
+    with tempfile.TemporaryDirectory() as scratch:
+        # The third server is reached through a throttling proxy
+        ports = [BASE_PORT, BASE_PORT + 1, BASE_PORT + 2]
+        server.MINOR_SERVERS = [
+            {"host": "localhost", "port": port, "dir": os.path.join(scratch, f"server{i + 1}")}
+            for i, port in enumerate(ports)
+        ]
+        for s in server.MINOR_SERVERS:
+            os.makedirs(s["dir"])
+        server.store = MetadataStore(os.path.join(scratch, "segment_cache.json"))
+        file_info = server.create_segments(args.filename)
+
+        real_ports = ports[:2] + [BASE_PORT + 12]
+        procs = [
+            subprocess.Popen(
+                [sys.executable, os.path.join(SRC_DIR, "minor_server.py"), str(port), s["dir"]],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            for port, s in zip(real_ports, server.MINOR_SERVERS)
+        ]
+        proxy = multiprocessing.Process(
+            target=throttled_proxy,
+            args=(ports[2], real_ports[2], args.throttle_mbps * 1024 * 1024),
+            daemon=True,
+        )
+        proxy.start()
+        try:
+            for port in real_ports + ports[2:]:
+                wait_for_port(port)
+            print(f"{args.filename}: {file_info['total_segments']} segments, "
+                  f"server 3 throttled to {args.throttle_mbps:g} MB/s")
+            results = {}
+            for mode in ("unbounded", "scheduler"):
+                results[mode] = timed_download(
+                    args.filename, file_info, mode, os.path.join(scratch, mode),
+                    args.workers, args.per_server,
+                )
+            print(f"{'mode':<12}{'secs':>9}")
+            for mode, elapsed in results.items():
+                print(f"{mode:<12}{elapsed:>9.2f}")
+        finally:
+            proxy.terminate()
+            for proc in procs:
+                proc.terminate()
+                proc.wait()
+
+
+if __name__ == "__main__":
+    main()
+
+# Example usage (from src, after gen_test_files.py):
+# python bench_download_scheduler.py
+# python bench_download_scheduler.py large_file.xml --throttle-mbps 10 --workers 16
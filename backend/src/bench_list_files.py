@@ -0,0 +1,75 @@
+import argparse
+import os
+import tempfile
+import time
+
+import server
+from file_index import FileIndex
+
+DEFAULT_FILES = [1000, 10000, 50000]
+
+
+def legacy_list(directory):
+    """The previous list_available_files: listdir plus a getsize per file, on every request."""
+    return [
+        {"name": f, "size": os.path.getsize(os.path.join(directory, f))}
+        for f in os.listdir(directory)
+        if os.path.isfile(os.path.join(directory, f))
+    ]
+
+
+def per_second(fn, seconds):
+    count = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        fn()
+        count += 1
+    return count / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="list_files and existence checks with many files: "
+        "listdir and stat per request versus the incremental file index"
+    )
+    parser.add_argument("--files", type=int, nargs="+", default=DEFAULT_FILES)
+    parser.add_argument("--seconds", type=float, default=2, help="Time spent on each measurement")
+    args = parser.parse_args()
+
+    print(f"{'files':>7}{'op':>22}{'legacy /s':>12}{'index /s':>12}")
+    for count in args.files:
+        with tempfile.TemporaryDirectory() as scratch:
+            directory = os.path.join(scratch, "data")
+            os.makedirs(directory)
+            for i in range(count):
+                with open(os.path.join(directory, f"file_{i:06d}.bin"), "wb") as f:
+                    f.write(b"x" * (i % 100))
+            index = FileIndex(directory)
+            name = f"file_{count // 2:06d}.bin"
+
+            legacy = per_second(lambda: legacy_list(directory), args.seconds)
+            indexed = per_second(lambda: index.page(limit=server.LIST_PAGE_SIZE), args.seconds)
+            print(f"{count:>7}{'list (first page)':>22}{legacy:>12.1f}{indexed:>12.1f}")
+
+            legacy = per_second(lambda: name in [f["name"] for f in legacy_list(directory)], args.seconds)
+            indexed = per_second(lambda: index.get(name), args.seconds)
+            print(f"{count:>7}{'exists':>22}{legacy:>12.1f}{indexed:>12.1f}")
+
+            def all_pages():
+                files, cursor = index.page(limit=server.LIST_PAGE_SIZE)
+                while cursor is not None:
+                    page, cursor = index.page(cursor, server.LIST_PAGE_SIZE)
+                    files += page
+                return files
+
+            legacy = per_second(lambda: legacy_list(directory), args.seconds)
+            indexed = per_second(all_pages, args.seconds)
+            print(f"{count:>7}{'list (every page)':>22}{legacy:>12.1f}{indexed:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
+
+# Example usage (from src):
+# python bench_list_files.py
+# python bench_list_files.py --files 100000 --seconds 5
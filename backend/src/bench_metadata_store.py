@@ -0,0 +1,112 @@
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+from threading import Thread
+
+import server
+from metadata_store import MetadataStore
+
+DEFAULT_THREADS = [1, 8, 32]
+
+
+def fake_file_info(name, segments, blocks):
+    """A cache entry shaped like create_segments output, without the segment files."""
+    size = segments * server.BASE_SEGMENT_SIZE
+    return {
+        "segments": [
+            {
+                "id": i + 1,
+                "start": i * server.BASE_SEGMENT_SIZE,
+                "end": (i + 1) * server.BASE_SEGMENT_SIZE,
+                "server": server.MINOR_SERVERS[i % 3],
+                "replicas": [server.MINOR_SERVERS[i % 3], server.MINOR_SERVERS[(i + 1) % 3]],
+                "checksum": os.urandom(16).hex(),
+                "content_checksum": os.urandom(16).hex(),
+                "blocks": [os.urandom(16).hex() for _ in range(blocks)],
+                "root": os.urandom(16).hex(),
+            }
+            for i in range(segments)
+        ],
+        "total_segments": segments,
+        "segment_size": server.BASE_SEGMENT_SIZE,
+        "file_size": size,
+        "is_compressed": False,
+        "last_accessed": time.time(),
+        "checksum": os.urandom(16).hex(),
+        "tree_checksum": os.urandom(16).hex(),
+        "manifest": {"algorithm": server.BLOCK_HASH, "block_size": server.BLOCK_SIZE,
+                     "root": os.urandom(16).hex()},
+    }
+
+
+def json_rewrite_lookup(cache, path):
+    """The previous cache hit: update last_accessed and rewrite the whole JSON file."""
+    def lookup(filename):
+        file_info = cache[filename]
+        file_info["last_accessed"] = time.time()
+        with open(path, "w") as f:
+            json.dump(cache, f)
+        return file_info
+    return lookup
+
+
+def requests_per_second(lookup, names, threads, requests):
+    def worker():
+        for _ in range(requests // threads):
+            lookup(random.choice(names))
+
+    workers = [Thread(target=worker) for _ in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return requests // threads * threads / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="get_file_info requests/s on cache hits: JSON file rewritten "
+        "per request versus the metadata store"
+    )
+    parser.add_argument("--files", type=int, default=1000)
+    parser.add_argument("--segments", type=int, default=4, help="Segments per file")
+    parser.add_argument("--blocks", type=int, default=16, help="Manifest blocks per segment")
+    parser.add_argument("--threads", type=int, nargs="+", default=DEFAULT_THREADS)
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+
+    names = [f"file_{i}.bin" for i in range(args.files)]
+    infos = {name: fake_file_info(name, args.segments, args.blocks) for name in names}
+    with tempfile.TemporaryDirectory() as scratch:
+        legacy = json_rewrite_lookup(dict(infos), os.path.join(scratch, "legacy.json"))
+        server.store = MetadataStore(os.path.join(scratch, "segment_cache.json"))
+        # Empty sources, so lookups see them unchanged since segmentation
+        server.FILE_DIR = os.path.join(scratch, "data")
+        os.makedirs(server.FILE_DIR)
+        for name, info in infos.items():
+            path = os.path.join(server.FILE_DIR, name)
+            open(path, "wb").close()
+            info["source"] = server.source_stat(path)
+            server.store.put(name, info)
+        server.store.start()
+
+        print(f"{args.files} files cached")
+        print(f"{'lookup':<14}{'threads':>8}{'req/s':>12}")
+        for threads in args.threads:
+            rate = requests_per_second(legacy, names, threads, args.requests)
+            print(f"{'json rewrite':<14}{threads:>8}{rate:>12.1f}")
+            rate = requests_per_second(server.get_file_info, names, threads, args.requests)
+            print(f"{'store':<14}{threads:>8}{rate:>12.1f}")
+        server.store.close()
+
+
+if __name__ == "__main__":
+    main()
+
+# Example usage (from src):
+# python bench_metadata_store.py
+# python bench_metadata_store.py --files 1000 --segments 10 --blocks 80 --threads 1 16
@@ -0,0 +1,127 @@
+import argparse
+import asyncio
+import os
+import resource
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+DEFAULT_CONCURRENCY = [10, 100, 1000]
+SEGMENT_NAME = "bench.bin"
+
+
+def raise_fd_limit():
+    # 1000 concurrent fetches need more descriptors than the usual soft limit;
+    # the server subprocess inherits the raised limit.
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or hard > soft:
+        target = 65536 if hard == resource.RLIM_INFINITY else hard
+        resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+
+
+def start_server(port, base_path, use_async, backlog):
+    cmd = [sys.executable, "minor_server.py", str(port), base_path,
+           "--backlog", str(backlog)]
+    if use_async:
+        cmd.append("--async")
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("localhost", port), timeout=1).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError(f"Minor server on port {port} did not start")
+
+
+async def fetch(port, size):
+    """One old-style text GET_SEGMENT on a fresh connection, like client.py."""
+    reader, writer = await asyncio.open_connection("localhost", port)
+    try:
+        writer.write(f"GET_SEGMENT {SEGMENT_NAME} 1 False".encode())
+        await writer.drain()
+        length, _ = struct.unpack("!I32s", await reader.readexactly(36))
+        if length != size:
+            raise IOError(f"Expected {size} bytes, server sent {length}")
+        await reader.readexactly(length)
+    finally:
+        writer.close()
+
+
+async def load(port, size, concurrency, requests):
+    latencies = []
+    errors = 0
+    queue = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for _ in queue:
+            started = time.perf_counter()
+            try:
+                await fetch(port, size)
+            except (OSError, asyncio.IncompleteReadError):
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return latencies, errors, time.perf_counter() - started
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Load-test the threaded and asyncio minor servers"
+    )
+    parser.add_argument("--concurrency", type=int, nargs="+", default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--requests", type=int, default=2000,
+                        help="Fetches per run (at least one per concurrent client)")
+    parser.add_argument("--segment-kb", type=int, default=256)
+    parser.add_argument("--backlog", type=int, default=1024)
+    parser.add_argument("--port", type=int, default=8101)
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    size = args.segment_kb * 1024
+    with tempfile.TemporaryDirectory() as scratch:
+        with open(os.path.join(scratch, f"{SEGMENT_NAME}_segment_1"), "wb") as f:
+            f.write(os.urandom(size))
+
+        print(f"{'engine':<10}{'conc':>6}{'reqs':>7}{'errors':>8}{'req/s':>10}"
+              f"{'p50 ms':>9}{'p99 ms':>9}")
+        for engine in ("threaded", "async"):
+            proc = start_server(args.port, scratch, engine == "async", args.backlog)
+            try:
+                for concurrency in args.concurrency:
+                    requests = max(args.requests, concurrency)
+                    latencies, errors, elapsed = asyncio.run(
+                        load(args.port, size, concurrency, requests)
+                    )
+                    print(f"{engine:<10}{concurrency:>6}{requests:>7}{errors:>8}"
+                          f"{len(latencies) / elapsed:>10.1f}"
+                          f"{percentile(latencies, 0.5) * 1000:>9.1f}"
+                          f"{percentile(latencies, 0.99) * 1000:>9.1f}")
+            finally:
+                proc.terminate()
+                proc.wait()
+
+
+if __name__ == "__main__":
+    main()
+
+# Example usage (from src):
+# python bench_minor_server.py
+# python bench_minor_server.py --concurrency 10 100 1000 --segment-kb 1024
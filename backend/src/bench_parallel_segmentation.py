@@ -0,0 +1,58 @@
+import argparse
+import os
+import tempfile
+import time
+
+import server
+from bench_segmentation import use_scratch_dirs
+
+
+def time_segmentation(filename, workers):
+    server.SEGMENT_WORKERS = workers
+    server._segment_pool = None
+    with tempfile.TemporaryDirectory() as scratch:
+        use_scratch_dirs(scratch)
+        if workers > 1:
+            # Start the pool up front so process spawn is not part of the timing
+            server.get_segment_pool().submit(int).result()
+        started = time.perf_counter()
+        info = server.create_segments(filename)
+        elapsed = time.perf_counter() - started
+    if server._segment_pool is not None:
+        server._segment_pool.shutdown()
+    return info, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare serial and parallel create_segments"
+    )
+    parser.add_argument("filename", nargs="?", default="large_file.xml")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        nargs="+",
+        default=sorted({2, os.cpu_count() or 1}),
+        help="Parallel worker counts to compare against the serial run",
+    )
+    args = parser.parse_args()
+
+    info, serial = time_segmentation(args.filename, 1)
+    print(f"{args.filename}: {info['file_size'] / (1024 * 1024):.1f} MB, "
+          f"{info['total_segments']} segments")
+    print(f"{'workers':>8}{'secs':>9}{'speedup':>9}")
+    print(f"{1:>8}{serial:>9.2f}{1:>9.2f}")
+    for workers in args.workers:
+        if workers <= 1:
+            continue
+        parallel_info, elapsed = time_segmentation(args.filename, workers)
+        assert parallel_info["checksum"] == info["checksum"]
+        print(f"{workers:>8}{elapsed:>9.2f}{serial / elapsed:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
+
+# Example usage (from src, after gen_test_files.py):
+# python bench_parallel_segmentation.py
+# python bench_parallel_segmentation.py large_file.xml --workers 2 4 8
@@ -0,0 +1,81 @@
+import argparse
+import hashlib
+import socket
+import time
+from threading import Thread
+
+import protocol
+
+DEFAULT_SEGMENT_MB = [1, 5, 25]
+DEFAULT_READ_KB = [64, 256, 1024]
+
+
+def send_segments(listener, payload, rounds):
+    conn, _ = listener.accept()
+    with conn:
+        for _ in range(rounds):
+            conn.sendall(payload)
+
+
+def receive_concat(sock, size):
+    """The previous receive loop: 4096-byte recv calls and bytes concatenation."""
+    segment_data = b""
+    while len(segment_data) < size:
+        chunk = sock.recv(min(4096, size - len(segment_data)))
+        if not chunk:
+            break
+        segment_data += chunk
+    return hashlib.md5(segment_data).hexdigest()
+
+
+def receive_into(sock, size, view):
+    segment_hash = hashlib.md5()
+    for chunk in protocol.recv_chunks(sock, view, size):
+        segment_hash.update(chunk)
+    return segment_hash.hexdigest()
+
+
+def throughput(size, rounds, receive):
+    """MB/s for `rounds` segments of `size` bytes received over loopback TCP."""
+    listener = socket.create_server(("localhost", 0))
+    sender = Thread(
+        target=send_segments,
+        args=(listener, bytes(size), rounds),
+    )
+    sender.start()
+    with socket.create_connection(listener.getsockname()) as sock:
+        started = time.perf_counter()
+        for _ in range(rounds):
+            receive(sock, size)
+        elapsed = time.perf_counter() - started
+    sender.join()
+    listener.close()
+    return size * rounds / elapsed / (1024 * 1024)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Segment receive throughput")
+    parser.add_argument("--segment-mb", type=int, nargs="+", default=DEFAULT_SEGMENT_MB)
+    parser.add_argument("--read-kb", type=int, nargs="+", default=DEFAULT_READ_KB)
+    parser.add_argument("--total-mb", type=int, default=50,
+                        help="Data received per measurement")
+    args = parser.parse_args()
+
+    print(f"{'segment MB':>11}{'method':>18}{'MB/s':>10}")
+    for segment_mb in args.segment_mb:
+        size = segment_mb * 1024 * 1024
+        rounds = max(1, args.total_mb // segment_mb)
+        rate = throughput(size, rounds, receive_concat)
+        print(f"{segment_mb:>11}{'concat 4 KB':>18}{rate:>10.1f}")
+        for read_kb in args.read_kb:
+            view = memoryview(bytearray(read_kb * 1024))
+            rate = throughput(size, rounds, lambda sock, n: receive_into(sock, n, view))
+            print(f"{segment_mb:>11}{f'recv_into {read_kb} KB':>18}{rate:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
+
+# Example usage (from src):
+# python bench_receive.py
+# python bench_receive.py --segment-mb 5 --read-kb 16 64 256 1024
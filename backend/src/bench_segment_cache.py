@@ -0,0 +1,160 @@
+import argparse
+import itertools
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from threading import Thread
+
+import protocol
+import server
+from file_index import FileIndex
+from metadata_store import MetadataStore
+from segment_cache import CachedSegment, SegmentCache, file_signature
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def start_server(port, base_path, use_async, cache_mb):
+    cmd = [sys.executable, os.path.join(SRC_DIR, "minor_server.py"), str(port), base_path]
+    if use_async:
+        cmd.append("--async")
+    if cache_mb:
+        cmd += ["--cache-mb", str(cache_mb)]
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("localhost", port), timeout=1).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError(f"Minor server on port {port} did not start")
+
+
+def zipf_trace(segments, count, exponent, seed):
+    """`count` segments drawn with the popularity of the one ranked k falling as 1/k**exponent."""
+    rng = random.Random(seed)
+    ranked = segments[:]
+    rng.shuffle(ranked)
+    weights = list(itertools.accumulate(1 / k ** exponent for k in range(1, len(ranked) + 1)))
+    return rng.choices(ranked, cum_weights=weights, k=count)
+
+
+def fetch_all(port, requests, accept_encoding):
+    """Fetch `requests` one after another on one multiplexed connection; return bytes received."""
+    sock = socket.create_connection(("localhost", port))
+    buf = memoryview(bytearray(1024 * 1024))
+    received = 0
+    try:
+        sock.sendall(protocol.pack_hello())
+        protocol.unpack_hello(protocol.recv_exact(sock, protocol.HELLO.size))
+        for request_id, (filename, segment_id, is_compressed) in enumerate(requests):
+            request = {"filename": filename, "segment_id": segment_id,
+                       "is_compressed": is_compressed, "accept_encoding": accept_encoding}
+            sock.sendall(protocol.pack_frame_header(protocol.REQUEST, request_id, request))
+            kind, _, meta, length = protocol.recv_frame_header(sock)
+            if kind != protocol.SEGMENT:
+                raise IOError(f"Segment {segment_id} of {filename}: {meta}")
+            for chunk in protocol.recv_chunks(sock, buf, length):
+                received += len(chunk)
+    finally:
+        sock.close()
+    return received
+
+
+def replay(port, trace, concurrency, accept_encoding):
+    """Split the trace across `concurrency` connections; return (seconds, bytes received)."""
+    received = []
+    threads = [
+        Thread(target=lambda part: received.append(fetch_all(port, part, accept_encoding)),
+               args=(trace[i::concurrency],))
+        for i in range(concurrency)
+    ]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - started, sum(received)
+
+
+def expected_hit_rate(trace, base_path, cache_mb, accept_encoding, decoded_sizes):
+    """Hit rate of the trace replayed in order through a SegmentCache of the same budget."""
+    cache = SegmentCache(int(cache_mb * 1024 * 1024))
+    blank = memoryview(bytes(max(decoded_sizes.values())))
+    for filename, segment_id, is_compressed in trace:
+        path = os.path.join(base_path, f"{filename}_segment_{segment_id}")
+        decoded = is_compressed and "zlib" not in accept_encoding
+        size = decoded_sizes[(filename, segment_id)] if decoded else os.path.getsize(path)
+        cache.get((path, decoded), path,
+                  lambda p: CachedSegment(file_signature(os.stat(p)), blank[:size], ""))
+    return cache.stats()["hit_rate"]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay a Zipf-skewed stream of segment requests against a "
+        "minor server with the segment cache off and on"
+    )
+    parser.add_argument("--data-dir", default="data", help="Directory of generated test files")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=8, help="Connections replaying the trace")
+    parser.add_argument("--zipf", type=float, default=1.1, help="Exponent of the popularity skew")
+    parser.add_argument("--cache-mb", type=float, nargs="+", default=[64, 256])
+    parser.add_argument("--accept-zlib", action="store_true",
+                        help="Take compressed segments as stored instead of decoded by the server")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="Run the asyncio engine instead of the threaded one")
+    parser.add_argument("--port", type=int, default=8121)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    accept_encoding = ["zlib"] if args.accept_zlib else []
+
+    with tempfile.TemporaryDirectory() as scratch:
+        base_path = os.path.join(scratch, "segments")
+        os.makedirs(base_path)
+        server.FILE_DIR = args.data_dir
+        server.file_index = FileIndex(args.data_dir)
+        server.MINOR_SERVERS = [{"host": "localhost", "port": args.port, "dir": base_path}]
+        server.REPLICATION_FACTOR = 1
+        server.store = MetadataStore(os.path.join(scratch, "segment_cache.json"))
+
+        segments = []
+        decoded_sizes = {}
+        for name in sorted(os.listdir(args.data_dir)):
+            if not os.path.isfile(os.path.join(args.data_dir, name)):
+                continue
+            info = server.create_segments(name)
+            for segment in info["segments"]:
+                segments.append((name, segment["id"], info["is_compressed"]))
+                decoded_sizes[(name, segment["id"])] = segment["end"] - segment["start"]
+        trace = zipf_trace(segments, args.requests, args.zipf, args.seed)
+        distinct = len(set(trace))
+        print(f"{len(segments)} segments, {args.requests} requests over {distinct} of them, "
+              f"zipf {args.zipf:g}, {args.concurrency} connections")
+
+        print(f"{'cache MB':>9}{'hit rate':>10}{'req/s':>10}{'MB/s':>10}")
+        for cache_mb in [0] + args.cache_mb:
+            proc = start_server(args.port, base_path, args.use_async, cache_mb)
+            try:
+                elapsed, received = replay(args.port, trace, args.concurrency, accept_encoding)
+            finally:
+                proc.terminate()
+                proc.wait()
+            hits = (expected_hit_rate(trace, base_path, cache_mb, accept_encoding, decoded_sizes)
+                    if cache_mb else 0.0)
+            print(f"{cache_mb or 'off':>9}{hits:>10.1%}{args.requests / elapsed:>10.1f}"
+                  f"{received / elapsed / (1024 * 1024):>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
+
+# Example usage (from src, after python gen_test_files.py):
+# python bench_segment_cache.py
+# python bench_segment_cache.py --cache-mb 32 128 512 --zipf 0.8 --async
@@ -0,0 +1,82 @@
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+
+import server
+from metadata_store import MetadataStore
+
+# Files produced by gen_test_files.py
+DEFAULT_FILES = ["small_file.bin", "medium_file.txt", "large_file.xml"]
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in kilobytes elsewhere
+    if sys.platform == "darwin":
+        return rss / (1024 * 1024)
+    return rss / 1024
+
+
+def use_scratch_dirs(scratch):
+    """Point the server at throwaway segment directories and cache file."""
+    server.MINOR_SERVERS = [
+        dict(s, dir=os.path.join(scratch, s["dir"])) for s in server.MINOR_SERVERS
+    ]
+    for s in server.MINOR_SERVERS:
+        os.makedirs(s["dir"], exist_ok=True)
+    server.store = MetadataStore(os.path.join(scratch, "segment_cache.json"))
+
+
+def run_one(filename, results):
+    # Runs in a fresh process so ru_maxrss only reflects this file. Segmenting
+    # serially keeps all the work, and all the memory, in this process.
+    server.SEGMENT_WORKERS = 1
+    with tempfile.TemporaryDirectory() as scratch:
+        use_scratch_dirs(scratch)
+        rss_before = peak_rss_mb()
+        started = time.perf_counter()
+        info = server.create_segments(filename)
+        elapsed = time.perf_counter() - started
+        results.put(
+            {
+                "file": filename,
+                "size": info["file_size"],
+                "segments": info["total_segments"],
+                "seconds": elapsed,
+                "rss_before": rss_before,
+                "rss_peak": peak_rss_mb(),
+            }
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark create_segments")
+    parser.add_argument("files", nargs="*", default=DEFAULT_FILES)
+    args = parser.parse_args()
+
+    print(f"{'file':<20}{'size MB':>10}{'segs':>6}{'secs':>9}{'MB/s':>9}"
+          f"{'RSS start MB':>14}{'RSS peak MB':>13}")
+    for filename in args.files:
+        if not os.path.exists(os.path.join(server.FILE_DIR, filename)):
+            print(f"{filename:<20} missing, run gen_test_files.py first")
+            continue
+        results = multiprocessing.Queue()
+        proc = multiprocessing.Process(target=run_one, args=(filename, results))
+        proc.start()
+        r = results.get()
+        proc.join()
+        size_mb = r["size"] / (1024 * 1024)
+        print(f"{r['file']:<20}{size_mb:>10.1f}{r['segments']:>6}{r['seconds']:>9.2f}"
+              f"{size_mb / r['seconds']:>9.1f}{r['rss_before']:>14.1f}{r['rss_peak']:>13.1f}")
+
+
+if __name__ == "__main__":
+    main()
+
+# Example usage (from src, after gen_test_files.py):
+# python bench_segmentation.py
+# python bench_segmentation.py large_file.xml
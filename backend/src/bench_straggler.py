@@ -0,0 +1,99 @@
+import argparse
+import copy
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+
+import client
+import server
+from bench_download_scheduler import throttled_proxy, timed_download, wait_for_port
+from metadata_store import MetadataStore
+
+BASE_PORT = 8231
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def single_source(file_info):
+    """The same file info with each segment listing only its first server."""
+    single = copy.deepcopy(file_info)
+    for segment in single["segments"]:
+        segment.pop("replicas", None)
+    return single
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Download time with one slow minor server: segments fetched "
+        "from their first server only versus from every replica"
+    )
+    parser.add_argument("filename", nargs="?", default="large_file.xml")
+    parser.add_argument("--throttle-mbps", type=float, default=10,
+                        help="Bandwidth of the slow server in MB/s")
+    parser.add_argument("--workers", type=int, default=client.MAX_WORKERS)
+    parser.add_argument("--per-server", type=int, default=client.MAX_SERVER_CONCURRENCY)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    server.FILE_DIR = os.path.join(SRC_DIR, server.FILE_DIR)
+    if not os.path.exists(os.path.join(server.FILE_DIR, args.filename)):
+        sys.exit(f"{args.filename} missing, run gen_test_files.py first")
+
+    with tempfile.TemporaryDirectory() as scratch:
+        # The third server is reached through a throttling proxy
+        ports = [BASE_PORT, BASE_PORT + 1, BASE_PORT + 2]
+        server.MINOR_SERVERS = [
+            {"host": "localhost", "port": port, "dir": os.path.join(scratch, f"server{i + 1}")}
+            for i, port in enumerate(ports)
+        ]
+        for s in server.MINOR_SERVERS:
+            os.makedirs(s["dir"])
+        server.store = MetadataStore(os.path.join(scratch, "segment_cache.json"))
+        server.REPLICATION_FACTOR = len(server.MINOR_SERVERS)
+        replicated = server.create_segments(args.filename)
+        single = single_source(replicated)
+
+        real_ports = ports[:2] + [BASE_PORT + 12]
+        procs = [
+            subprocess.Popen(
+                [sys.executable, os.path.join(SRC_DIR, "minor_server.py"), str(port), s["dir"]],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            for port, s in zip(real_ports, server.MINOR_SERVERS)
+        ]
+        proxy = multiprocessing.Process(
+            target=throttled_proxy,
+            args=(ports[2], real_ports[2], args.throttle_mbps * 1024 * 1024),
+            daemon=True,
+        )
+        proxy.start()
+        try:
+            for port in real_ports + ports[2:]:
+                wait_for_port(port)
+            print(f"{args.filename}: {single['total_segments']} segments, "
+                  f"server 3 throttled to {args.throttle_mbps:g} MB/s")
+            print(f"{'mode':<16}{'best s':>9}{'mean s':>9}")
+            for mode, file_info in (("single source", single), ("multi-source", replicated)):
+                times = [
+                    timed_download(
+                        args.filename, file_info, "scheduler",
+                        os.path.join(scratch, f"{mode}-{i}"), args.workers, args.per_server,
+                    )
+                    for i in range(args.rounds)
+                ]
+                print(f"{mode:<16}{min(times):>9.2f}{sum(times) / len(times):>9.2f}")
+        finally:
+            proxy.terminate()
+            for proc in procs:
+                proc.terminate()
+                proc.wait()
+
+
+if __name__ == "__main__":
+    main()
+
+# Example usage (from src, after gen_test_files.py):
+# python bench_straggler.py
+# python bench_straggler.py large_file.xml --throttle-mbps 5 --rounds 5
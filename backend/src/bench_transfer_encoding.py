@@ -0,0 +1,94 @@
+import argparse
+import os
+import socket
+import tempfile
+import time
+from threading import Thread
+
+import minor_server
+import protocol
+import server
+from bench_segmentation import use_scratch_dirs
+
+DEFAULT_FILES = ["medium_file.txt", "large_file.xml"]
+
+
+def drain(sock, counter):
+    while True:
+        chunk = sock.recv(1024 * 1024)
+        if not chunk:
+            break
+        counter[0] += len(chunk)
+
+
+def serve_once(base_path, filename, segment_id, accept_encoding):
+    """Serve one framed GET_SEGMENT reply over a socket pair.
+
+    Returns the bytes that crossed the wire and the CPU time spent by the
+    serving thread alone (reading, decompressing, hashing and sending).
+    """
+    server_end, client_end = socket.socketpair()
+    received = [0]
+    reader = Thread(target=drain, args=(client_end, received))
+    reader.start()
+    started = time.thread_time()
+    segment = minor_server.read_segment(
+        base_path, filename, segment_id, True, accept_encoding
+    )
+    try:
+        server_end.sendall(
+            protocol.pack_frame_header(
+                protocol.SEGMENT,
+                segment_id,
+                {"checksum": segment.checksum, "encoding": segment.encoding},
+                segment.size,
+            )
+        )
+        minor_server.send_segment(server_end, segment)
+    finally:
+        segment.close()
+    cpu = time.thread_time() - started
+    server_end.close()
+    reader.join()
+    client_end.close()
+    return received[0], cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Bytes on the wire and minor server CPU per segment, "
+        "with wire compression on and off"
+    )
+    parser.add_argument("files", nargs="*", default=DEFAULT_FILES)
+    args = parser.parse_args()
+
+    print(f"{'file':<20}{'wire':<10}{'segs':>6}{'KB/seg':>12}{'CPU ms/seg':>12}")
+    for filename in args.files:
+        if not os.path.exists(os.path.join(server.FILE_DIR, filename)):
+            print(f"{filename:<20} missing, run gen_test_files.py first")
+            continue
+        with tempfile.TemporaryDirectory() as scratch:
+            use_scratch_dirs(scratch)
+            info = server.create_segments(filename)
+            if not info["is_compressed"]:
+                print(f"{filename:<20} is not stored compressed, skipping")
+                continue
+            for label, accept in (("off", ()), ("zlib", ("zlib",))):
+                total_bytes = total_cpu = 0
+                for segment in info["segments"]:
+                    sent, cpu = serve_once(
+                        segment["server"]["dir"], filename, segment["id"], accept
+                    )
+                    total_bytes += sent
+                    total_cpu += cpu
+                n = info["total_segments"]
+                print(f"{filename:<20}{label:<10}{n:>6}{total_bytes / n / 1024:>12.1f}"
+                      f"{total_cpu / n * 1000:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
+
+# Example usage (from src, after gen_test_files.py):
+# python bench_transfer_encoding.py
+# python bench_transfer_encoding.py medium_file.txt
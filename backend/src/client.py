@@ -2,31 +2,1153 @@ import socket
 import json
 import os
 import struct
-from threading import Thread, Lock
+from threading import Thread, Lock, Event, Condition
 import logging
 import time
 import argparse
 import hashlib
 from tqdm import tqdm
-import zlib
-import pickle
+import itertools
+import asyncio
+import fnmatch
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+import protocol
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 MAIN_SERVER_HOST = 'localhost'
 MAIN_SERVER_PORT = 8000
 MAX_RETRIES = 3
-RESUME_FILE = 'download_resume.pickle'
-SEGMENT_DIR = 'downloaded_segments'
+PROGRESS_SUFFIX = '.progress'  # progress journal kept next to each output file
+VERSION_SUFFIX = '.version'  # version and segment digests of a finished output file
+CONNECTIONS_PER_SERVER = 2  # persistent multiplexed connections per minor server
+REQUEST_TIMEOUT = 60  # seconds a multiplexed request waits with nothing of its reply arriving
+WIRE_COMPRESSION = True  # accept compressed segments as stored and decode them here
+RECV_SIZE = 256 * 1024  # bytes asked of the socket per recv_into
+MAX_WORKERS = 16  # segment fetches in flight across all servers
+INITIAL_SERVER_CONCURRENCY = 2  # starting AIMD window per minor server
+MAX_SERVER_CONCURRENCY = 8  # largest AIMD window per minor server
+THROUGHPUT_TOLERANCE = 0.9  # keep growing a window while throughput stays this close to its best
+THROUGHPUT_SMOOTHING = 0.3  # weight of the newest sample in the throughput average
+RETRY_DELAY = 1  # seconds before a failed segment is fetched again
+STRAGGLER_MIN_BYTES = 1024 * 1024  # smallest unfetched tail worth splitting onto another replica
+STRAGGLER_POLL = 0.2  # seconds between looks for stragglers once nothing is left to start
+CHUNK_INDEX_FILE = 'chunk_index.json'  # chunks of earlier downloads, reused instead of fetched
+MAX_DOWNLOADS = 32  # downloads a Downloader runs at once; later ones wait their turn
+MAIN_IDLE_CONNECTIONS = 4  # idle connections to the main server a Downloader keeps for reuse
+MAX_BANDWIDTH = None  # bytes per second of segments started across all servers, None for no limit
+SERVER_BANDWIDTH = None  # bytes per second of segments started on one minor server, None for no limit
+MAX_FILE_SHARE = 0.5  # share of a batch's workers one file may hold while other files wait
+METRICS_PORT = None  # local port serving metrics; None = no endpoint
+
+SEGMENT_SECONDS = metrics.histogram(
+    'fdl_client_segment_fetch_seconds', 'Time to fetch one segment or range', ['server']
+)
+SEGMENT_THROUGHPUT = metrics.histogram(
+    'fdl_client_segment_throughput_bytes', 'Bytes per second of each segment or range fetched',
+    ['server'], buckets=metrics.THROUGHPUT_BUCKETS,
+)
+SEGMENT_BYTES = metrics.counter('fdl_client_segment_bytes_total', 'Segment bytes fetched', ['server'])
+FETCHES = metrics.counter(
+    'fdl_client_fetches_total', 'Fetch attempts of segments and straggler ranges', ['server', 'kind', 'result']
+)
+RETRIES = metrics.counter('fdl_client_retries_total', 'Failed segments queued to be fetched again')
+ABANDONED = metrics.counter('fdl_client_abandoned_segments_total', f'Segments given up after {MAX_RETRIES} attempts')
+
+
+class BufferPool:
+    """Free list of RECV_SIZE receive buffers, reused across segments."""
+
+    def __init__(self):
+        self.lock = Lock()
+        self.free = []
+
+    def acquire(self):
+        with self.lock:
+            if self.free:
+                return self.free.pop()
+        return bytearray(RECV_SIZE)
+
+    def release(self, buf):
+        if len(buf) != RECV_SIZE:
+            return  # RECV_SIZE changed since this buffer was made
+        with self.lock:
+            self.free.append(buf)
+
+
+buffer_pool = BufferPool()
+
+
+def new_block_hash(algorithm):
+    """A hasher for manifest blocks, matching server.new_block_hash."""
+    if algorithm == 'blake2b':
+        return hashlib.blake2b(digest_size=16)
+    return hashlib.new(algorithm)
+
+
+def block_runs(blocks):
+    """Group sorted block indices into (first, last) runs of consecutive blocks."""
+    for _, run in itertools.groupby(enumerate(blocks), lambda pair: pair[1] - pair[0]):
+        run = [block for _, block in run]
+        yield run[0], run[-1]
+
+
+class BlockVerifier:
+    """Checks a segment's decoded bytes against its manifest block hashes as they arrive.
+
+    `first_block` lets a range fetch start partway into the segment. Blocks
+    that do not match are collected in `bad_blocks` so only they are fetched again.
+    """
+
+    def __init__(self, digests, block_size, algorithm, first_block=0):
+        self.digests = digests
+        self.block_size = block_size
+        self.algorithm = algorithm
+        self.index = first_block
+        self.current = new_block_hash(algorithm)
+        self.filled = 0
+        self.bad_blocks = []
+
+    def update(self, data):
+        view = memoryview(data)
+        while view:
+            n = min(len(view), self.block_size - self.filled)
+            self.current.update(view[:n])
+            self.filled += n
+            view = view[n:]
+            if self.filled == self.block_size:
+                self.check()
+
+    def check(self):
+        if self.index >= len(self.digests) or self.current.hexdigest() != self.digests[self.index]:
+            self.bad_blocks.append(self.index)
+        self.index += 1
+        self.current = new_block_hash(self.algorithm)
+        self.filled = 0
+
+    def finish(self):
+        if self.filled:
+            self.check()
+
+
+def tree_checksum(content_checksums):
+    """Root hash of a file: the MD5 of its segments' content digests, in order."""
+    return hashlib.md5(b"".join(bytes.fromhex(c) for c in content_checksums)).hexdigest()
+
+
+_seek_lock = Lock()
+
+
+def write_at(fd, data, offset):
+    """Write all of `data` to `fd` at `offset`, safely from many threads."""
+    view = memoryview(data)
+    while view:
+        if hasattr(os, 'pwrite'):
+            n = os.pwrite(fd, view, offset)
+        else:
+            # No positional writes (Windows): serialise seek + write instead
+            with _seek_lock:
+                os.lseek(fd, offset, os.SEEK_SET)
+                n = os.write(fd, view)
+        view = view[n:]
+        offset += n
+
+
+def read_at(fd, size, offset):
+    if hasattr(os, 'pread'):
+        return os.pread(fd, size, offset)
+    with _seek_lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, size)
+
+
+class SegmentSink:
+    """Takes a segment's bytes as they come off the socket.
+
+    Each chunk is hashed as received, decoded from its transfer encoding if
+    needed, checked block by block when a BlockVerifier is given, and written
+    straight into the output file at the segment's offset.
+
+    At most `limit` decoded bytes are kept. A straggling fetch can have the
+    back half of its unwritten bytes split off to another replica, after
+    which it is `satisfied` as soon as it reaches the lowered limit.
+    """
+
+    def __init__(self, fd, offset, encoding=protocol.IDENTITY, on_progress=None, blocks=None,
+                 limit=None):
+        self.fd = fd
+        self.offset = offset
+        self.hash = hashlib.md5()
+        self.decoder = None if encoding == protocol.IDENTITY else protocol.decoder(encoding)
+        # Digest of the decoded segment; the wire hash already is one when unencoded
+        self.content_hash = self.hash if self.decoder is None else hashlib.md5()
+        self.on_progress = on_progress
+        self.blocks = blocks
+        self.limit = limit
+        self.cut_short = False
+        self.lock = Lock()
+        self.written = 0
+        self.resumed = 0
+
+    def resume(self, length):
+        """Carry on after the first `length` bytes, which are already in the output file.
+
+        They are read back from disk to bring the hash up to date, so the
+        finished segment is still checked against its full checksum.
+        """
+        while self.written < length:
+            chunk = read_at(self.fd, min(RECV_SIZE, length - self.written),
+                            self.offset + self.written)
+            if not chunk:
+                raise IOError("Output file is shorter than its progress journal")
+            self.hash.update(chunk)
+            if self.blocks is not None:
+                self.blocks.update(chunk)
+            self.written += len(chunk)
+        self.resumed = length
+
+    def write(self, chunk):
+        self.hash.update(chunk)
+        if self.decoder is not None:
+            chunk = self.decoder.decompress(chunk)
+            self.content_hash.update(chunk)
+        self.put(chunk)
+
+    def put(self, chunk):
+        """Write decoded bytes at the current position, dropping any beyond the limit."""
+        with self.lock:
+            position = self.written
+            if self.limit is not None:
+                chunk = memoryview(chunk)[:max(0, self.limit - position)]
+            self.written += len(chunk)
+        if not chunk:
+            return
+        if self.blocks is not None:
+            self.blocks.update(chunk)
+        write_at(self.fd, chunk, self.offset + position)
+        if self.on_progress is not None:
+            self.on_progress(position + len(chunk))
+
+    def finish(self):
+        if self.decoder is not None and hasattr(self.decoder, 'flush'):
+            chunk = self.decoder.flush()
+            self.content_hash.update(chunk)
+            self.put(chunk)
+        if self.blocks is not None:
+            self.blocks.finish()
+
+    def remaining(self):
+        with self.lock:
+            return 0 if self.limit is None else max(0, self.limit - self.written)
+
+    def satisfied(self):
+        """True once a fetch that was split has written everything it still owns."""
+        with self.lock:
+            return self.cut_short and self.written >= self.limit
+
+    def split(self, block_size, min_bytes=STRAGGLER_MIN_BYTES):
+        """Give up the back half of the unwritten bytes; return their (start, end), or None.
+
+        The range is relative to this sink's offset and starts on a block
+        boundary, so both halves can still be verified block by block.
+        """
+        with self.lock:
+            if self.limit is None or self.limit - self.written < min_bytes:
+                return None
+            middle = self.written + (self.limit - self.written) // 2
+            middle += -middle % block_size
+            if middle >= self.limit:
+                return None
+            cut = (middle, self.limit)
+            self.limit = middle
+            self.cut_short = True
+        return cut
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+    def content_hexdigest(self):
+        return self.content_hash.hexdigest()
+
+
+class PendingRequest:
+    def __init__(self, open_sink):
+        self.done = Event()
+        self.lock = Lock()  # held by the reader around every use of the sink
+        self.open_sink = open_sink
+        self.abandoned = False  # the requester timed out; its sink must not be touched
+        self.last_progress = None  # when it was sent, or its reply last arrived in part
+        self.meta = None
+        self.sink = None
+        self.error = None
+
+
+class MuxConnection:
+    """A persistent connection carrying many tagged GET_SEGMENT requests at once."""
+
+    def __init__(self, host, port):
+        self.sock = socket.create_connection((host, port), timeout=REQUEST_TIMEOUT)
+        try:
+            self.sock.sendall(protocol.pack_hello())
+            version = protocol.unpack_hello(protocol.recv_exact(self.sock, protocol.HELLO.size))
+        except (ConnectionError, protocol.ProtocolError, socket.timeout):
+            self.sock.close()
+            raise protocol.ProtocolError(f"{host}:{port} does not support the multiplexed protocol")
+        if version != protocol.PROTOCOL_VERSION:
+            self.sock.close()
+            raise protocol.ProtocolError(f"{host}:{port} speaks protocol version {version}")
+        self.sock.settimeout(None)
+        self.send_lock = Lock()
+        self.pending_lock = Lock()
+        self.pending = {}
+        self.request_ids = itertools.count(1)
+        self.closed = False
+        reader = Thread(target=self.read_replies, daemon=True)
+        reader.start()
+
+    def in_flight(self):
+        return len(self.pending)
+
+    def request(self, meta, open_sink):
+        """Send a request and wait for its reply; return (meta, sink).
+
+        `open_sink(reply_meta)` is called on the reader thread when the reply
+        arrives and returns the SegmentSink that receives the body.
+
+        The request times out once nothing of its own reply has arrived for
+        REQUEST_TIMEOUT, so a large reply on a slow link keeps it alive for as
+        long as it makes progress, while replies to other requests on the
+        connection do not keep a request that was never answered waiting.
+        A request that times out is abandoned: the reader drains the rest of
+        its reply without touching its sink, which the caller may close as
+        soon as this raises.
+        """
+        pending = PendingRequest(open_sink)
+        with self.pending_lock:
+            if self.closed:
+                raise ConnectionError("Connection closed")
+            request_id = next(self.request_ids)
+            self.pending[request_id] = pending
+        try:
+            with self.send_lock:
+                protocol.send_frame(self.sock, protocol.REQUEST, request_id, meta)
+            pending.last_progress = time.monotonic()
+            while not pending.done.is_set():
+                idle = time.monotonic() - pending.last_progress
+                if idle >= REQUEST_TIMEOUT and self.abandon(pending):
+                    raise TimeoutError(f"No reply to request {request_id} for {REQUEST_TIMEOUT}s")
+                pending.done.wait(max(0, REQUEST_TIMEOUT - idle))
+        finally:
+            with self.pending_lock:
+                self.pending.pop(request_id, None)
+        if pending.error:
+            raise pending.error
+        return pending.meta, pending.sink
+
+    def abandon(self, pending):
+        """Detach a timed-out request from the reader; False if its reply was delivered first."""
+        with pending.lock:
+            if pending.done.is_set():
+                return False
+            pending.abandoned = True
+            return True
+
+    def read_replies(self):
+        buf = buffer_pool.acquire()
+        view = memoryview(buf)
+        try:
+            while True:
+                _, request_id, meta, body_length = protocol.recv_frame_header(self.sock)
+                with self.pending_lock:
+                    pending = self.pending.get(request_id)
+                sink = None
+                if pending is not None:
+                    pending.last_progress = time.monotonic()
+                if pending is not None and 'error' not in meta:
+                    with pending.lock:
+                        if not pending.abandoned:
+                            try:
+                                sink = pending.open_sink(meta)
+                            except Exception as e:
+                                pending.error = e
+                # The body is always read in full to keep the stream in step,
+                # even if nobody is waiting for it any more
+                for chunk in protocol.recv_chunks(self.sock, view, body_length):
+                    if sink is None:
+                        continue
+                    pending.last_progress = time.monotonic()
+                    with pending.lock:
+                        if pending.abandoned:
+                            pending = sink = None
+                            continue
+                        try:
+                            sink.write(chunk)
+                        except Exception as e:
+                            pending.error = e
+                            sink = None
+                    if sink is not None and sink.satisfied():
+                        # The rest was split off to another replica: hand over
+                        # what this fetch owns and drop the remaining body
+                        self.deliver(pending, meta, sink)
+                        pending = sink = None
+                if pending is None:
+                    continue  # the requester already gave up or was answered
+                self.deliver(pending, meta, sink)
+        except Exception as e:
+            self.fail(e)
+        finally:
+            view.release()
+            buffer_pool.release(buf)
+
+    def deliver(self, pending, meta, sink):
+        with pending.lock:
+            if pending.abandoned:
+                return
+            if sink is not None:
+                try:
+                    sink.finish()
+                except Exception as e:
+                    pending.error = e
+            pending.meta, pending.sink = meta, sink
+            pending.done.set()
+
+    def fail(self, error):
+        with self.pending_lock:
+            self.closed = True
+            waiting = list(self.pending.values())
+        for pending in waiting:
+            pending.error = ConnectionError(f"Connection lost: {error}")
+            pending.done.set()
+        self.close()
+
+    def close(self):
+        self.closed = True
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+class ConnectionPool:
+    """Persistent multiplexed connections to one minor server.
+
+    `multiplexed` turns False if the server only speaks the text protocol, in
+    which case callers fall back to one connection per segment.
+    """
+
+    def __init__(self, host, port, size=CONNECTIONS_PER_SERVER):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.lock = Lock()
+        self.connections = []
+        self.multiplexed = True
+
+    def get_connection(self):
+        with self.lock:
+            self.connections = [c for c in self.connections if not c.closed]
+            if len(self.connections) < self.size:
+                try:
+                    connection = MuxConnection(self.host, self.port)
+                except protocol.ProtocolError as e:
+                    logging.info(f"Falling back to text protocol: {e}")
+                    self.multiplexed = False
+                    return None
+                self.connections.append(connection)
+                return connection
+            return min(self.connections, key=lambda c: c.in_flight())
+
+    def close(self):
+        with self.lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections = []
+
+
+_pools = {}
+_pools_lock = Lock()
+
+
+def server_key(server):
+    return (server['host'], server['port'])
+
+
+def record_fetch(key, kind, size, elapsed):
+    """Meter one fetch from server `key`; `size` is None if it failed."""
+    server = f"{key[0]}:{key[1]}"
+    if size is None:
+        FETCHES.inc(server=server, kind=kind, result='failed')
+        return
+    FETCHES.inc(server=server, kind=kind, result='ok')
+    SEGMENT_BYTES.inc(size, server=server)
+    SEGMENT_SECONDS.observe(elapsed, server=server)
+    if elapsed > 0:
+        SEGMENT_THROUGHPUT.observe(size / elapsed, server=server)
+
+
+def replica_servers(segment):
+    """Servers holding a segment, preferred first."""
+    return segment.get('replicas') or [segment['server']]
+
+
+def get_pool(server):
+    key = server_key(server)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ConnectionPool(*key)
+        return _pools[key]
+
+
+class ServerWindow:
+    """AIMD window bounding the fetches in flight to one minor server.
+
+    The window grows by about one fetch per round of completions while the
+    server's estimated throughput keeps up with its best so far, and halves
+    on every failed fetch.
+    """
+
+    def __init__(self, limit=INITIAL_SERVER_CONCURRENCY, max_limit=MAX_SERVER_CONCURRENCY):
+        self.limit = float(limit)
+        self.max_limit = max_limit
+        self.in_flight = 0
+        self.throughput = 0.0
+        self.best_throughput = 0.0
+        self.failures = 0  # consecutive failed fetches
+
+    def has_room(self):
+        return self.in_flight < int(self.limit)
+
+    def on_success(self, size, elapsed):
+        self.failures = 0
+        # One fetch's rate times the fetches sharing the server estimates the
+        # server's total throughput at the current window.
+        sample = size / max(elapsed, 1e-6) * self.in_flight
+        if self.throughput:
+            self.throughput += THROUGHPUT_SMOOTHING * (sample - self.throughput)
+        else:
+            self.throughput = sample
+        if self.throughput >= self.best_throughput * THROUGHPUT_TOLERANCE:
+            self.best_throughput = max(self.best_throughput, self.throughput)
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+
+    def on_failure(self):
+        self.failures += 1
+        self.limit = max(1.0, self.limit / 2)
+        self.best_throughput = self.throughput
+
+
+class BandwidthBudget:
+    """Paces the fetches started through it to `rate` bytes per second.
+
+    A fetch is charged its whole size when it starts, and the next one may
+    start once that many bytes would have been sent at `rate`.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.next_start = 0.0
+
+    def take(self, size):
+        self.next_start = max(time.monotonic(), self.next_start) + size / self.rate
+
+
+class RangeFetch:
+    """A range of a straggling segment, split off to be fetched from another replica.
+
+    `start` and `end` are relative to the segment. `sink` is set once the
+    replica starts answering; its limit may be lowered again by a later split.
+    """
+
+    def __init__(self, downloader, fetch, server, start, end):
+        self.downloader = downloader
+        self.fetch = fetch
+        self.server = server
+        self.start = start
+        self.end = end
+        self.sink = None
+        self.done = False
+
+
+class SegmentFetch:
+    """The pieces one segment is being received in: its own fetch plus any split-off ranges."""
+
+    def __init__(self, segment):
+        self.segment = segment
+        self.condition = Condition()
+        self.pieces = []  # (server, sink) of every fetch writing part of the segment
+        self.ranges = []
+
+    def add_piece(self, server, sink):
+        with self.condition:
+            self.pieces.append((server, sink))
+
+    def add_range(self, job):
+        with self.condition:
+            self.ranges.append(job)
+
+    def range_done(self, job):
+        with self.condition:
+            job.done = True
+            self.condition.notify_all()
+
+    def wait_for_ranges(self):
+        with self.condition:
+            while not all(job.done for job in self.ranges):
+                self.condition.wait()
+            return list(self.ranges)
+
+
+class QueuedSegment:
+    def __init__(self, segment, downloader):
+        self.segment = segment
+        self.downloader = downloader
+        self.server = segment['server']  # replica the next attempt goes to
+        self.size = segment['end'] - segment['start']
+        self.attempts = 0
+        self.ready_at = 0.0
+
+    def job(self):
+        """The segment as fetched this attempt, pointed at the chosen replica."""
+        if server_key(self.server) == server_key(self.segment['server']):
+            return self.segment
+        return dict(self.segment, server=self.server)
+
+
+class SegmentScheduler:
+    """Runs a download's segments on a bounded pool of worker threads.
+
+    Each minor server has its own ServerWindow. Workers are not tied to a
+    server: a free worker takes the next segment from whichever server has
+    room in its window and the most bytes still to fetch, so idle workers
+    drift to the servers that are behind. Segments with several replicas
+    also move between servers: a failed attempt is retried on the next
+    replica, and a replica with room and nothing of its own left to start
+    takes queued segments it also holds from the server furthest behind.
+
+    Once every segment has been started, idle workers help the stragglers
+    instead: the in-flight fetch with the most bytes left is split, and its
+    back half is fetched from a faster replica of the segment.
+
+    With MAX_BANDWIDTH or SERVER_BANDWIDTH set, segments are started no
+    faster than the bandwidth budgets, overall and of their server, allow.
+    """
+
+    def __init__(self, downloader, segments, max_workers=MAX_WORKERS,
+                 max_server_concurrency=MAX_SERVER_CONCURRENCY):
+        self.downloader = downloader
+        self.max_workers = max_workers
+        self.max_server_concurrency = max_server_concurrency
+        self.condition = Condition()
+        self.queues = {}
+        self.windows = {}
+        self.budgets = {}
+        self.budget = BandwidthBudget(MAX_BANDWIDTH) if MAX_BANDWIDTH else None
+        self.remaining = {}
+        self.pending = 0
+        self.add(downloader, segments)
+
+    def add(self, downloader, segments):
+        for segment in segments:
+            key = server_key(segment['server'])
+            entry = QueuedSegment(segment, downloader)
+            self.queues.setdefault(key, deque()).append(entry)
+            self.remaining[key] = self.remaining.get(key, 0) + entry.size
+            self.pending += 1
+            for replica in replica_servers(segment):
+                self.window(server_key(replica))
+                self.queues.setdefault(server_key(replica), deque())
+                self.remaining.setdefault(server_key(replica), 0)
+
+    def window(self, key):
+        if key not in self.windows:
+            self.windows[key] = ServerWindow(max_limit=self.max_server_concurrency)
+            if SERVER_BANDWIDTH:
+                self.budgets[key] = BandwidthBudget(SERVER_BANDWIDTH)
+        return self.windows[key]
+
+    def ready_at(self, key, now):
+        """When the bandwidth budgets let the next fetch from server `key` start."""
+        ready = now
+        if self.budget is not None:
+            ready = max(ready, self.budget.next_start)
+        if key in self.budgets:
+            ready = max(ready, self.budgets[key].next_start)
+        return ready
+
+    def start(self, key, size):
+        self.windows[key].in_flight += 1
+        if self.budget is not None:
+            self.budget.take(size)
+        if key in self.budgets:
+            self.budgets[key].take(size)
+
+    def cancelled(self):
+        return self.downloader.cancelled.is_set()
+
+    def take(self, key, now):
+        """Remove and return the entry to start next from server `key`'s queue."""
+        return self.queues[key].popleft()
+
+    def claim(self, entry):
+        """Called under the condition when a queued entry, taken or stolen, is handed to a worker."""
+
+    def split_straggler(self):
+        return self.downloader.split_straggler(self.pick_replica)
+
+    def attempt_done(self, entry, finished):
+        """Called under the condition after every attempt; `finished` once the entry is no longer pending."""
+
+    def pick_replica(self, server, replicas):
+        """The replica with room and the best throughput, if it is faster than `server`."""
+        best = None
+        best_throughput = self.window(server_key(server)).throughput
+        now = time.monotonic()
+        for replica in replicas:
+            key = server_key(replica)
+            window = self.window(key)
+            if window.has_room() and window.throughput > best_throughput and self.ready_at(key, now) <= now:
+                best, best_throughput = replica, window.throughput
+        return best
+
+    def next_segment(self):
+        """Block until there is work; return (key, entry), or None when done.
+
+        `entry` is a QueuedSegment, or a RangeFetch split off a straggler.
+        """
+        with self.condition:
+            while self.pending and not self.cancelled():
+                now = time.monotonic()
+                best = None
+                wake_at = None
+                for key, queue in self.queues.items():
+                    if not queue or not self.windows[key].has_room():
+                        continue
+                    # Retries are appended with later ready times, so only the head matters
+                    ready = max(queue[0].ready_at, self.ready_at(key, now))
+                    if ready > now:
+                        wake_at = min(wake_at or ready, ready)
+                        continue
+                    if best is None or self.remaining[key] > self.remaining[best]:
+                        best = key
+                if best is not None:
+                    entry = self.take(best, now)
+                    self.claim(entry)
+                    self.start(best, entry.size)
+                    return best, entry
+                stolen = self.steal(now)
+                if stolen is not None:
+                    self.claim(stolen[1])
+                    self.start(stolen[0], stolen[1].size)
+                    return stolen
+                if not any(self.queues.values()):
+                    job = self.split_straggler()
+                    if job is not None:
+                        key = server_key(job.server)
+                        self.start(key, job.end - job.start)
+                        return key, job
+                    # Fetches make progress without notifying, so look again soon
+                    wake_at = now + STRAGGLER_POLL
+                self.condition.wait(None if wake_at is None else wake_at - now)
+            return None
+
+    def steal(self, now):
+        """Hand a queued segment to an idle replica server; return (key, entry), or None."""
+        # A server that just failed would only take work to fail it again
+        idle = {key for key, queue in self.queues.items()
+                if not queue and self.windows[key].has_room() and not self.windows[key].failures
+                and self.ready_at(key, now) <= now}
+        if not idle:
+            return None
+        for other in sorted(self.queues, key=self.remaining.get, reverse=True):
+            queue = self.queues[other]
+            # Take from the back: the owner will get to the front itself soonest
+            for entry in reversed(queue):
+                if entry.ready_at > now:
+                    continue
+                for replica in replica_servers(entry.segment):
+                    key = server_key(replica)
+                    if key in idle:
+                        queue.remove(entry)
+                        self.move(entry, other, replica)
+                        return key, entry
+        return None
+
+    def move(self, entry, key, replica):
+        self.remaining[key] -= entry.size
+        self.remaining[server_key(replica)] += entry.size
+        entry.server = replica
+
+    def fail_over(self, key, entry):
+        """Point a failed segment at its next replica; return that server's key."""
+        replicas = replica_servers(entry.segment)
+        keys = [server_key(r) for r in replicas]
+        if len(replicas) < 2 or key not in keys:
+            entry.ready_at = time.monotonic() + RETRY_DELAY
+            return key
+        replica = replicas[(keys.index(key) + 1) % len(replicas)]
+        self.move(entry, key, replica)
+        return server_key(replica)
+
+    def finish(self, key, entry, size, elapsed):
+        """Record the outcome of one attempt; `size` is None if it failed."""
+        record_fetch(key, 'segment', size, elapsed)
+        with self.condition:
+            window = self.windows[key]
+            if size is not None:
+                window.on_success(size, elapsed)
+                window.in_flight -= 1
+                self.remaining[key] -= entry.size
+                self.pending -= 1
+                self.attempt_done(entry, True)
+            else:
+                window.on_failure()
+                window.in_flight -= 1
+                entry.attempts += 1
+                if entry.attempts >= MAX_RETRIES:
+                    logging.error(f"Failed to download segment {entry.segment['id']} after {MAX_RETRIES} retries")
+                    ABANDONED.inc()
+                    self.remaining[key] -= entry.size
+                    self.pending -= 1
+                    self.attempt_done(entry, True)
+                else:
+                    RETRIES.inc()
+                    self.queues[self.fail_over(key, entry)].append(entry)
+                    self.attempt_done(entry, False)
+            self.condition.notify_all()
+
+    def finish_range(self, key, size, elapsed):
+        record_fetch(key, 'range', size, elapsed)
+        with self.condition:
+            window = self.windows[key]
+            if size is not None:
+                window.on_success(size, elapsed)
+            else:
+                window.on_failure()
+            window.in_flight -= 1
+            self.condition.notify_all()
+
+    def worker(self):
+        while True:
+            job = self.next_segment()
+            if job is None:
+                return
+            key, entry = job
+            if isinstance(entry, RangeFetch):
+                self.run_range(key, entry)
+                continue
+            segment = entry.job()
+            started = time.monotonic()
+            try:
+                size = entry.downloader.try_download_segment(segment)
+            except Exception as e:
+                logging.error(f"Error downloading segment {segment['id']} (attempt {entry.attempts + 1}): {e}")
+                size = None
+            self.finish(key, entry, size, time.monotonic() - started)
+
+    def run_range(self, key, job):
+        started = time.monotonic()
+        try:
+            size = job.downloader.fetch_range(job)
+        except Exception as e:
+            logging.error(f"Error fetching part of segment {job.fetch.segment['id']}: {e}")
+            size = None
+        self.finish_range(key, size, time.monotonic() - started)
+
+    def run(self):
+        threads = [
+            Thread(target=self.worker, daemon=True)
+            for _ in range(min(self.max_workers, self.pending))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+
+
+class BatchScheduler(SegmentScheduler):
+    """Runs the segments of many downloads on one shared pool of worker threads.
+
+    Every file shares the worker pool, the server windows and the bandwidth
+    budgets, so a whole catalogue keeps the minor servers busy without any
+    of them getting more fetches than its window. Files are queued by
+    priority, then by the bytes they have left, so small files finish first.
+    Within a server's queue a free worker takes the first ready segment of a
+    file holding less than MAX_FILE_SHARE of the workers, and only falls
+    back to a file over its share when nothing else is waiting.
+
+    A file's output is opened when its first segment starts and finished
+    (verified, its journal removed) as soon as its last one is done, so only
+    the files being fetched hold open descriptors.
+    """
+
+    def __init__(self, downloaders, max_workers=MAX_WORKERS,
+                 max_server_concurrency=MAX_SERVER_CONCURRENCY, priorities=None, on_file_done=None):
+        super().__init__(None, [], max_workers, max_server_concurrency)
+        self.stopped = Event()
+        self.on_file_done = on_file_done
+        self.file_share = max(1, int(max_workers * MAX_FILE_SHARE))
+        self.file_pending = {}
+        self.file_in_flight = {}
+        self.completed = deque()  # downloaders whose last segment is done, still to be finished
+        self.finish_lock = Lock()  # finishing saves the shared chunk index
+        priorities = priorities or {}
+        self.downloaders = sorted(downloaders, key=lambda d: (
+            -priorities.get(d.filename, 0), d.file_size - d.resumed_bytes()))
+        for downloader in self.downloaders:
+            downloader.scheduler = self
+            missing = [s for s in downloader.segments if s['id'] not in downloader.downloaded_segments]
+            if missing and downloader.chunk_index is not None:
+                downloader.open_output()
+                try:
+                    missing = downloader.reuse_local_chunks(missing)
+                finally:
+                    downloader.close_output()
+            self.file_pending[downloader] = len(missing)
+            self.file_in_flight[downloader] = 0
+            if not missing:
+                self.completed.append(downloader)
+            self.add(downloader, missing)
+
+    def cancelled(self):
+        return self.stopped.is_set()
+
+    def cancel(self):
+        """Start no more segments of any file; each file's journal keeps what was fetched."""
+        self.stopped.set()
+        with self.condition:
+            self.condition.notify_all()
+
+    def take(self, key, now):
+        queue = self.queues[key]
+        fallback = None
+        for entry in queue:
+            if entry.ready_at > now:
+                continue
+            if self.file_in_flight[entry.downloader] < self.file_share:
+                break
+            if fallback is None:
+                fallback = entry
+        else:
+            entry = fallback
+        queue.remove(entry)
+        return entry
+
+    def claim(self, entry):
+        downloader = entry.downloader
+        self.file_in_flight[downloader] += 1
+        if downloader.output_fd is None:
+            downloader.open_output()
+
+    def split_straggler(self):
+        # The most urgent files first, so their stragglers are helped first
+        for downloader in self.downloaders:
+            if self.file_in_flight[downloader]:
+                job = downloader.split_straggler(self.pick_replica)
+                if job is not None:
+                    return job
+        return None
+
+    def attempt_done(self, entry, finished):
+        downloader = entry.downloader
+        self.file_in_flight[downloader] -= 1
+        if finished:
+            self.file_pending[downloader] -= 1
+            if not self.file_pending[downloader]:
+                self.completed.append(downloader)
+
+    def finish(self, key, entry, size, elapsed):
+        super().finish(key, entry, size, elapsed)
+        self.finish_files()
+
+    def finish_files(self):
+        while True:
+            with self.condition:
+                if not self.completed:
+                    return
+                downloader = self.completed.popleft()
+                del self.file_pending[downloader]
+            self.finish_file(downloader)
+
+    def finish_file(self, downloader):
+        downloader.close_output()
+        downloader.pbar.close()
+        with self.finish_lock:
+            verified = downloader.finish_download()
+        if self.on_file_done is not None:
+            self.on_file_done(downloader, verified)
+
+    def run(self):
+        self.finish_files()
+        super().run()
+        self.finish_files()
+        # Files cut short by cancel() keep their journals and are reported incomplete
+        for downloader in self.downloaders:
+            if self.file_pending.pop(downloader, None) is not None:
+                self.finish_file(downloader)
+
+
+class ProgressJournal:
+    """Append-only record of one download's progress, kept next to its output file.
+
+    Every update appends one fixed-size record, so recording progress costs
+    the same however far the download has got. Replaying the records gives the
+    verified segments with their content digests, and how many leading bytes
+    of each unfinished segment have been written. A record torn by a crash is ignored, and the journal is
+    discarded if it belongs to another version of the file.
+    """
+
+    MAGIC = b"FDJ2"
+    HEADER = struct.Struct("!4sQ32s")  # magic, file size, file checksum
+    RECORD = struct.Struct("!BIQ16s")  # kind, segment id, bytes written, content digest
+    PROGRESS = 1
+    DONE = 2
+
+    def __init__(self, path, file_size, checksum):
+        self.path = path
+        self.header = self.HEADER.pack(self.MAGIC, file_size, checksum.encode())
+        self.fd = None
+
+    def load(self):
+        """Return ({verified segment id: digest}, {segment id: bytes written}) from disk."""
+        done, partial = {}, {}
+        if not os.path.exists(self.path):
+            return done, partial
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        if not data.startswith(self.header):
+            logging.info(f"Ignoring progress journal {self.path} for another version of the file")
+            return done, partial
+        end = len(data) - (len(data) - self.HEADER.size) % self.RECORD.size
+        for kind, segment_id, written, digest in self.RECORD.iter_unpack(data[self.HEADER.size:end]):
+            if kind == self.DONE:
+                done[segment_id] = digest.hex()
+                partial.pop(segment_id, None)
+            elif segment_id not in done:
+                partial[segment_id] = written
+        return done, partial
+
+    def open(self):
+        """Open the journal for appending, starting a new one if it is missing or stale."""
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND | getattr(os, 'O_BINARY', 0)
+        self.fd = os.open(self.path, flags, 0o644)
+        size = os.fstat(self.fd).st_size
+        with open(self.path, 'rb') as f:
+            valid = f.read(self.HEADER.size) == self.header
+        if not valid:
+            os.ftruncate(self.fd, 0)
+            os.write(self.fd, self.header)
+        elif (size - self.HEADER.size) % self.RECORD.size:
+            # Drop a record torn by a crash so new records stay aligned
+            os.ftruncate(self.fd, size - (size - self.HEADER.size) % self.RECORD.size)
+
+    def append(self, kind, segment_id, written=0, digest=bytes(16)):
+        # One small O_APPEND write per record: no lock, no rewrite
+        os.write(self.fd, self.RECORD.pack(kind, segment_id, written, digest))
+
+    def record_progress(self, segment_id, written):
+        self.append(self.PROGRESS, segment_id, written)
+
+    def record_done(self, segment_id, digest):
+        self.append(self.DONE, segment_id, digest=bytes.fromhex(digest))
+
+    def close(self):
+        if self.fd is not None:
+            os.fsync(self.fd)
+            os.close(self.fd)
+            self.fd = None
+
+    def remove(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class ChunkIndex:
+    """Where the chunks of earlier downloads sit on local disk, keyed by content hash.
+
+    Files the server cut into content-defined chunks share chunks with other
+    files and with their own earlier versions. Each finished download
+    records its chunks as (path, offset, length), and later downloads copy
+    the chunks they find here instead of fetching them. A copy is only used
+    if it still matches the segment's content checksum, since the file it
+    came from may have changed since.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or CHUNK_INDEX_FILE
+        self.chunks = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    self.chunks = json.load(f)
+            except ValueError:
+                logging.warning(f"Ignoring unreadable chunk index {self.path}")
+
+    def read(self, segment):
+        """Content of a segment's chunk from a local file, or None if no good copy is at hand."""
+        entry = self.chunks.get(segment.get('chunk'))
+        if entry is None or 'content_checksum' not in segment:
+            return None
+        path, offset, length = entry
+        if length != segment['end'] - segment['start']:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                f.seek(offset)
+                data = f.read(length)
+        except OSError:
+            return None
+        if hashlib.md5(data).hexdigest() != segment['content_checksum']:
+            return None
+        return data
+
+    def add(self, path, segments):
+        path = os.path.abspath(path)
+        for segment in segments:
+            if 'chunk' in segment:
+                self.chunks[segment['chunk']] = [path, segment['start'], segment['end'] - segment['start']]
+
+    def save(self):
+        # Forget chunks of files that have since been removed
+        self.chunks = {k: v for k, v in self.chunks.items() if os.path.exists(v[0])}
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.chunks, f)
+        os.replace(tmp_path, self.path)
+
+
+class ProgressCounter:
+    """Stands in for the tqdm bar of an embedded download, passing each change to `on_update(done, total)`."""
+
+    def __init__(self, total, initial, on_update):
+        self.total = total
+        self.n = initial
+        self.on_update = on_update
+
+    def update(self, n):
+        self.n += n
+        self.on_update(self.n, self.total)
+
+    def close(self):
+        pass
+
 
 class FileDownloader:
-    def __init__(self, filename, output_file, main_server_host, main_server_port):
+    def __init__(self, filename, output_file, main_server_host, main_server_port,
+                 file_info=None, max_workers=MAX_WORKERS,
+                 max_server_concurrency=MAX_SERVER_CONCURRENCY, on_progress=None):
         self.filename = filename
         self.output_file = output_file
         self.main_server_host = main_server_host
         self.main_server_port = main_server_port
+        self.max_workers = max_workers
+        self.max_server_concurrency = max_server_concurrency
         self.lock = Lock()
-        self.file_info = self.get_file_info()
+        self.file_info = file_info if file_info is not None else self.get_file_info()
         if "error" in self.file_info:
             raise ValueError(f"Error: {self.file_info['error']}")
         self.total_segments = self.file_info['total_segments']
@@ -35,157 +1157,794 @@ class FileDownloader:
         self.segments = self.file_info['segments']
         self.is_compressed = self.file_info['is_compressed']
         self.checksum = self.file_info['checksum']
+        self.version = self.file_info.get('version', self.checksum)
+        self.manifest = self.file_info.get('manifest')
+        self.journal = ProgressJournal(output_file + PROGRESS_SUFFIX, self.file_size, self.checksum)
         self.downloaded_segments = set()
+        self.segment_digests = {}  # segment id -> MD5 of its content, for tree verification
+        self.partial_segments = {}  # segment id -> leading bytes already in the output
+        self.counted_bytes = {}  # segment id -> partial bytes already shown in the progress bar
+        self.fetches = {}  # segment id -> SegmentFetch of segments being received
+        self.chunk_index = ChunkIndex() if any('chunk' in s for s in self.segments) else None
+        self.cancelled = Event()
+        self.scheduler = None
         self.load_resume_data()
-        self.pbar = tqdm(total=self.file_size, unit='B', unit_scale=True, desc=self.filename)
-        self.ensure_segment_dir()
-
-    def ensure_segment_dir(self):
-        if not os.path.exists(SEGMENT_DIR):
-            os.makedirs(SEGMENT_DIR)
+        if on_progress is None:
+            self.pbar = tqdm(total=self.file_size, unit='B', unit_scale=True, desc=self.filename,
+                             initial=self.resumed_bytes())
+        else:
+            self.pbar = ProgressCounter(self.file_size, self.resumed_bytes(), on_progress)
+        self.output_fd = None
 
     def get_file_info(self):
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((self.main_server_host, self.main_server_port))
-            request = {"type": "get_file_info", "filename": self.filename}
-            s.sendall(json.dumps(request).encode())
-            
-            chunks = []
+        request = {"type": "get_file_info", "filename": self.filename}
+        with MainServerConnection(self.main_server_host, self.main_server_port) as main_server:
+            # A file another client asked for first may still be being segmented
             while True:
-                chunk = s.recv(4096)
-                if not chunk:
-                    break
-                chunks.append(chunk)
-            
-            response_data = b''.join(chunks).decode()
-            return json.loads(response_data)
+                file_info = main_server.request(request)
+                if file_info.get('status') != 'segmenting':
+                    return file_info
+                logging.info(f"{self.filename} is being segmented, asking again in {file_info['retry_after']}s")
+                time.sleep(file_info['retry_after'])
 
     def load_resume_data(self):
-        if os.path.exists(RESUME_FILE):
-            with open(RESUME_FILE, 'rb') as f:
-                resume_data = pickle.load(f)
-                if resume_data.get('filename') == self.filename:
-                    self.downloaded_segments = resume_data['downloaded_segments']
-                    logging.info(f"Resumed download. Already downloaded segments: {self.downloaded_segments}")
-                    self.pbar.update(sum(self.segments[i-1]['end'] - self.segments[i-1]['start'] for i in self.downloaded_segments))
-
-    def save_resume_data(self):
-        with open(RESUME_FILE, 'wb') as f:
-            pickle.dump({'filename': self.filename, 'downloaded_segments': self.downloaded_segments}, f)
+        if not os.path.exists(self.output_file):
+            return  # the journal is meaningless without the data it describes
+        self.segment_digests, self.partial_segments = self.journal.load()
+        for segment_id, digest in self.unchanged_segments().items():
+            if segment_id not in self.partial_segments:  # partly overwritten since
+                self.segment_digests.setdefault(segment_id, digest)
+        self.downloaded_segments = set(self.segment_digests)
+        self.counted_bytes = dict(self.partial_segments)
+        if self.downloaded_segments or self.partial_segments:
+            logging.info(f"Resumed download. Already downloaded segments: {self.downloaded_segments}")
+
+    def unchanged_segments(self):
+        """{segment id: digest} of segments an earlier version of the output already holds.
+
+        A finished download leaves its version and its segments' ranges and
+        content digests next to the output file. When the server's version
+        differs, a segment with the same range and digest is already in
+        place, so only the others are fetched and written over the old copy.
+        """
+        try:
+            with open(self.output_file + VERSION_SUFFIX) as f:
+                local = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if local['version'] == self.version:
+            logging.info(f"{self.output_file} is already at version {self.version}")
+        else:
+            logging.info(f"Updating {self.output_file} from version {local['version']} to {self.version}")
+        size = os.path.getsize(self.output_file)
+        have = {(start, end): digest for start, end, digest in local['segments'] if end <= size}
+        return {
+            s['id']: s['content_checksum'] for s in self.segments
+            if 'content_checksum' in s and have.get((s['start'], s['end'])) == s['content_checksum']
+        }
+
+    def save_version(self):
+        version = {
+            'version': self.version,
+            'segments': [[s['start'], s['end'], self.segment_digests[s['id']]] for s in self.segments],
+        }
+        tmp_path = f"{self.output_file}{VERSION_SUFFIX}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(version, f)
+        os.replace(tmp_path, self.output_file + VERSION_SUFFIX)
+
+    def resumed_bytes(self):
+        done = sum(s['end'] - s['start'] for s in self.segments if s['id'] in self.downloaded_segments)
+        return done + sum(self.partial_segments.values())
 
     def calculate_checksum(self, data):
         return hashlib.md5(data).hexdigest()
 
-    def download_segment(self, segment):
-        segment_id = segment['id']
+    def block_verifier(self, segment, first_block=0):
+        if self.manifest is None or 'blocks' not in segment:
+            return None
+        return BlockVerifier(segment['blocks'], self.manifest['block_size'],
+                             self.manifest['algorithm'], first_block)
+
+    def open_sink(self, segment, meta):
+        encoding = meta.get('encoding', protocol.IDENTITY)
+        on_progress = None
+        if encoding == protocol.IDENTITY:
+            def on_progress(written):
+                self.journal.record_progress(segment['id'], written)
+                self.partial_segments[segment['id']] = written
+        sink = SegmentSink(self.output_fd, segment['start'], encoding, on_progress,
+                           self.block_verifier(segment), segment['end'] - segment['start'])
+        if meta.get('offset'):
+            sink.resume(meta['offset'])
+        with self.lock:
+            fetch = self.fetches.get(segment['id'])
+        if fetch is not None:
+            fetch.add_piece(segment['server'], sink)
+        return sink
+
+    def segment_request(self, segment):
+        """GET_SEGMENT request for a segment, by its chunk's object name if it is a shared chunk."""
+        request = {
+            'op': 'GET_SEGMENT',
+            'filename': self.filename,
+            'segment_id': segment['id'],
+            'is_compressed': self.is_compressed,
+        }
+        if 'object' in segment:
+            request['object'] = segment['object']
+        return request
+
+    def fetch_segment(self, segment):
+        """Fetch a segment into the output file; return (checksum, sink), or None if the server lacks it.
+
+        `checksum` is the server's checksum of the bytes on the wire, and the
+        sink holds the checksum of what was actually received.
+        """
+        pool = get_pool(segment['server'])
+        connection = pool.get_connection() if pool.multiplexed else None
+        if connection is None:
+            return self.fetch_segment_text(segment)
+
+        request = self.segment_request(segment)
+        if WIRE_COMPRESSION:
+            request['accept_encoding'] = protocol.supported_encodings()
+        if self.partial_segments.get(segment['id']):
+            request['offset'] = self.partial_segments[segment['id']]
+        meta, sink = connection.request(request, lambda meta: self.open_sink(segment, meta))
+        if 'error' in meta:
+            return None
+        return meta['checksum'], sink
+
+    def repair_blocks(self, segment, bad_blocks):
+        """Re-fetch only the damaged blocks of a segment; return True once they all verify.
+
+        Each run of consecutive bad blocks is one range request, served
+        unencoded and written back over the damaged bytes in the output file.
+        """
+        pool = get_pool(segment['server'])
+        connection = pool.get_connection() if pool.multiplexed else None
+        if connection is None:
+            return False  # the text protocol cannot fetch ranges
+        block_size = self.manifest['block_size']
+        logging.info(f"Re-fetching {len(bad_blocks)} damaged blocks of segment {segment['id']}")
+        for first, last in block_runs(bad_blocks):
+            offset = first * block_size
+            request = dict(self.segment_request(segment), offset=offset,
+                           length=(last - first + 1) * block_size)
+            meta, sink = connection.request(
+                request,
+                lambda meta, offset=offset, first=first: SegmentSink(
+                    self.output_fd, segment['start'] + offset,
+                    blocks=self.block_verifier(segment, first),
+                ),
+            )
+            if 'error' in meta or meta.get('offset') != offset or sink.blocks.bad_blocks:
+                return False
+        return True
+
+    def split_straggler(self, pick_replica):
+        """Split the in-flight fetch with the most bytes left; return a RangeFetch for its back half.
+
+        Only fetches with a faster replica to hand over to, as chosen by
+        `pick_replica(server, replicas)`, are considered. Returns None if
+        there is nothing worth splitting.
+        """
+        if self.manifest is None:
+            return None  # the halves could only be verified block by block
+        with self.lock:
+            fetches = list(self.fetches.values())
+        best = None
+        for fetch in fetches:
+            if 'blocks' not in fetch.segment:
+                continue
+            with fetch.condition:
+                pieces = list(fetch.pieces)
+            for server, sink in pieces:
+                remaining = sink.remaining()
+                if remaining < STRAGGLER_MIN_BYTES or (best and remaining <= best[0]):
+                    continue
+                others = [r for r in replica_servers(fetch.segment)
+                          if server_key(r) != server_key(server)]
+                replica = pick_replica(server, others)
+                if replica is not None:
+                    best = (remaining, fetch, sink, replica)
+        if best is None:
+            return None
+        _, fetch, sink, replica = best
+        cut = sink.split(self.manifest['block_size'])
+        if cut is None:
+            return None
+        base = sink.offset - fetch.segment['start']
+        job = RangeFetch(self, fetch, replica, base + cut[0], base + cut[1])
+        fetch.add_range(job)
+        logging.info(f"Splitting segment {fetch.segment['id']}: bytes {job.start}-{job.end} "
+                     f"from {replica['host']}:{replica['port']}")
+        return job
+
+    def fetch_range(self, job):
+        """Fetch a range split off a straggler from its replica; return the bytes written, or None."""
+        segment = job.fetch.segment
+        block_size = self.manifest['block_size']
+
+        def open_sink(meta):
+            job.sink = SegmentSink(self.output_fd, segment['start'] + job.start,
+                                   blocks=self.block_verifier(segment, job.start // block_size),
+                                   limit=job.end - job.start)
+            job.fetch.add_piece(job.server, job.sink)
+            return job.sink
+
+        try:
+            pool = get_pool(job.server)
+            connection = pool.get_connection() if pool.multiplexed else None
+            if connection is None:
+                return None  # the text protocol cannot fetch ranges
+            request = dict(self.segment_request(segment), offset=job.start,
+                           length=job.end - job.start)
+            meta, sink = connection.request(request, open_sink)
+            if 'error' in meta or meta.get('offset') != job.start:
+                return None
+            return sink.written
+        finally:
+            job.fetch.range_done(job)
+
+    def finish_split(self, segment, sink, ranges):
+        """Check a segment received in pieces; return True once all of its blocks verify.
+
+        Blocks that failed, or that a piece never got to, are fetched again
+        from the segment's own server.
+        """
+        block_size = self.manifest['block_size']
+        pieces = [(0, sink)] + [(job.start, job.sink) for job in ranges]
+        bad = set()
+        for job in ranges:
+            if job.sink is None:  # the replica never answered
+                bad.update(range(job.start // block_size, -(-job.end // block_size)))
+        for start, piece in pieces:
+            if piece is None:
+                continue
+            bad.update(piece.blocks.bad_blocks)
+            if piece.written < piece.limit:
+                bad.update(range((start + piece.written) // block_size,
+                                 -(-(start + piece.limit) // block_size)))
+        return not bad or self.repair_blocks(segment, sorted(bad))
+
+    def fetch_segment_text(self, segment):
+        if 'object' in segment:
+            raise IOError("Shared chunks cannot be fetched with the text protocol")
         server = segment['server']
-        segment_file = os.path.join(SEGMENT_DIR, f"{self.filename}_segment_{segment_id}")
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.connect((server["host"], server["port"]))
+            s.send(f"GET_SEGMENT {self.filename} {segment['id']} {self.is_compressed}".encode())
+
+            size_and_checksum = protocol.recv_exact(s, 36)
+            size, checksum = struct.unpack("!I32s", size_and_checksum)
+            checksum = checksum.decode()
 
-        if os.path.exists(segment_file):
-            with open(segment_file, 'rb') as f:
-                segment_data = f.read()
-            if self.calculate_checksum(segment_data) == segment['checksum']:
-                logging.info(f"Segment {segment_id} already downloaded and verified")
-                return True
+            if size == 0:
+                return None
 
-        for attempt in range(MAX_RETRIES):
+            sink = self.open_sink(segment, {})
+            buf = buffer_pool.acquire()
             try:
-                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                    s.connect((server["host"], server["port"]))
-                    s.send(f"GET_SEGMENT {self.filename} {segment_id} {self.is_compressed}".encode())
-                    
-                    size_and_checksum = s.recv(36)
-                    size, checksum = struct.unpack("!I32s", size_and_checksum)
-                    checksum = checksum.decode()
-                    
-                    if size == 0:
-                        logging.warning(f"Error downloading segment {segment_id}: Segment not found")
-                        continue
-                    
-                    segment_data = b""
-                    while len(segment_data) < size:
-                        chunk = s.recv(min(4096, size - len(segment_data)))
-                        if not chunk:
+                with memoryview(buf) as view:
+                    for chunk in protocol.recv_chunks(s, view, size):
+                        sink.write(chunk)
+                        if sink.satisfied():
                             break
-                        segment_data += chunk
+            finally:
+                buffer_pool.release(buf)
+            sink.finish()
+        return checksum, sink
 
-                    if self.calculate_checksum(segment_data) != checksum:
-                        logging.warning(f"Checksum mismatch for segment {segment_id}")
-                        continue
+    def open_output(self):
+        """Open the output file once, sized to the whole file, for positional writes."""
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0)
+        self.output_fd = os.open(self.output_file, flags, 0o644)
+        os.ftruncate(self.output_fd, self.file_size)
+        self.journal.open()
 
-                with open(segment_file, 'wb') as f:
-                    f.write(segment_data)
-
-                with self.lock:
-                    self.downloaded_segments.add(segment_id)
-                    self.save_resume_data()
-                    self.pbar.update(len(segment_data))
-                
-                # logging.info(f"Downloaded segment {segment_id}")
-                return True
-            
-            except Exception as e:
-                logging.error(f"Error downloading segment {segment_id} (attempt {attempt + 1}): {e}")
-                time.sleep(1)  # Wait before retrying
-        
-        logging.error(f"Failed to download segment {segment_id} after {MAX_RETRIES} retries")
-        return False
+    def close_output(self):
+        self.journal.close()
+        if self.output_fd is not None:
+            os.close(self.output_fd)
+            self.output_fd = None
 
-    def download(self):
-        threads = []
-        for segment in self.segments:
-            if segment['id'] not in self.downloaded_segments:
-                thread = Thread(target=self.download_segment, args=(segment,))
-                thread.start()
-                threads.append(thread)
+    def record_segment(self, segment_id, size, digest):
+        self.journal.record_done(segment_id, digest)
+        with self.lock:
+            self.segment_digests[segment_id] = digest
+            self.downloaded_segments.add(segment_id)
+            self.pbar.update(size)
 
-        for thread in threads:
-            thread.join()
+    def try_download_segment(self, segment):
+        """Fetch a segment in one attempt; return its size, or None on failure.
+
+        The segment is written to its place in the output file as it arrives
+        and only counted as downloaded once its checksum matches. When the
+        manifest names which blocks are damaged, only those are fetched again;
+        the repaired segment then counts with its published content checksum,
+        since every one of its blocks has been verified. The same goes for a
+        segment that was split across replicas while it straggled.
+        """
+        segment_id = segment['id']
+        fetch = SegmentFetch(segment)
+        with self.lock:
+            self.fetches[segment_id] = fetch
+        try:
+            reply = self.fetch_segment(segment)
+        finally:
+            # Ranges split off to other replicas write into the same bytes
+            ranges = fetch.wait_for_ranges()
+            with self.lock:
+                self.fetches.pop(segment_id, None)
+        if reply is None:
+            logging.warning(f"Error downloading segment {segment_id}: Segment not found")
+            return None
+        checksum, sink = reply
+
+        size = segment['end'] - segment['start']
+        if ranges:
+            if not self.finish_split(segment, sink, ranges):
+                logging.warning(f"Block verification failed for split segment {segment_id}")
+                self.reset_segment(segment_id)
+                return None
+            self.partial_segments.pop(segment_id, None)
+            self.record_segment(segment_id, size - self.counted_bytes.pop(segment_id, 0),
+                                segment['content_checksum'])
+            return size
+
+        content_checksum = segment.get('content_checksum', sink.content_hexdigest())
+        digest = sink.content_hexdigest()
+        if sink.hexdigest() != checksum or digest != content_checksum:
+            logging.warning(f"Checksum mismatch for segment {segment_id}")
+            if self.repaired(segment, sink):
+                digest = content_checksum
+            else:
+                self.reset_segment(segment_id)
+                return None
 
+        self.partial_segments.pop(segment_id, None)
+        self.record_segment(segment_id, sink.written - self.counted_bytes.pop(segment_id, 0), digest)
+        return sink.written
+
+    def repaired(self, segment, sink):
+        """Repair a mismatched segment block by block, if the manifest can tell where it is damaged."""
+        if sink.blocks is None or not sink.blocks.bad_blocks or 'content_checksum' not in segment:
+            return False
+        if sink.written != segment['end'] - segment['start']:
+            return False  # a short or long body is not a matter of a few bad blocks
+        return self.repair_blocks(segment, sink.blocks.bad_blocks)
+
+    def reset_segment(self, segment_id):
+        # The bytes kept from earlier attempts may be bad too: start over
+        self.partial_segments.pop(segment_id, None)
+        self.journal.record_progress(segment_id, 0)
+        with self.lock:
+            self.pbar.update(-self.counted_bytes.pop(segment_id, 0))
+
+    def download(self):
+        """Download the missing segments; return True once the whole file is verified."""
+        missing = [s for s in self.segments if s['id'] not in self.downloaded_segments]
+        self.open_output()
+        try:
+            missing = self.reuse_local_chunks(missing)
+            self.scheduler = SegmentScheduler(self, missing, self.max_workers, self.max_server_concurrency)
+            self.scheduler.run()
+        finally:
+            self.close_output()
         self.pbar.close()
+        return self.finish_download()
 
+    def cancel(self):
+        """Start no more segments. Fetches in flight finish and stay in the journal, so the download can resume."""
+        self.cancelled.set()
+        scheduler = self.scheduler
+        if scheduler is not None:
+            with scheduler.condition:
+                scheduler.condition.notify_all()
+
+    def reuse_local_chunks(self, segments):
+        """Copy chunks already on disk from earlier downloads; return the segments still to fetch."""
+        if self.chunk_index is None:
+            return segments
+        remaining = []
+        reused = 0
+        for segment in segments:
+            data = self.chunk_index.read(segment)
+            if data is None:
+                remaining.append(segment)
+                continue
+            write_at(self.output_fd, data, segment['start'])
+            self.partial_segments.pop(segment['id'], None)
+            self.record_segment(segment['id'], len(data) - self.counted_bytes.pop(segment['id'], 0),
+                                segment['content_checksum'])
+            reused += len(data)
+        if reused:
+            logging.info(f"Reused {len(segments) - len(remaining)} chunks ({reused} bytes) "
+                         f"from earlier downloads")
+        return remaining
+
+    def finish_download(self):
         if len(self.downloaded_segments) == self.total_segments:
-            logging.info("All segments downloaded, assembling file...")
-            self.assemble_file()
-            os.remove(RESUME_FILE)
-            self.verify_file_integrity()
+            logging.info("All segments downloaded")
+            self.journal.remove()
+            if not self.verify_file_integrity():
+                return False
+            self.save_version()
+            if self.chunk_index is not None:
+                self.chunk_index.add(self.output_file, self.segments)
+                self.chunk_index.save()
+            return True
+        if self.cancelled.is_set():
+            logging.info(f"Download of {self.filename} cancelled")
         else:
             missing_segments = set(range(1, self.total_segments + 1)) - self.downloaded_segments
             logging.warning(f"Download incomplete. Missing segments: {missing_segments}")
-
-    def assemble_file(self):
-        with open(self.output_file, "wb") as f:
-            for segment_id in range(1, self.total_segments + 1):
-                segment_file = os.path.join(SEGMENT_DIR, f"{self.filename}_segment_{segment_id}")
-                with open(segment_file, 'rb') as sf:
-                    f.write(sf.read())
-                os.remove(segment_file)  # Remove segment file after assembling
+        return False
 
     def verify_file_integrity(self):
+        """Check the output against the server's checksums; return True if it matches.
+
+        When the server publishes a tree checksum, the content digests taken
+        while downloading are combined into it, so nothing is read back and a
+        bad segment is named. Otherwise the output is hashed in chunks.
+        """
         logging.info("Verifying file integrity...")
-        with open(self.output_file, 'rb') as f:
-            file_data = f.read()
-        file_checksum = self.calculate_checksum(file_data)
-        if file_checksum == self.checksum:
-            logging.info("File integrity verified successfully")
+        tree = self.file_info.get('tree_checksum')
+        if tree and all('content_checksum' in s for s in self.segments):
+            bad = [s['id'] for s in self.segments
+                   if self.segment_digests.get(s['id']) != s['content_checksum']]
+            if bad:
+                logging.error(f"File integrity check failed: segments {bad} do not match")
+                return False
+            if tree_checksum(self.segment_digests[s['id']] for s in self.segments) != tree:
+                logging.error("File integrity check failed: tree checksum mismatch")
+                return False
         else:
-            logging.error("File integrity check failed")
-
-def list_available_files(main_server_host, main_server_port):
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.connect((main_server_host, main_server_port))
-        request = {"type": "list_files"}
-        s.sendall(json.dumps(request).encode())
-        
-        chunks = []
+            file_hash = hashlib.md5()
+            with open(self.output_file, 'rb') as f:
+                for chunk in iter(lambda: f.read(RECV_SIZE), b''):
+                    file_hash.update(chunk)
+            if file_hash.hexdigest() != self.checksum:
+                logging.error("File integrity check failed")
+                return False
+        logging.info("File integrity verified successfully")
+        return True
+
+class MainServerConnection:
+    """Framed connection to the main server, kept open for any number of requests."""
+
+    def __init__(self, host, port):
+        self.sock = socket.create_connection((host, port))
+        self.sock.sendall(protocol.MAIN_MAGIC)
+
+    def request(self, request):
+        self.sock.sendall(protocol.pack_message(request))
+        return protocol.recv_message(self.sock)
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def list_available_files(main_server_host, main_server_port, prefix=None, pattern=None):
+    """Every available file, read page by page, optionally filtered by name prefix or glob."""
+    files = []
+    request = {"type": "list_files", "prefix": prefix, "pattern": pattern}
+    with MainServerConnection(main_server_host, main_server_port) as main_server:
         while True:
-            chunk = s.recv(4096)
-            if not chunk:
-                break
-            chunks.append(chunk)
-        
-        response_data = b''.join(chunks).decode()
-        return json.loads(response_data).get('files', [])
+            page = main_server.request(request)
+            if "error" in page:
+                raise ValueError(f"Error: {page['error']}")
+            files.extend(page['files'])
+            if page.get('next_cursor') is None:
+                return files
+            request['cursor'] = page['next_cursor']
+
+
+def download_batch(filenames, output_dir, main_server_host=MAIN_SERVER_HOST,
+                   main_server_port=MAIN_SERVER_PORT, max_workers=MAX_WORKERS,
+                   max_server_concurrency=MAX_SERVER_CONCURRENCY, priorities=None):
+    """Download many files into `output_dir` on one BatchScheduler; return {filename: verified}.
+
+    `priorities` maps filenames to numbers, and files with higher ones are
+    fetched first. Progress is shown as one bar for the whole batch.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    results = {}
+    counted = {}
+    lock = Lock()
+    pbar = None
+
+    def progress(filename):
+        def on_progress(done, total):
+            with lock:
+                pbar.update(done - counted[filename])
+                counted[filename] = done
+        return on_progress
+
+    downloaders = []
+    chunk_index = None
+    for filename in filenames:
+        try:
+            downloader = FileDownloader(filename, os.path.join(output_dir, filename),
+                                        main_server_host, main_server_port,
+                                        on_progress=progress(filename))
+        except ValueError as e:
+            logging.error(f"Skipping {filename}: {e}")
+            results[filename] = False
+            continue
+        counted[filename] = downloader.pbar.n
+        # One index for the batch, so files finishing later keep the chunks of earlier ones
+        if downloader.chunk_index is not None:
+            chunk_index = chunk_index or downloader.chunk_index
+            downloader.chunk_index = chunk_index
+        downloaders.append(downloader)
+
+    def on_file_done(downloader, verified):
+        results[downloader.filename] = verified
+        logging.info(f"{downloader.filename}: {'done' if verified else 'incomplete'}")
+
+    pbar = tqdm(total=sum(d.file_size for d in downloaders), initial=sum(counted.values()),
+                unit='B', unit_scale=True, desc=f"{len(downloaders)} files")
+    try:
+        BatchScheduler(downloaders, max_workers, max_server_concurrency,
+                       priorities, on_file_done).run()
+    finally:
+        pbar.close()
+    return results
+
+
+class Download:
+    """One download run by a Downloader.
+
+    Await it for the result: True once the file is complete and verified,
+    False if segments are still missing. `progress()` yields its progress
+    events, and `cancel()` stops it. Awaiting a cancelled download raises
+    asyncio.CancelledError, and the progress journal keeps what was fetched,
+    so starting the same download again resumes it.
+    """
+
+    FINISHED = ('done', 'failed', 'cancelled')
+
+    def __init__(self, filename, output_file, total, loop):
+        self.filename = filename
+        self.output_file = output_file
+        self.state = 'queued'
+        self.downloaded = 0
+        self.total = total
+        self.loop = loop
+        self.file_downloader = None
+        self.cancel_requested = False
+        self.task = None
+        self.listeners = set()
+        self.publish_scheduled = False
+
+    def __await__(self):
+        return self.task.__await__()
+
+    def event(self):
+        return {
+            'filename': self.filename,
+            'output_file': self.output_file,
+            'state': self.state,
+            'downloaded': self.downloaded,
+            'total': self.total,
+        }
+
+    def on_progress(self, downloaded, total):
+        # Called on download threads, once per chunk received: updates are
+        # coalesced into at most one pending publish on the event loop
+        self.downloaded, self.total = downloaded, total
+        if not self.publish_scheduled:
+            self.publish_scheduled = True
+            self.loop.call_soon_threadsafe(self.publish)
+
+    def publish(self):
+        self.publish_scheduled = False
+        event = self.event()
+        for queue in self.listeners:
+            queue.put_nowait(event)
+
+    def set_state(self, state):
+        self.state = state
+        self.publish()
+
+    async def progress(self):
+        """Yield progress events, starting with the current one, until the download finishes."""
+        queue = asyncio.Queue()
+        self.listeners.add(queue)
+        try:
+            event = self.event()
+            while True:
+                yield event
+                if event['state'] in self.FINISHED:
+                    return
+                event = await queue.get()
+        finally:
+            self.listeners.discard(queue)
+
+    def cancel(self):
+        self.cancel_requested = True
+        if self.file_downloader is not None:
+            self.file_downloader.cancel()
+
+
+class Downloader:
+    """asyncio front end running many downloads in one process.
+
+        async with Downloader() as downloader:
+            download = await downloader.start('large_file.xml', 'out.xml')
+            async for event in download.progress():
+                print(event['downloaded'], event['total'])
+            verified = await download
+
+    Requests to the main server go over asyncio streams, so nothing blocks
+    the event loop, and up to MAIN_IDLE_CONNECTIONS of them stay open for
+    the next requests. Each download runs a FileDownloader on one of
+    `max_downloads` threads; the rest wait their turn. All of them share the
+    process-wide connection pools to the minor servers. Leaving the `async
+    with` block cancels the downloads still running and waits for them.
+    """
+
+    def __init__(self, host=MAIN_SERVER_HOST, port=MAIN_SERVER_PORT, max_downloads=MAX_DOWNLOADS,
+                 max_workers=MAX_WORKERS, max_server_concurrency=MAX_SERVER_CONCURRENCY):
+        self.host = host
+        self.port = port
+        self.max_downloads = max_downloads
+        self.max_workers = max_workers
+        self.max_server_concurrency = max_server_concurrency
+        self.executor = None
+        self.downloads = set()
+        self.idle = []  # (reader, writer) of open connections to the main server
+
+    async def __aenter__(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.max_downloads,
+                                           thread_name_prefix='download')
+        return self
+
+    async def __aexit__(self, *exc_info):
+        for download in list(self.downloads):
+            download.cancel()
+        if self.downloads:
+            await asyncio.gather(*(d.task for d in self.downloads), return_exceptions=True)
+        self.executor.shutdown(wait=False)
+        for _, writer in self.idle:
+            writer.close()
+        self.idle.clear()
+
+    async def request(self, request):
+        """Send one request to the main server and return its JSON reply.
+
+        Connections are kept open for later requests. When one the server
+        closed while it sat idle fails, the request is sent again on a new one.
+        """
+        while True:
+            reused = bool(self.idle)
+            if reused:
+                reader, writer = self.idle.pop()
+            else:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+                writer.write(protocol.MAIN_MAGIC)
+            try:
+                writer.write(protocol.pack_message(request))
+                await writer.drain()
+                reply = await protocol.read_message(reader)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if reused:
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            if len(self.idle) < MAIN_IDLE_CONNECTIONS:
+                self.idle.append((reader, writer))
+            else:
+                writer.close()
+            return reply
+
+    async def list_files(self, prefix=None, pattern=None):
+        """Every available file, read page by page, optionally filtered by name prefix or glob."""
+        files = []
+        request = {"type": "list_files", "prefix": prefix, "pattern": pattern}
+        while True:
+            page = await self.request(request)
+            if "error" in page:
+                raise ValueError(f"Error: {page['error']}")
+            files.extend(page['files'])
+            if page.get('next_cursor') is None:
+                return files
+            request = dict(request, cursor=page['next_cursor'])
+
+    async def file_info(self, filename):
+        # A file another client asked for first may still be being segmented
+        while True:
+            file_info = await self.request({"type": "get_file_info", "filename": filename})
+            if file_info.get('status') != 'segmenting':
+                return file_info
+            await asyncio.sleep(file_info['retry_after'])
+
+    async def start(self, filename, output_file):
+        """Start downloading `filename` into `output_file`; return its Download."""
+        file_info = await self.file_info(filename)
+        if "error" in file_info:
+            raise ValueError(f"Error: {file_info['error']}")
+        download = Download(filename, output_file, file_info['file_size'], asyncio.get_running_loop())
+        self.downloads.add(download)
+        download.task = asyncio.ensure_future(self.run(download, file_info))
+        return download
+
+    async def download(self, filename, output_file):
+        """Download `filename` into `output_file`; return True once it is verified."""
+        return await (await self.start(filename, output_file))
+
+    async def run(self, download, file_info):
+        loop = asyncio.get_running_loop()
+        try:
+            # Loading the journal and earlier versions reads the disk
+            file_downloader = await loop.run_in_executor(None, lambda: FileDownloader(
+                download.filename, download.output_file, self.host, self.port,
+                file_info=file_info, max_workers=self.max_workers,
+                max_server_concurrency=self.max_server_concurrency,
+                on_progress=download.on_progress,
+            ))
+            download.file_downloader = file_downloader
+            download.on_progress(file_downloader.pbar.n, file_downloader.file_size)
+            if download.cancel_requested:
+                file_downloader.cancel()
+
+            def run_download():
+                loop.call_soon_threadsafe(download.set_state, 'running')
+                return file_downloader.download()
+
+            future = loop.run_in_executor(self.executor, run_download)
+            try:
+                verified = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # The thread cannot be interrupted: stop it starting segments and wait
+                file_downloader.cancel()
+                await future
+                raise
+            if file_downloader.cancelled.is_set() and not verified:
+                raise asyncio.CancelledError()
+        except asyncio.CancelledError:
+            download.set_state('cancelled')
+            raise
+        except Exception:
+            download.set_state('failed')
+            raise
+        finally:
+            self.downloads.discard(download)
+        download.set_state('done' if verified else 'failed')
+        return verified
+
+
+async def run_cli(args):
+    async with Downloader(args.host, args.port, max_workers=args.workers,
+                          max_server_concurrency=args.per_server) as downloader:
+        if args.list:
+            files = await downloader.list_files()
+            print("Available files:")
+            for file in files:
+                print(f"- {file['name']} ({file['size']} bytes)")
+            return
+        try:
+            download = await downloader.start(args.filename, args.output_file)
+        except ValueError as e:
+            print(f"Error: {e}")
+            return
+        with tqdm(total=download.total, unit='B', unit_scale=True, desc=args.filename) as pbar:
+            async for event in download.progress():
+                pbar.update(event['downloaded'] - pbar.n)
+        await download
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Dynamic File Downloader")
@@ -194,22 +1953,53 @@ if __name__ == "__main__":
     parser.add_argument("--host", default="localhost", help="Main server host")
     parser.add_argument("--port", type=int, default=8000, help="Main server port")
     parser.add_argument("--list", action="store_true", help="List available files")
+    parser.add_argument("--no-wire-compression", action="store_true",
+                        help="Ask minor servers for decompressed segments")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS,
+                        help="Segment fetches in flight across all servers")
+    parser.add_argument("--per-server", type=int, default=MAX_SERVER_CONCURRENCY,
+                        help="Most segment fetches in flight to one minor server")
+    parser.add_argument("--read-size", type=int, default=RECV_SIZE,
+                        help="Bytes read from the socket per recv_into")
+    parser.add_argument("--chunk-index", default=CHUNK_INDEX_FILE,
+                        help="Index of downloaded chunks reused by later downloads")
+    parser.add_argument("--batch", nargs="+", metavar="PATTERN",
+                        help="Download every available file matching a pattern; "
+                        "files matching earlier patterns go first")
+    parser.add_argument("--output-dir", default="downloads", help="Where --batch downloads go")
+    parser.add_argument("--max-rate", type=float, help="MB/s of segments started across all servers")
+    parser.add_argument("--server-rate", type=float, help="MB/s of segments started on one minor server")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="Serve metrics on this local port while downloading")
     args = parser.parse_args()
+    WIRE_COMPRESSION = not args.no_wire_compression
+    RECV_SIZE = args.read_size
+    CHUNK_INDEX_FILE = args.chunk_index
+    MAX_BANDWIDTH = args.max_rate * 1024 * 1024 if args.max_rate else None
+    SERVER_BANDWIDTH = args.server_rate * 1024 * 1024 if args.server_rate else None
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
 
-    if args.list:
-        files = list_available_files(args.host, args.port)
-        print("Available files:")
-        for file in files:
-            print(f"- {file['name']} ({file['size']} bytes)")
-    elif args.filename and args.output_file:
-        try:
-            downloader = FileDownloader(args.filename, args.output_file, args.host, args.port)
-            downloader.download()
-        except ValueError as e:
-            print(f"Error: {e}")
+    if args.batch:
+        priorities = {}
+        for file in list_available_files(args.host, args.port):
+            for rank, pattern in enumerate(args.batch):
+                if fnmatch.fnmatch(file['name'], pattern):
+                    priorities[file['name']] = len(args.batch) - rank
+                    break
+        results = download_batch(list(priorities), args.output_dir, args.host, args.port,
+                                 args.workers, args.per_server, priorities)
+        print(f"Downloaded {sum(results.values())} of {len(results)} files")
+        for filename, verified in results.items():
+            if not verified:
+                print(f"- {filename} failed")
+    elif args.list or (args.filename and args.output_file):
+        asyncio.run(run_cli(args))
     else:
         parser.print_help()
 
 # Example usage:
 # python client.py --list
-# python client.py example.txt downloaded_example.txt
\ No newline at end of file
+# python client.py example.txt downloaded_example.txt
+# python client.py --batch "*" --output-dir downloads --server-rate 50
+# python client.py large_file.xml downloaded_large_file.xml --metrics-port 9110
@@ -0,0 +1,300 @@
+"""Long-running download service with a local JSON API over HTTP.
+
+One process keeps a client.Downloader open, so every download shares warm
+connection pools to the minor servers, and the file list is cached instead of
+being fetched by a fresh interpreter for every page load.
+
+    GET  /files[?refresh=1]                  available files, cached for FILE_LIST_TTL
+    GET  /downloads                          latest event of every download
+    GET  /downloads/<filename>               latest event of one download
+    POST /downloads                          {"filename", "output_file"?}: start one
+    POST /downloads/<filename>/pause         stop it, keeping the progress journal
+    POST /downloads/<filename>/resume        start it again from the journal
+    POST /downloads/<filename>/cancel        stop it and delete the partial output
+    GET  /events[?filename=]                 server-sent stream of progress events
+    GET  /metrics                            client metrics in the Prometheus text format
+
+Every event is a JSON object with `filename`, `output_file`, `state`
+(queued, running, paused, done, failed or cancelled), `downloaded` and
+`total`, plus `error` when a download fails.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+from http import HTTPStatus
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import client
+import metrics
+from client import Download, Downloader
+
+DAEMON_HOST = '127.0.0.1'  # only local processes may drive downloads
+DAEMON_PORT = 8010
+DOWNLOAD_DIR = 'downloads'  # where downloads go when no output file is given
+FILE_LIST_TTL = 30  # seconds the cached file list is served before asking the main server again
+EVENT_KEEPALIVE = 15  # seconds between comments on an idle event stream
+MAX_BODY_SIZE = 64 * 1024  # largest request body accepted
+
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class DownloadService:
+    """Downloads driven through the HTTP API, and the events they publish."""
+
+    def __init__(self, downloader, download_dir=DOWNLOAD_DIR):
+        self.downloader = downloader
+        self.download_dir = download_dir
+        self.downloads = {}  # filename -> latest Download
+        self.watchers = {}  # filename -> task publishing that Download's events
+        self.events = {}  # filename -> latest event
+        self.paused = set()
+        self.subscribers = {}  # event stream queue -> filename it follows, or None for all
+        self.files = None
+        self.files_fetched = 0
+        self.files_lock = asyncio.Lock()
+
+    async def list_files(self, refresh=False):
+        async with self.files_lock:
+            if refresh or self.files is None or time.monotonic() - self.files_fetched > FILE_LIST_TTL:
+                self.files = await self.downloader.list_files()
+                self.files_fetched = time.monotonic()
+            return self.files
+
+    def running(self, filename):
+        download = self.downloads.get(filename)
+        return download is not None and download.state not in Download.FINISHED
+
+    def publish(self, event):
+        self.events[event['filename']] = event
+        for queue, filename in self.subscribers.items():
+            if filename in (None, event['filename']):
+                queue.put_nowait(event)
+
+    async def watch(self, download):
+        async for event in download.progress():
+            if event['state'] not in Download.FINISHED:
+                self.publish(event)
+        await asyncio.wait([download.task])
+        event = download.event()
+        if download.task.cancelled():
+            if download.filename in self.paused:
+                event['state'] = 'paused'
+        else:
+            # It may have finished before a pause took hold
+            self.paused.discard(download.filename)
+            if download.task.exception() is not None:
+                event['error'] = str(download.task.exception())
+            elif event['state'] == 'failed':
+                event['error'] = 'Some segments could not be fetched'
+        self.publish(event)
+
+    async def start(self, filename, output_file=None):
+        if self.running(filename):
+            return self.events[filename]
+        if output_file is None:
+            output_file = os.path.join(self.download_dir, os.path.basename(filename))
+        directory = os.path.dirname(output_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        try:
+            download = await self.downloader.start(filename, output_file)
+        except ValueError as e:
+            raise ApiError(HTTPStatus.NOT_FOUND, str(e))
+        except OSError as e:
+            raise ApiError(HTTPStatus.BAD_GATEWAY, f"Main server unreachable: {e}")
+        self.paused.discard(filename)
+        self.downloads[filename] = download
+        self.watchers[filename] = asyncio.ensure_future(self.watch(download))
+        logging.info(f"Started {filename} -> {output_file}")
+        return download.event()
+
+    async def stop(self, filename):
+        self.downloads[filename].cancel()
+        await self.watchers[filename]
+
+    async def pause(self, filename):
+        if not self.running(filename):
+            raise ApiError(HTTPStatus.CONFLICT, f"{filename} is not downloading")
+        self.paused.add(filename)
+        await self.stop(filename)
+        logging.info(f"Paused {filename}")
+        return self.events[filename]
+
+    async def resume(self, filename):
+        if filename not in self.paused:
+            raise ApiError(HTTPStatus.CONFLICT, f"{filename} is not paused")
+        return await self.start(filename, self.events[filename]['output_file'])
+
+    async def cancel(self, filename):
+        event = self.events.get(filename)
+        if event is None or event['state'] in ('done', 'cancelled'):
+            raise ApiError(HTTPStatus.CONFLICT, f"{filename} has nothing to cancel")
+        self.paused.discard(filename)
+        if self.running(filename):
+            await self.stop(filename)
+        # The journal is what a resume would start from, so it goes too
+        output_file = event['output_file']
+        for path in (output_file, output_file + client.PROGRESS_SUFFIX):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        event = {**self.events[filename], 'state': 'cancelled', 'downloaded': 0}
+        event.pop('error', None)
+        self.publish(event)
+        logging.info(f"Cancelled {filename}")
+        return event
+
+    def event(self, filename):
+        if filename not in self.events:
+            raise ApiError(HTTPStatus.NOT_FOUND, f"No download of {filename}")
+        return self.events[filename]
+
+    async def route(self, method, parts, query, body):
+        if parts == ['files'] and method == 'GET':
+            return {"files": await self.list_files(query.get('refresh') == ['1'])}
+        if parts == ['downloads'] and method == 'GET':
+            return {"downloads": list(self.events.values())}
+        if parts == ['downloads'] and method == 'POST':
+            try:
+                request = json.loads(body)
+            except ValueError:
+                raise ApiError(HTTPStatus.BAD_REQUEST, "Body must be JSON")
+            if not isinstance(request, dict) or not request.get('filename'):
+                raise ApiError(HTTPStatus.BAD_REQUEST, "filename is required")
+            return await self.start(request['filename'], request.get('output_file'))
+        if len(parts) == 2 and parts[0] == 'downloads' and method == 'GET':
+            return self.event(parts[1])
+        if len(parts) == 3 and parts[0] == 'downloads' and method == 'POST':
+            action = {'pause': self.pause, 'resume': self.resume, 'cancel': self.cancel}.get(parts[2])
+            if action is not None:
+                return await action(parts[1])
+        raise ApiError(HTTPStatus.NOT_FOUND, f"No route for {method} /{'/'.join(parts)}")
+
+    async def handle(self, reader, writer):
+        """Serve one HTTP request; every connection is closed after its reply."""
+        try:
+            request_line = await reader.readline()
+            if not request_line:
+                return
+            method, target, _ = request_line.decode('latin-1').split(' ', 2)
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                if name.strip().lower() == 'content-length':
+                    length = int(value)
+            url = urlsplit(target)
+            # Split before unquoting so a filename may contain an encoded '/'
+            parts = [unquote(part) for part in url.path.strip('/').split('/')]
+            query = parse_qs(url.query)
+            if parts == ['events'] and method == 'GET':
+                await self.stream_events(writer, query.get('filename', [None])[0])
+                return
+            content_type = 'application/json'
+            if parts == ['metrics'] and method == 'GET':
+                status, data = HTTPStatus.OK, metrics.REGISTRY.render().encode()
+                content_type = metrics.CONTENT_TYPE
+            else:
+                try:
+                    if length > MAX_BODY_SIZE:
+                        raise ApiError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, "Request body too large")
+                    body = await reader.readexactly(length) if length else b''
+                    status, reply = HTTPStatus.OK, await self.route(method, parts, query, body)
+                except ApiError as e:
+                    status, reply = e.status, {"error": str(e)}
+                except Exception as e:
+                    logging.error(f"Error handling {method} {url.path}: {e}")
+                    status, reply = HTTPStatus.INTERNAL_SERVER_ERROR, {"error": str(e)}
+                data = json.dumps(reply).encode()
+            writer.write(
+                f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(data)}\r\n"
+                f"Connection: close\r\n\r\n".encode() + data
+            )
+            await writer.drain()
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def stream_events(self, writer, filename):
+        """Send the current events, then every new one, until the client goes away."""
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/event-stream\r\n"
+            b"Cache-Control: no-cache\r\n"
+            b"Connection: close\r\n\r\n"
+        )
+        queue = asyncio.Queue()
+        self.subscribers[queue] = filename
+        try:
+            for event in list(self.events.values()):
+                if filename in (None, event['filename']):
+                    queue.put_nowait(event)
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), EVENT_KEEPALIVE)
+                    writer.write(f"data: {json.dumps(event)}\n\n".encode())
+                except asyncio.TimeoutError:
+                    # Lets a stream whose client left fail and be dropped
+                    writer.write(b": keepalive\n\n")
+                await writer.drain()
+        finally:
+            del self.subscribers[queue]
+
+
+async def serve(args):
+    async with Downloader(args.host, args.port, max_downloads=args.max_downloads,
+                          max_workers=args.workers,
+                          max_server_concurrency=args.per_server) as downloader:
+        service = DownloadService(downloader, args.download_dir)
+        metrics.gauge('fdl_daemon_running_downloads', 'Downloads queued or running',
+                      function=lambda: sum(map(service.running, list(service.downloads))))
+        if args.unix_socket:
+            server = await asyncio.start_unix_server(service.handle, path=args.unix_socket)
+            logging.info(f"Download daemon listening on {args.unix_socket}")
+        else:
+            server = await asyncio.start_server(service.handle, args.listen_host, args.listen_port)
+            logging.info(f"Download daemon listening on {args.listen_host}:{args.listen_port}")
+        async with server:
+            await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download daemon with a local JSON API")
+    parser.add_argument("--host", default=client.MAIN_SERVER_HOST, help="Main server host")
+    parser.add_argument("--port", type=int, default=client.MAIN_SERVER_PORT, help="Main server port")
+    parser.add_argument("--listen-host", default=DAEMON_HOST, help="Address the API listens on")
+    parser.add_argument("--listen-port", type=int, default=DAEMON_PORT, help="Port the API listens on")
+    parser.add_argument("--unix-socket", help="Serve the API on this Unix socket instead of TCP")
+    parser.add_argument("--download-dir", default=DOWNLOAD_DIR,
+                        help="Where downloads go when no output file is given")
+    parser.add_argument("--max-downloads", type=int, default=client.MAX_DOWNLOADS,
+                        help="Downloads run at once; later ones wait their turn")
+    parser.add_argument("--workers", type=int, default=client.MAX_WORKERS,
+                        help="Segment fetches in flight per download")
+    parser.add_argument("--per-server", type=int, default=client.MAX_SERVER_CONCURRENCY,
+                        help="Most segment fetches in flight to one minor server per download")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+# Example usage (progress journals keep interrupted downloads resumable):
+# python download_daemon.py
+# python download_daemon.py --download-dir ../downloads --listen-port 8010
+# curl -X POST localhost:8010/downloads -d '{"filename": "large_file.xml"}'
+# curl -N localhost:8010/events
+# curl localhost:8010/metrics
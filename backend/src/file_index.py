@@ -0,0 +1,119 @@
+"""Index of the files the main server offers, kept up to date incrementally.
+
+Lookups and listings read an in-memory snapshot: a sorted list of names and
+a dict of sizes, replaced as a whole whenever the index changes, so readers
+never take a lock. Before answering, the index stats the directory. When its
+mtime has moved (a file was added, removed or renamed), the directory is
+scanned again with os.scandir, and only names new to the index are stat'ed.
+Sizes of files changed in place do not move the directory's mtime, so every
+REFRESH_INTERVAL all sizes are stat'ed again.
+
+Listings are paginated in name order. The cursor is the last name a page
+looked at, so pages stay consistent while files come and go.
+"""
+import bisect
+import fnmatch
+import os
+import time
+from threading import Lock
+
+REFRESH_INTERVAL = 30  # seconds before every size is stat'ed again
+MAX_SCAN = 100000  # names one page may look at before returning, filtered out or not
+
+
+class FileIndex:
+    def __init__(self, directory, refresh_interval=REFRESH_INTERVAL):
+        self.directory = directory
+        self.refresh_interval = refresh_interval
+        self.lock = Lock()  # one scan at a time
+        self.snapshot = ([], {})  # (sorted names, {name: size})
+        self.directory_mtime = None
+        self.refreshed = None  # monotonic time of the last full scan
+
+    def refresh(self):
+        """Scan the directory again if it changed or the sizes are due to be stat'ed."""
+        if not self.stale(self.directory_stat()):
+            return
+        with self.lock:
+            # Stat again under the lock: the scan must not miss a change made after it
+            mtime = self.directory_stat()
+            if not self.stale(mtime):
+                return  # another request scanned it while we waited
+            full = self.refreshed is None or time.monotonic() - self.refreshed >= self.refresh_interval
+            self.scan(full)
+            self.directory_mtime = mtime
+            if full:
+                self.refreshed = time.monotonic()
+
+    def directory_stat(self):
+        try:
+            return os.stat(self.directory).st_mtime_ns
+        except OSError:
+            return None
+
+    def stale(self, mtime):
+        return (
+            mtime != self.directory_mtime
+            or self.refreshed is None
+            or time.monotonic() - self.refreshed >= self.refresh_interval
+        )
+
+    def scan(self, full):
+        names, old = self.snapshot
+        sizes = {}
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    # is_file() comes from the directory entry, without a stat
+                    if not entry.is_file():
+                        continue
+                    size = None if full else old.get(entry.name)
+                    if size is None:
+                        try:
+                            size = entry.stat().st_size
+                        except OSError:
+                            continue  # removed while we scanned
+                    sizes[entry.name] = size
+        except FileNotFoundError:
+            pass
+        if sizes.keys() != old.keys():
+            names = sorted(sizes)
+        self.snapshot = (names, sizes)
+
+    def get(self, name):
+        """Size of the file `name`, or None if there is no such file."""
+        self.refresh()
+        size = self.snapshot[1].get(name)
+        if size is None and os.path.basename(name) == name:
+            # Created within the directory mtime's granularity of the last scan
+            path = os.path.join(self.directory, name)
+            if os.path.isfile(path):
+                size = os.path.getsize(path)
+        return size
+
+    def page(self, cursor=None, limit=1000, prefix=None, pattern=None):
+        """Return (files, next cursor): up to `limit` files after `cursor`, in name order.
+
+        Only names starting with `prefix` and matching the glob `pattern` are
+        listed. The next cursor is None once the listing is complete.
+        """
+        self.refresh()
+        names, sizes = self.snapshot
+        start = bisect.bisect_left(names, prefix) if prefix else 0
+        if cursor is not None:
+            start = max(start, bisect.bisect_right(names, cursor))
+        end = min(len(names), start + MAX_SCAN)
+        files = []
+        for i in range(start, end):
+            name = names[i]
+            if prefix and not name.startswith(prefix):
+                return files, None  # names are sorted: no more with this prefix
+            if pattern and not fnmatch.fnmatchcase(name, pattern):
+                continue
+            files.append({"name": name, "size": sizes[name]})
+            if len(files) == limit:
+                end = i + 1
+                break
+        if end == len(names) or (prefix and not names[end].startswith(prefix)):
+            return files, None
+        return files, names[end - 1]
@@ -0,0 +1,217 @@
+"""Segment metadata kept by the main server.
+
+Every file's info lives in an in-memory index, so lookups never touch the
+disk. Changes are appended to a JSON-lines log next to the snapshot file
+(`segment_cache.json.log`):
+
+    {"op": "put", "filename": ..., "info": {...}}
+    {"op": "delete", "filename": ...}
+    {"op": "touch", "times": {filename: last_accessed, ...}, "hits": {filename: hits, ...}}
+
+New and deleted files are fsynced before the call returns. Access times and
+hit counts only steer eviction, so they are written behind, batched once per
+FLUSH_INTERVAL.
+Once the log outgrows LOG_COMPACT_BYTES it is folded into a new snapshot,
+written to a temporary file and renamed over the old one, and the log starts
+again. On startup the snapshot is loaded and the log replayed; a torn last
+line left by a crash is dropped.
+"""
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from threading import Thread, Lock, RLock, Event
+
+FLUSH_INTERVAL = 1.0  # seconds between batched access-time writes
+LOG_COMPACT_BYTES = 4 * 1024 * 1024  # log size that triggers a new snapshot
+LOG_SUFFIX = ".log"
+
+
+class MetadataStore:
+    def __init__(self, path):
+        self.path = path
+        self.log_path = path + LOG_SUFFIX
+        self.lock = Lock()  # guards the index and the log
+        self.files = {}
+        self.file_locks = {}  # filename -> [RLock, holders], dropped once nobody holds it
+        self.dirty = set()  # files whose access time is not in the log yet
+        self.stopped = Event()
+        self.flusher = None
+        self.log = None  # opened on the first change
+        self.recover()
+
+    def recover(self):
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                self.files = json.load(f)
+        if not os.path.exists(self.log_path):
+            return
+        good = 0
+        with open(self.log_path, "rb") as f:
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("unterminated record")
+                    record = json.loads(line)
+                except ValueError:
+                    break
+                self.replay(record)
+                good += len(line)
+        if good < os.path.getsize(self.log_path):
+            # Cut the torn record off so new ones are not appended to it
+            logging.warning(f"Dropping torn record at the end of {self.log_path}")
+            os.truncate(self.log_path, good)
+
+    def replay(self, record):
+        op = record["op"]
+        if op == "put":
+            self.files[record["filename"]] = record["info"]
+        elif op == "delete":
+            self.files.pop(record["filename"], None)
+        elif op == "touch":
+            for filename, accessed in record["times"].items():
+                if filename in self.files:
+                    self.files[filename]["last_accessed"] = accessed
+            for filename, hits in record.get("hits", {}).items():
+                if filename in self.files:
+                    self.files[filename]["hits"] = hits
+
+    @contextmanager
+    def file_lock(self, filename):
+        """Hold the lock serialising changes to one file's entry.
+
+        It is re-entrant, so callers can hold it around a put or delete, for
+        example to segment or evict a file without racing a lookup. A file's
+        lock is dropped when its last holder releases it, so locks of deleted
+        files do not pile up.
+        """
+        with self.lock:
+            entry = self.file_locks.get(filename)
+            if entry is None:
+                entry = self.file_locks[filename] = [RLock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.file_locks[filename]
+
+    def get(self, filename):
+        return self.files.get(filename)
+
+    def __contains__(self, filename):
+        return filename in self.files
+
+    def items(self):
+        with self.lock:
+            return list(self.files.items())
+
+    def touch(self, filename):
+        """Record an access in memory and return the file's info, or None if it is not stored.
+
+        The access reaches the log on the next flush. Only self.lock is
+        taken, never the file's lock, so a lookup does not wait while the
+        file is being segmented.
+        """
+        with self.lock:
+            info = self.files.get(filename)
+            if info is None:
+                return None
+            info["last_accessed"] = time.time()
+            info["hits"] = info.get("hits", 0) + 1
+            self.dirty.add(filename)
+        return info
+
+    def put(self, filename, info):
+        with self.file_lock(filename):
+            with self.lock:
+                self.append({"op": "put", "filename": filename, "info": info})
+                self.files[filename] = info
+                self.dirty.discard(filename)
+
+    def delete(self, filename):
+        with self.file_lock(filename):
+            with self.lock:
+                self.append({"op": "delete", "filename": filename})
+                self.files.pop(filename, None)
+                self.dirty.discard(filename)
+
+    def delete_idle(self, filename, idle_for):
+        """Delete a file's entry unless it was accessed in the last `idle_for` seconds.
+
+        Returns the deleted info, or None if the file is not stored or in use.
+        The check and the delete happen under self.lock, so a concurrent touch
+        either renews the file first or finds it gone.
+        """
+        with self.file_lock(filename):
+            with self.lock:
+                info = self.files.get(filename)
+                if info is None or time.time() - info["last_accessed"] < idle_for:
+                    return None
+                self.append({"op": "delete", "filename": filename})
+                del self.files[filename]
+                self.dirty.discard(filename)
+                return info
+
+    def append(self, record, sync=True):
+        # Caller holds self.lock
+        if self.log is None:
+            self.log = open(self.log_path, "a")
+        self.log.write(json.dumps(record) + "\n")
+        self.log.flush()
+        if sync:
+            os.fsync(self.log.fileno())
+
+    def flush(self):
+        """Write batched access times and compact the log if it has grown too big."""
+        with self.lock:
+            if self.dirty:
+                touched = [f for f in self.dirty if f in self.files]
+                self.dirty.clear()
+                self.append({
+                    "op": "touch",
+                    "times": {f: self.files[f]["last_accessed"] for f in touched},
+                    "hits": {f: self.files[f].get("hits", 0) for f in touched},
+                }, sync=False)
+            if self.log is not None and self.log.tell() > LOG_COMPACT_BYTES:
+                self.snapshot()
+
+    def snapshot(self):
+        # Caller holds self.lock, so no record can slip in between the
+        # snapshot and the truncated log
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.files, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        if self.log is not None:
+            self.log.close()
+        self.log = open(self.log_path, "w")
+        os.fsync(self.log.fileno())
+
+    def run_flusher(self):
+        while not self.stopped.wait(FLUSH_INTERVAL):
+            try:
+                self.flush()
+            except OSError as e:
+                logging.error(f"Error writing segment metadata: {e}")
+
+    def start(self):
+        """Start writing batched access times in the background."""
+        if self.flusher is None:
+            self.flusher = Thread(target=self.run_flusher, daemon=True)
+            self.flusher.start()
+
+    def close(self):
+        self.stopped.set()
+        if self.flusher is not None:
+            self.flusher.join()
+        with self.lock:
+            self.dirty.clear()  # the snapshot holds every access time
+            self.snapshot()
+            self.log.close()
@@ -1,15 +1,69 @@
 import socket
 import os
 import struct
-from threading import Thread
+from threading import Thread, Lock, BoundedSemaphore
+from concurrent.futures import ThreadPoolExecutor
 import logging
 import hashlib
 import zlib
+import asyncio
+import argparse
+import time
+
+import metrics
+import protocol
+from segment_cache import CachedSegment, SegmentCache, file_signature
 
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
 )
 
+MAX_INFLIGHT_REQUESTS = 4  # multiplexed requests one connection serves at once
+MAX_QUEUED_REQUESTS = 64  # requests one connection may have waiting before it stops reading more
+LISTEN_BACKLOG = 128  # pending connections the kernel queues before refusing
+MAX_CONCURRENT_REQUESTS = 256  # async engine: requests being served at once
+READ_WORKERS = 8  # async engine: threads reading segments off disk
+CHECKSUM_SUFFIX = ".md5"  # sidecar holding a segment's checksum, written by server.py
+HASH_CHUNK_SIZE = 1024 * 1024
+STORED_ENCODING = "zlib"  # how server.py compresses segments of text files
+CHUNK_PREFIX = "chunk_"  # content-addressed chunks shared across files, named by server.py
+SEGMENT_CACHE_SIZE = None  # bytes of hot segments kept in memory; None = read every request from disk
+METRICS_PORT = None  # local port serving metrics; None = no endpoint
+LEASE_DIR = ".leases"  # per-file markers whose mtime tells server.py the file is being downloaded
+LEASE_RENEW_INTERVAL = 60  # seconds between marker updates for one file
+
+segment_cache = None  # SegmentCache of the threaded engine, set by run_server
+metered_cache = None  # SegmentCache whose counters the metrics report, of either engine
+lease_lock = Lock()
+lease_renewed = {}  # filename -> when its lease marker was last touched
+
+
+def cache_stat(name):
+    return metered_cache.stats()[name] if metered_cache is not None else 0
+
+
+REQUESTS = metrics.counter(
+    "fdl_minor_requests_total", "Segment requests answered", ["protocol", "result"]
+)
+READ_SECONDS = metrics.histogram(
+    "fdl_minor_read_seconds", "Time to read a segment, from the cache or from disk"
+)
+SERVE_SECONDS = metrics.histogram(
+    "fdl_minor_serve_seconds", "Time from a request to the last byte of its reply", ["protocol"]
+)
+BYTES_SENT = metrics.counter("fdl_minor_bytes_sent_total", "Segment bytes sent", ["encoding"])
+CONNECTIONS = metrics.counter("fdl_minor_connections_total", "Connections accepted", ["protocol"])
+OPEN_CONNECTIONS = metrics.gauge("fdl_minor_open_connections", "Connections being served")
+for stat, kind, help in [
+    ("hits", metrics.counter, "Segments served from the segment cache"),
+    ("misses", metrics.counter, "Segments read from disk into the segment cache"),
+    ("coalesced", metrics.counter, "Cache misses that waited on another request's read"),
+    ("evictions", metrics.counter, "Segments evicted from the segment cache"),
+    ("bytes", metrics.gauge, "Bytes held in the segment cache"),
+]:
+    name = f"fdl_minor_cache_{stat}" + ("_total" if kind is metrics.counter else "")
+    kind(name, help, function=lambda stat=stat: cache_stat(stat))
+
 
 def calculate_checksum(data):
     return hashlib.md5(data).hexdigest()
@@ -19,46 +73,391 @@ def decompress_data(data):
     return zlib.decompress(data)
 
 
-def handle_client(client_socket, base_path):
+class Segment:
+    """A segment ready to send: an open file served with sendfile, or bytes."""
+
+    def __init__(self, size, checksum, data=None, file=None,
+                 encoding=protocol.IDENTITY, offset=0):
+        self.size = size
+        self.checksum = checksum
+        self.data = data
+        self.file = file
+        self.encoding = encoding
+        self.offset = offset  # first byte sent; `size` counts from here
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+def stored_checksum(file_path):
+    """Return the checksum recorded next to a segment when it was created.
+
+    Segments written before checksums were recorded are hashed once, in
+    chunks, and the result is saved for later requests.
+    """
+    return read_stored_checksum(file_path)[0]
+
+
+def read_stored_checksum(file_path):
+    """(checksum, signature of the sidecar it was read from) of a stored segment."""
+    checksum_path = file_path + CHECKSUM_SUFFIX
     try:
-        data = client_socket.recv(1024).decode()
-        request = data.strip().split()
-        logging.info(f"Received request: {request}")
-
-        if request[0] == "GET_SEGMENT":
-            filename, segment_id, is_compressed = (
-                request[1],
-                int(request[2]),
-                request[3] == "True",
-            )
-            file_path = os.path.join(base_path, f"{filename}_segment_{segment_id}")
+        with open(checksum_path, "r") as f:
+            return f.read().strip(), file_signature(os.fstat(f.fileno()))
+    except FileNotFoundError:
+        pass
 
-            if os.path.exists(file_path):
-                with open(file_path, "rb") as f:
-                    segment_data = f.read()
+    segment_hash = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            segment_hash.update(chunk)
+    checksum = segment_hash.hexdigest()
+    tmp_path = f"{checksum_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(checksum)
+        signature = file_signature(os.fstat(f.fileno()))
+    os.replace(tmp_path, checksum_path)
+    return checksum, signature
 
-                if is_compressed:
-                    segment_data = decompress_data(segment_data)
 
-                checksum = calculate_checksum(segment_data)
-                client_socket.send(
-                    struct.pack("!I32s", len(segment_data), checksum.encode())
-                )
-                client_socket.sendall(segment_data)
-                logging.info(f"Sent segment {segment_id} of {filename}")
+def stored_name(filename, segment_id, object_name=None):
+    """Name of the file holding a segment, or None if the request names an invalid object.
+
+    Segments of files cut into content-defined chunks are requested by the
+    chunk's `object` name, which must be a bare chunk name in this directory.
+    """
+    if object_name is None:
+        return f"{filename}_segment_{segment_id}"
+    if os.path.basename(object_name) != object_name or not object_name.startswith(CHUNK_PREFIX):
+        return None
+    return object_name
+
+
+def load_stored(file_path):
+    """Read a segment as stored, for the segment cache.
+
+    Its signature covers the checksum sidecar as well, stat'ed through the
+    descriptor the checksum came from, so a rewrite of either file between
+    the two reads leaves an entry that no later lookup matches.
+    """
+    with open(file_path, "rb") as f:
+        signature = file_signature(os.fstat(f.fileno()))
+        data = f.read()
+    checksum, sidecar_signature = read_stored_checksum(file_path)
+    return CachedSegment(signature + sidecar_signature, data, checksum)
+
+
+def load_decoded(file_path):
+    """Read and decompress a segment, for the segment cache."""
+    with open(file_path, "rb") as f:
+        signature = file_signature(os.fstat(f.fileno()))
+        data = decompress_data(f.read())
+    return CachedSegment(signature, data, calculate_checksum(data))
+
+
+def read_segment(base_path, filename, segment_id, is_compressed, accept_encoding=(),
+                 offset=0, length=None, object_name=None, cache=None):
+    """Return a Segment to send, or None if it is not stored here.
+
+    Segments are sent as stored whenever the client can take them that way:
+    always for uncompressed ones, and for zlib-compressed ones when the client
+    accepts zlib. Those stay on disk and go out through sendfile with their
+    recorded checksum. Otherwise the segment is decompressed and hashed.
+    With a `cache`, segments are sent from memory in either form, and only
+    read from disk on a miss.
+
+    A resumed fetch starts at `offset`, and a range fetch also stops after
+    `length` bytes; the checksum still covers the whole segment. Ranges only
+    apply to unencoded replies and are ignored otherwise.
+    """
+    name = stored_name(filename, segment_id, object_name)
+    if name is None:
+        return None
+    file_path = os.path.join(base_path, name)
+    stored_encoding = STORED_ENCODING if is_compressed else protocol.IDENTITY
+    as_stored = stored_encoding == protocol.IDENTITY or stored_encoding in accept_encoding
+
+    if cache is not None:
+        encoding = stored_encoding if as_stored else protocol.IDENTITY
+        try:
+            if as_stored:
+                entry = cache.get((name, encoding), file_path, load_stored,
+                                  file_path + CHECKSUM_SUFFIX)
             else:
-                client_socket.send(struct.pack("!I32s", 0, b"\0" * 32))
-                logging.warning(f"Segment {segment_id} of {filename} not found")
+                entry = cache.get((name, encoding), file_path, load_decoded)
+        except FileNotFoundError:
+            return None  # removed between the lookup and the read
+        if entry is None:
+            return None
+        if encoding != protocol.IDENTITY:
+            offset, length = 0, None
+        offset, count = byte_range(len(entry.data), offset, length)
+        return Segment(count, entry.checksum, data=memoryview(entry.data)[offset:offset + count],
+                       encoding=encoding, offset=offset)
+
+    if not os.path.exists(file_path):
+        return None
+    if as_stored:
+        checksum = stored_checksum(file_path)
+        f = open(file_path, "rb")
+        size = os.fstat(f.fileno()).st_size
+        if stored_encoding != protocol.IDENTITY:
+            offset, length = 0, None
+        offset, count = byte_range(size, offset, length)
+        return Segment(count, checksum, file=f, encoding=stored_encoding, offset=offset)
+
+    with open(file_path, "rb") as f:
+        segment_data = decompress_data(f.read())
+    offset, count = byte_range(len(segment_data), offset, length)
+    return Segment(
+        count,
+        calculate_checksum(segment_data),
+        data=memoryview(segment_data)[offset:offset + count],
+        offset=offset,
+    )
+
+
+def renew_lease(base_path, filename):
+    """Touch the file's lease marker, so the main server keeps it while segments are being read.
+
+    The main server only sees lookups, and one download may take far longer
+    than its lease. Markers are touched at most every LEASE_RENEW_INTERVAL.
+    """
+    if os.path.basename(filename) != filename or filename.startswith("."):
+        return
+    now = time.monotonic()
+    with lease_lock:
+        if now - lease_renewed.get(filename, -LEASE_RENEW_INTERVAL) < LEASE_RENEW_INTERVAL:
+            return
+        lease_renewed[filename] = now
+    marker = os.path.join(base_path, LEASE_DIR, filename)
+    try:
+        os.makedirs(os.path.dirname(marker), exist_ok=True)
+        with open(marker, "a"):
+            os.utime(marker)
+    except OSError as e:
+        logging.warning(f"Could not renew the lease of {filename}: {e}")
+
+
+def timed_read_segment(base_path, filename, *args):
+    started = time.perf_counter()
+    try:
+        segment = read_segment(base_path, filename, *args)
+    finally:
+        READ_SECONDS.observe(time.perf_counter() - started)
+    if segment is not None:
+        renew_lease(base_path, filename)
+    return segment
+
+
+def record_served(kind, segment, started):
+    """Count one answered request; `segment` is None if it was not found."""
+    if segment is None:
+        REQUESTS.inc(protocol=kind, result="not_found")
+        return
+    REQUESTS.inc(protocol=kind, result="ok")
+    BYTES_SENT.inc(segment.size, encoding=segment.encoding)
+    SERVE_SECONDS.observe(time.perf_counter() - started, protocol=kind)
+
+
+def byte_range(size, offset, length):
+    """Clamp a requested range to a segment of `size` bytes: (offset, count)."""
+    offset = min(offset, size)
+    count = size - offset
+    if length is not None:
+        count = min(count, length)
+    return offset, count
+
+
+def send_segment(sock, segment):
+    if segment.file is not None:
+        if segment.size:  # sendfile rejects a zero count
+            sent = sock.sendfile(segment.file, segment.offset, segment.size)
+            if sent != segment.size:
+                raise ConnectionError(f"Segment file ended after {sent} of {segment.size} bytes")
+    else:
+        sock.sendall(segment.data)
+
+
+def parse_text_request(data):
+    """Return (filename, segment_id, is_compressed) for a text GET_SEGMENT line."""
+    request = data.strip().split()
+    logging.info(f"Received request: {request}")
+    if request[0] != "GET_SEGMENT":
+        return None
+    return request[1], int(request[2]), request[3] == "True"
+
+
+def text_reply_header(segment):
+    if segment is None:
+        return struct.pack("!I32s", 0, b"\0" * 32)
+    return struct.pack("!I32s", segment.size, segment.checksum.encode())
+
+
+def handle_text_request(client_socket, base_path, data):
+    request = parse_text_request(data)
+    if request is None:
+        return
+
+    started = time.perf_counter()
+    filename, segment_id, is_compressed = request
+    segment = timed_read_segment(base_path, filename, segment_id, is_compressed,
+                                 (), 0, None, None, segment_cache)
+    if segment is None:
+        client_socket.send(text_reply_header(segment))
+        record_served("text", segment, started)
+        logging.warning(f"Segment {segment_id} of {filename} not found")
+        return
+
+    try:
+        client_socket.send(text_reply_header(segment))
+        send_segment(client_socket, segment)
+    finally:
+        segment.close()
+    record_served("text", segment, started)
+    logging.info(f"Sent segment {segment_id} of {filename}")
+
+
+def drop_connection(sock):
+    """Close a connection whose stream is out of step: a reply started but did not finish."""
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+def serve_frame_request(client_socket, send_lock, base_path, request_id, request):
+    started = time.perf_counter()
+    replying = False  # once a reply is being sent, an ERROR frame can no longer follow
+    try:
+        filename, segment_id = request["filename"], request["segment_id"]
+        segment = timed_read_segment(
+            base_path,
+            filename,
+            segment_id,
+            request.get("is_compressed", False),
+            request.get("accept_encoding", ()),
+            request.get("offset", 0),
+            request.get("length"),
+            request.get("object"),
+            segment_cache,
+        )
+        if segment is None:
+            with send_lock:
+                replying = True
+                protocol.send_frame(
+                    client_socket,
+                    protocol.ERROR,
+                    request_id,
+                    {"error": "Segment not found"},
+                )
+            record_served("mux", segment, started)
+            logging.warning(f"Segment {segment_id} of {filename} not found")
+            return
+
+        try:
+            with send_lock:
+                replying = True
+                try:
+                    client_socket.sendall(
+                        protocol.pack_frame_header(
+                            protocol.SEGMENT,
+                            request_id,
+                            {
+                                "checksum": segment.checksum,
+                                "encoding": segment.encoding,
+                                "offset": segment.offset,
+                            },
+                            segment.size,
+                        )
+                    )
+                    send_segment(client_socket, segment)
+                except Exception:
+                    drop_connection(client_socket)  # before another reply can follow the partial one
+                    raise
+        finally:
+            segment.close()
+        record_served("mux", segment, started)
+        logging.info(f"Sent segment {segment_id} of {filename}")
+    except Exception as e:
+        REQUESTS.inc(protocol="mux", result="error")
+        logging.error(f"Error serving request {request_id}: {e}")
+        if not replying:
+            try:
+                with send_lock:
+                    protocol.send_frame(
+                        client_socket,
+                        protocol.ERROR,
+                        request_id,
+                        {"error": f"Server error: {e}"},
+                    )
+            except OSError:
+                pass
+
+
+def handle_multiplexed(client_socket, base_path):
+    client_socket.sendall(protocol.pack_hello())
+    send_lock = Lock()
+    # Each connection has its own workers, so a client that reads its replies
+    # slowly holds up only its own requests, never those of other clients
+    request_pool = ThreadPoolExecutor(max_workers=MAX_INFLIGHT_REQUESTS)
+    queued = BoundedSemaphore(MAX_QUEUED_REQUESTS)
+    try:
+        while True:
+            try:
+                kind, request_id, request, _ = protocol.recv_frame_header(
+                    client_socket
+                )
+            except ConnectionError:
+                break
+            if kind != protocol.REQUEST:
+                raise protocol.ProtocolError(f"Unexpected frame kind {kind}")
+            queued.acquire()  # stop reading requests the connection is not keeping up with
+            future = request_pool.submit(
+                serve_frame_request,
+                client_socket,
+                send_lock,
+                base_path,
+                request_id,
+                request,
+            )
+            future.add_done_callback(lambda _: queued.release())
+    finally:
+        # Let replies that are still being sent finish before the socket closes
+        request_pool.shutdown(wait=True)
+
+
+def handle_client(client_socket, base_path):
+    OPEN_CONNECTIONS.inc()
+    try:
+        prefix = protocol.recv_exact(client_socket, protocol.HELLO.size)
+        if prefix.startswith(protocol.MAGIC):
+            version = protocol.unpack_hello(prefix)
+            if version != protocol.PROTOCOL_VERSION:
+                raise protocol.ProtocolError(f"Unsupported protocol version {version}")
+            CONNECTIONS.inc(protocol="mux")
+            handle_multiplexed(client_socket, base_path)
+        else:
+            CONNECTIONS.inc(protocol="text")
+            data = prefix + client_socket.recv(1024)
+            handle_text_request(client_socket, base_path, data.decode())
     except Exception as e:
         logging.error(f"Error handling client: {e}")
     finally:
+        OPEN_CONNECTIONS.dec()
         client_socket.close()
 
 
-def run_server(port, base_path):
+def run_server(port, base_path, backlog=LISTEN_BACKLOG, cache_size=SEGMENT_CACHE_SIZE):
+    global segment_cache, metered_cache
+    if cache_size:
+        segment_cache = metered_cache = SegmentCache(cache_size)
+        segment_cache.start_reporting()
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
     server_socket.bind(("0.0.0.0", port))
-    server_socket.listen(5)
+    server_socket.listen(backlog)
     logging.info(f"Minor server listening on port {port}")
 
     while True:
@@ -68,18 +467,281 @@ def run_server(port, base_path):
         client_handler.start()
 
 
-if __name__ == "__main__":
-    import sys
+class AsyncMinorServer:
+    """asyncio serving engine: one event loop instead of a thread per connection.
+
+    At most `max_requests` requests are served at once across all connections,
+    segment reads run on a bounded thread pool, and every reply waits on
+    `drain()` so a slow reader holds back its own writer instead of buffering.
+    Hits in the segment cache still go through the pool, since the lookup
+    stats the stored file.
+    """
 
-    if len(sys.argv) != 3:
-        print("Usage: python minor_server.py <port> <base_path>")
-        sys.exit(1)
+    def __init__(self, base_path, max_requests=MAX_CONCURRENT_REQUESTS,
+                 read_workers=READ_WORKERS, cache_size=SEGMENT_CACHE_SIZE):
+        self.base_path = base_path
+        self.max_requests = max_requests
+        self.read_pool = ThreadPoolExecutor(max_workers=read_workers)
+        self.limiter = None
+        self.cache = SegmentCache(cache_size) if cache_size else None
 
-    port = int(sys.argv[1])
-    base_path = sys.argv[2]
-    run_server(port, base_path)
+    async def read_segment(self, filename, segment_id, is_compressed,
+                           accept_encoding=(), offset=0, length=None, object_name=None):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.read_pool,
+            timed_read_segment,
+            self.base_path,
+            filename,
+            segment_id,
+            is_compressed,
+            accept_encoding,
+            offset,
+            length,
+            object_name,
+            self.cache,
+        )
+
+    async def send_segment(self, writer, segment):
+        """Write a segment body (if any) and wait until the transport drains."""
+        if segment is None:
+            await writer.drain()
+            return
+        try:
+            if segment.file is not None:
+                await writer.drain()
+                if not segment.size:
+                    return  # loop.sendfile rejects a zero count
+                loop = asyncio.get_running_loop()
+                sent = await loop.sendfile(
+                    writer.transport, segment.file, segment.offset, segment.size
+                )
+                if sent != segment.size:
+                    raise ConnectionError(
+                        f"Segment file ended after {sent} of {segment.size} bytes"
+                    )
+            else:
+                writer.write(segment.data)
+                await writer.drain()
+        finally:
+            segment.close()
+
+    async def handle_client(self, reader, writer):
+        OPEN_CONNECTIONS.inc()
+        try:
+            prefix = await reader.readexactly(protocol.HELLO.size)
+            if prefix.startswith(protocol.MAGIC):
+                version = protocol.unpack_hello(prefix)
+                if version != protocol.PROTOCOL_VERSION:
+                    raise protocol.ProtocolError(
+                        f"Unsupported protocol version {version}"
+                    )
+                CONNECTIONS.inc(protocol="mux")
+                await self.handle_multiplexed(reader, writer)
+            else:
+                CONNECTIONS.inc(protocol="text")
+                data = prefix + await reader.read(1024)
+                await self.handle_text_request(writer, data.decode())
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            logging.error(f"Error handling client: {e}")
+        finally:
+            OPEN_CONNECTIONS.dec()
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def handle_text_request(self, writer, data):
+        request = parse_text_request(data)
+        if request is None:
+            return
+
+        started = time.perf_counter()
+        filename, segment_id, is_compressed = request
+        async with self.limiter:
+            segment = await self.read_segment(filename, segment_id, is_compressed)
+            writer.write(text_reply_header(segment))
+            await self.send_segment(writer, segment)
+        record_served("text", segment, started)
+        if segment is not None:
+            logging.info(f"Sent segment {segment_id} of {filename}")
+        else:
+            logging.warning(f"Segment {segment_id} of {filename} not found")
+
+    async def handle_multiplexed(self, reader, writer):
+        writer.write(protocol.pack_hello())
+        await writer.drain()
+        write_lock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                try:
+                    kind, request_id, request, _ = await protocol.read_frame_header(
+                        reader
+                    )
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                if kind != protocol.REQUEST:
+                    raise protocol.ProtocolError(f"Unexpected frame kind {kind}")
+                task = asyncio.ensure_future(
+                    self.serve_frame_request(writer, write_lock, request_id, request)
+                )
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            # Let replies that are still being sent finish before the socket closes
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def serve_frame_request(self, writer, write_lock, request_id, request):
+        started = time.perf_counter()
+        replying = False  # once a reply is being written, an ERROR frame can no longer follow
+        try:
+            filename, segment_id = request["filename"], request["segment_id"]
+            async with self.limiter:
+                segment = await self.read_segment(
+                    filename,
+                    segment_id,
+                    request.get("is_compressed", False),
+                    request.get("accept_encoding", ()),
+                    request.get("offset", 0),
+                    request.get("length"),
+                    request.get("object"),
+                )
+                async with write_lock:
+                    replying = True
+                    try:
+                        if segment is None:
+                            writer.write(
+                                protocol.pack_frame_header(
+                                    protocol.ERROR,
+                                    request_id,
+                                    {"error": "Segment not found"},
+                                )
+                            )
+                        else:
+                            writer.write(
+                                protocol.pack_frame_header(
+                                    protocol.SEGMENT,
+                                    request_id,
+                                    {
+                                        "checksum": segment.checksum,
+                                        "encoding": segment.encoding,
+                                        "offset": segment.offset,
+                                    },
+                                    segment.size,
+                                )
+                            )
+                        await self.send_segment(writer, segment)
+                    except Exception:
+                        writer.transport.abort()  # before another reply can follow the partial one
+                        raise
+            record_served("mux", segment, started)
+            if segment is None:
+                logging.warning(f"Segment {segment_id} of {filename} not found")
+            else:
+                logging.info(f"Sent segment {segment_id} of {filename}")
+        except Exception as e:
+            REQUESTS.inc(protocol="mux", result="error")
+            logging.error(f"Error serving request {request_id}: {e}")
+            if not replying:
+                async with write_lock:
+                    writer.write(
+                        protocol.pack_frame_header(
+                            protocol.ERROR,
+                            request_id,
+                            {"error": f"Server error: {e}"},
+                        )
+                    )
+                    try:
+                        await self.send_segment(writer, None)
+                    except ConnectionError:
+                        pass
+
+    async def serve(self, port, backlog=LISTEN_BACKLOG):
+        global metered_cache
+        self.limiter = asyncio.Semaphore(self.max_requests)
+        if self.cache is not None:
+            metered_cache = self.cache
+            self.cache.start_reporting()
+        server = await asyncio.start_server(
+            self.handle_client, "0.0.0.0", port, backlog=backlog
+        )
+        logging.info(f"Async minor server listening on port {port}")
+        async with server:
+            await server.serve_forever()
+
+
+def run_async_server(port, base_path, backlog=LISTEN_BACKLOG,
+                     max_requests=MAX_CONCURRENT_REQUESTS, read_workers=READ_WORKERS,
+                     cache_size=SEGMENT_CACHE_SIZE):
+    server = AsyncMinorServer(base_path, max_requests, read_workers, cache_size)
+    asyncio.run(server.serve(port, backlog))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Minor segment server")
+    parser.add_argument("port", type=int, help="Port to listen on")
+    parser.add_argument("base_path", help="Directory holding this server's segments")
+    parser.add_argument(
+        "--async",
+        dest="use_async",
+        action="store_true",
+        help="Serve with the asyncio engine instead of a thread per connection",
+    )
+    parser.add_argument(
+        "--backlog",
+        type=int,
+        default=LISTEN_BACKLOG,
+        help="Listen backlog for pending connections",
+    )
+    parser.add_argument(
+        "--max-requests",
+        type=int,
+        default=MAX_CONCURRENT_REQUESTS,
+        help="Async engine: requests served concurrently",
+    )
+    parser.add_argument(
+        "--read-workers",
+        type=int,
+        default=READ_WORKERS,
+        help="Async engine: threads reading segments from disk",
+    )
+    parser.add_argument(
+        "--cache-mb",
+        type=float,
+        help="Keep up to this many MB of hot segments in memory, ready to send",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=METRICS_PORT,
+        help="Serve metrics on this local port",
+    )
+    args = parser.parse_args()
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+    cache_size = int(args.cache_mb * 1024 * 1024) if args.cache_mb else SEGMENT_CACHE_SIZE
+
+    if args.use_async:
+        run_async_server(
+            args.port, args.base_path, args.backlog, args.max_requests, args.read_workers,
+            cache_size,
+        )
+    else:
+        run_server(args.port, args.base_path, args.backlog, cache_size)
+
+
+if __name__ == "__main__":
+    main()
 
 # Example usage:
 # python minor_server.py 8001 server1_segments
 # python minor_server.py 8002 server2_segments
 # python minor_server.py 8003 server3_segments
+# python minor_server.py 8001 server1_segments --async --backlog 1024
+# python minor_server.py 8001 server1_segments --cache-mb 512
+# python minor_server.py 8001 server1_segments --metrics-port 9101
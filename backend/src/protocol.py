@@ -0,0 +1,177 @@
+"""Framing shared by server.py, minor_server.py and client.py.
+
+A multiplexed connection starts with a HELLO (magic + protocol version) sent by
+the client and echoed back by the server. After that both sides exchange
+frames:
+
+    kind (B) | request id (I) | meta length (H) | body length (Q) | meta | body
+
+`meta` is a small JSON object and `body` is raw segment bytes. Requests only
+carry meta. Replies are tagged with the id of the request they answer, so many
+requests can be in flight on one connection and replies may arrive in any
+order. Connections that do not start with the magic are served with the old
+one-shot text protocol.
+
+GET_SEGMENT requests may list the transfer encodings the client can decode in
+`accept_encoding`. A minor server whose stored segment is already in one of
+them sends the stored bytes unchanged and names the encoding in the reply meta
+(`encoding`); the checksum then covers the encoded bytes.
+
+A request may also carry an `offset` to resume a partly received segment.
+Servers honour it only for unencoded replies and echo the offset they applied
+in the reply meta; the body then starts there, while the checksum still covers
+the whole segment. Adding a `length` turns it into a range request, used to
+re-fetch just the blocks of a segment that failed verification.
+
+Files cut into content-defined chunks share their stored chunks with other
+files, so their segments are requested by the chunk's `object` name, given
+in the file info, rather than by filename and segment id. The one-shot text
+protocol cannot name objects.
+
+The main server (port 8000) speaks a simpler framing. A connection starts
+with MAIN_MAGIC, and then every request and every reply is a JSON message
+prefixed with its length (I). Requests are answered in order, and the
+connection stays open for more until the client closes it. Connections that
+do not start with the magic carry one bare JSON request, and the reply is
+sent unframed before the server closes the connection.
+"""
+import json
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+MAGIC = b"FDMX"
+PROTOCOL_VERSION = 1
+HELLO = struct.Struct("!4sB")
+FRAME_HEADER = struct.Struct("!BIHQ")
+
+# Frame kinds
+REQUEST = 1
+SEGMENT = 2
+ERROR = 3
+
+IDENTITY = "identity"
+
+MAIN_MAGIC = b"FDMJ"
+MESSAGE_HEADER = struct.Struct("!I")
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def supported_encodings():
+    """Transfer encodings this process can decode, in order of preference."""
+    encodings = ["zlib"]
+    if zstandard is not None:
+        encodings.append("zstd")
+    if lz4 is not None:
+        encodings.append("lz4")
+    return encodings
+
+
+def decoder(encoding):
+    """Return an incremental decoder with `decompress(chunk)` for `encoding`."""
+    if encoding == "zlib":
+        return zlib.decompressobj()
+    if encoding == "zstd" and zstandard is not None:
+        return zstandard.ZstdDecompressor().decompressobj()
+    if encoding == "lz4" and lz4 is not None:
+        return lz4.frame.LZ4FrameDecompressor()
+    raise ProtocolError(f"Unsupported transfer encoding {encoding}")
+
+
+def pack_hello(version=PROTOCOL_VERSION):
+    return HELLO.pack(MAGIC, version)
+
+
+def unpack_hello(data):
+    magic, version = HELLO.unpack(data)
+    if magic != MAGIC:
+        raise ProtocolError("Peer does not speak the multiplexed protocol")
+    return version
+
+
+def recv_exact(sock, size):
+    buf = bytearray(size)
+    view = memoryview(buf)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if not n:
+            raise ConnectionError("Connection closed by peer")
+        received += n
+    return bytes(buf)
+
+
+def recv_chunks(sock, view, size):
+    """Receive `size` bytes into `view`, yielding the filled slice after each read.
+
+    The same buffer is reused for every read, so each slice must be consumed
+    before the next one is requested.
+    """
+    remaining = size
+    while remaining:
+        n = sock.recv_into(view[: min(len(view), remaining)])
+        if not n:
+            raise ConnectionError("Connection closed by peer")
+        remaining -= n
+        yield view[:n]
+
+
+def pack_frame_header(kind, request_id, meta, body_length=0):
+    """Return the frame header and meta; the body is sent separately."""
+    meta_bytes = json.dumps(meta).encode()
+    return FRAME_HEADER.pack(kind, request_id, len(meta_bytes), body_length) + meta_bytes
+
+
+def send_frame(sock, kind, request_id, meta, body=b""):
+    sock.sendall(pack_frame_header(kind, request_id, meta, len(body)))
+    if body:
+        sock.sendall(body)
+
+
+def recv_frame_header(sock):
+    """Read a frame header and its meta, leaving the body on the socket."""
+    kind, request_id, meta_length, body_length = FRAME_HEADER.unpack(
+        recv_exact(sock, FRAME_HEADER.size)
+    )
+    meta = json.loads(recv_exact(sock, meta_length)) if meta_length else {}
+    return kind, request_id, meta, body_length
+
+
+async def read_frame_header(reader):
+    """asyncio counterpart of recv_frame_header for an asyncio.StreamReader."""
+    kind, request_id, meta_length, body_length = FRAME_HEADER.unpack(
+        await reader.readexactly(FRAME_HEADER.size)
+    )
+    meta = json.loads(await reader.readexactly(meta_length)) if meta_length else {}
+    return kind, request_id, meta, body_length
+
+
+def pack_message(message):
+    """A JSON message for the main server, prefixed with its length."""
+    data = json.dumps(message).encode()
+    return MESSAGE_HEADER.pack(len(data)) + data
+
+
+def recv_message(sock, max_size=None):
+    (length,) = MESSAGE_HEADER.unpack(recv_exact(sock, MESSAGE_HEADER.size))
+    if max_size is not None and length > max_size:
+        raise ProtocolError(f"Message of {length} bytes is over the {max_size} byte limit")
+    return json.loads(recv_exact(sock, length))
+
+
+async def read_message(reader):
+    """asyncio counterpart of recv_message for an asyncio.StreamReader."""
+    (length,) = MESSAGE_HEADER.unpack(await reader.readexactly(MESSAGE_HEADER.size))
+    return json.loads(await reader.readexactly(length))
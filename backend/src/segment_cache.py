@@ -0,0 +1,152 @@
+"""In-memory cache of hot segments for a minor server.
+
+A cached segment is held as the bytes a reply carries, in the encoding it is
+sent in, together with the checksum the reply header needs. A hit therefore
+skips the open, the checksum sidecar and, for compressed segments sent
+decoded, the decompression and hashing.
+
+The cache holds at most `max_bytes` of segments and evicts the least recently
+used first. Each entry remembers the inode, size and mtime of the stored file
+it was read from, and of its checksum sidecar when it has one, and a lookup
+stats them: a segment rewritten or removed by the main server is read again
+instead of served stale. When several
+requests miss on the same segment at once, one of them reads it and the
+others wait for that read.
+"""
+import logging
+import os
+from collections import OrderedDict
+from concurrent.futures import Future
+from threading import Thread, Lock, Event
+
+MAX_ENTRY_SHARE = 0.25  # largest share of the budget one segment may take
+REPORT_INTERVAL = 60  # seconds between hit-rate lines in the log
+
+
+class CachedSegment:
+    def __init__(self, signature, data, checksum):
+        self.signature = signature  # (inode, size, mtime) of the stored file, then of its sidecar
+        self.data = data
+        self.checksum = checksum
+
+
+def file_signature(st):
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def path_signature(path, sidecar=None):
+    signature = file_signature(os.stat(path))
+    if sidecar is not None:
+        try:
+            signature += file_signature(os.stat(sidecar))
+        except FileNotFoundError:
+            pass  # written by the first load
+    return signature
+
+
+class SegmentCache:
+    def __init__(self, max_bytes, max_entry_share=MAX_ENTRY_SHARE):
+        self.max_bytes = max_bytes
+        self.max_entry = int(max_bytes * max_entry_share)
+        self.lock = Lock()
+        self.entries = OrderedDict()  # key -> CachedSegment, least recently used first
+        self.loading = {}  # key -> Future of a read in progress
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0  # misses served by another request's read
+        self.evictions = 0
+        self.stopped = Event()
+
+    def get(self, key, path, load, sidecar=None):
+        """Return the CachedSegment for `key`, stored at `path`, or None if it is gone.
+
+        On a miss `load(path)` is called, once however many requests are
+        waiting, and must return a CachedSegment. A `sidecar` the entry was
+        also read from, such as its checksum, must be unchanged too for a hit.
+        """
+        try:
+            signature = path_signature(path, sidecar)
+        except FileNotFoundError:
+            self.discard(key)
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.signature == signature:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            future = self.loading.get(key)
+            if future is not None:
+                self.coalesced += 1
+                waiting = True
+            else:
+                future = self.loading[key] = Future()
+                self.misses += 1
+                waiting = False
+        if waiting:
+            return future.result()
+        try:
+            entry = load(path)
+        except BaseException as e:
+            with self.lock:
+                del self.loading[key]
+            future.set_exception(e)
+            raise
+        with self.lock:
+            del self.loading[key]
+            self.store(key, entry)
+        future.set_result(entry)
+        return entry
+
+    def store(self, key, entry):
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.bytes -= len(old.data)
+        if len(entry.data) > self.max_entry:
+            return
+        self.entries[key] = entry
+        self.bytes += len(entry.data)
+        while self.bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= len(evicted.data)
+            self.evictions += 1
+
+    def discard(self, key):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old.data)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def start_reporting(self, interval=REPORT_INTERVAL):
+        Thread(target=self.report, args=(interval,), daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def report(self, interval):
+        last = None
+        while not self.stopped.wait(interval):
+            stats = self.stats()
+            if stats == last:
+                continue  # nothing was served since the last line
+            last = stats
+            logging.info(
+                f"Segment cache: {stats['hit_rate']:.1%} hits "
+                f"({stats['hits']} hits, {stats['misses']} misses, "
+                f"{stats['coalesced']} coalesced), {stats['entries']} segments, "
+                f"{stats['bytes'] / (1024 * 1024):.1f} MB, {stats['evictions']} evicted"
+            )
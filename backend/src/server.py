@@ -1,12 +1,21 @@
 import socket
 import json
-from threading import Thread
+from threading import Thread, Lock
 import logging
 import os
 import math
 import zlib
 import time
 import hashlib
+import argparse
+import shutil
+import io
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError
+
+import metrics
+import protocol
+from file_index import FileIndex
+from metadata_store import MetadataStore
 
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
@@ -14,6 +23,7 @@ logging.basicConfig(
 
 MAIN_SERVER_PORT = 8000
 BASE_SEGMENT_SIZE = 5 * 1024 * 1024  # 5MB base segment size
+READ_CHUNK_SIZE = 1024 * 1024  # 1MB read buffer used while segmenting
 MINOR_SERVERS = [
     {"host": "localhost", "port": 8001, "dir": "server1_segments"},
     {"host": "localhost", "port": 8002, "dir": "server2_segments"},
@@ -22,21 +32,57 @@ MINOR_SERVERS = [
 FILE_DIR = "data"
 CACHE_FILE = "segment_cache.json"
 CACHE_EXPIRY = 3600  # 1 hour
+EVICTION_INTERVAL = 60  # seconds between eviction sweeps
+DISK_BUDGET = None  # bytes of segments allowed in each minor server directory; None = no cap
+EVICTION_POLICY = "lru"  # "lru": least recently accessed first; "lfu": fewest hits first
+DOWNLOAD_LEASE = 15 * 60  # seconds after a lookup or a segment read during which a file is never evicted
+LEASE_DIR = ".leases"  # per-file markers minor servers touch while serving the file's segments
+SEGMENT_WORKERS = 1  # processes used to build segments; 1 = serial, raise with --segment-workers
+CHECKSUM_SUFFIX = ".md5"  # sidecar read by minor servers instead of rehashing
+BLOCK_SIZE = 64 * 1024  # content bytes covered by each manifest block hash
+BLOCK_HASH = "blake2b" if "blake2b" in hashlib.algorithms_available else "md5"
+REPLICATION_FACTOR = 1  # minor servers holding a copy of each segment; raise with --replication
+MIN_FREE_SPACE = 100 * 1024 * 1024  # disk left free on a minor server after placing a segment
+LOAD_HALF_LIFE = 60  # seconds for observed download load on a minor server to halve
+SEGMENTATION_WAIT = 10  # seconds a request waits on another's segmentation before answering
+SEGMENTATION_POLL_HINT = 2  # seconds a client is told to wait before asking again
+CHUNKING = "fixed"  # "fixed": equal segments per file; "cdc": content-defined chunks shared across files
+CDC_MIN_SIZE = 512 * 1024  # no content-defined cut closer than this to the start of a chunk
+CDC_MAX_SIZE = 4 * 1024 * 1024  # chunks are cut here when the content offers no cut point
+CDC_ANCHOR = b"\n"  # candidate cut points follow this byte
+CDC_WINDOW = 64  # bytes before a candidate whose hash decides whether to cut there
+CDC_CUT_MASK = 0xFFF  # a candidate is a cut when these bits of its window hash are clear
+GEAR_BITS = (1 << 64) - 1  # width of the gear hash used where the content has no anchors
+GEAR = [int.from_bytes(hashlib.md5(bytes([b])).digest()[:8], "big") for b in range(256)]  # fixed across runs
+GEAR_CUT_MASK = CDC_CUT_MASK << (64 - CDC_CUT_MASK.bit_length())  # top bits: they cover the last 64 bytes
+CHUNK_PREFIX = "chunk_"  # stored name of a content-addressed chunk, followed by its hash
+UPDATE_SIZE_RATIO = 2  # a changed file keeps its segment size while within this factor of a fresh one
+LIST_PAGE_SIZE = 1000  # files per list_files reply when the request names no limit
+LIST_MAX_PAGE = 10000  # most files one list_files reply may hold
+MAX_REQUEST_SIZE = 64 * 1024  # largest request accepted on port 8000
+IDLE_TIMEOUT = 60  # seconds a framed connection may wait between requests
+METRICS_PORT = None  # local port serving metrics; None = no endpoint
+LOG_PAYLOADS = False  # log every request and reply in full, segment lists included
 
 
-def load_cache():
-    if os.path.exists(CACHE_FILE):
-        with open(CACHE_FILE, "r") as f:
-            return json.load(f)
-    return {}
-
-
-def save_cache(cache):
-    with open(CACHE_FILE, "w") as f:
-        json.dump(cache, f)
+store = MetadataStore(CACHE_FILE)
+file_index = FileIndex(FILE_DIR)
 
-
-cache = load_cache()
+REQUESTS = metrics.counter("fdl_server_requests_total", "Requests answered", ["type", "result"])
+REQUEST_SECONDS = metrics.histogram("fdl_server_request_seconds", "Time to answer a request", ["type"])
+METADATA_LOOKUPS = metrics.counter(
+    "fdl_server_metadata_lookups_total",
+    "get_file_info lookups: hit (segments current), miss (segmentation needed) or not_found",
+    ["result"],
+)
+SEGMENTATION_SECONDS = metrics.histogram(
+    "fdl_server_segmentation_seconds", "Time to segment a file, or bring its segments up to date",
+    buckets=metrics.SEGMENTATION_BUCKETS,
+)
+SEGMENTED_BYTES = metrics.counter("fdl_server_segmented_bytes_total", "Source bytes segmented")
+EVICTED_FILES = metrics.counter("fdl_server_evicted_files_total", "Files whose segments were evicted")
+CONNECTIONS = metrics.counter("fdl_server_connections_total", "Connections accepted", ["protocol"])
+OPEN_CONNECTIONS = metrics.gauge("fdl_server_open_connections", "Connections being served")
 
 
 def is_text_file(filename):
@@ -44,128 +90,964 @@ def is_text_file(filename):
     return ext.lower() in [".txt", ".xml", ".json", ".csv"]
 
 
-def compress_data(data):
-    return zlib.compress(data)
-
-
 def calculate_checksum(data):
     return hashlib.md5(data).hexdigest()
 
 
-def create_segments(filename):
-    file_path = os.path.join(FILE_DIR, filename)
-    file_size = os.path.getsize(file_path)
-    num_segments = math.ceil(file_size / BASE_SEGMENT_SIZE)
-    segment_size = math.ceil(file_size / num_segments)
+def new_block_hash(algorithm):
+    if algorithm == "blake2b":
+        return hashlib.blake2b(digest_size=16)
+    return hashlib.new(algorithm)
 
-    segments = []
-    for i in range(num_segments):
-        start = i * segment_size
-        end = min((i + 1) * segment_size, file_size)
-        server = MINOR_SERVERS[i % len(MINOR_SERVERS)]
-        segment = {"id": i + 1, "start": start, "end": end, "server": server}
-        segments.append(segment)
-
-        # Create segment file
-        segment_file = os.path.join(server["dir"], f"{filename}_segment_{i+1}")
-        with open(file_path, "rb") as src, open(segment_file, "wb") as dst:
-            src.seek(start)
-            data = src.read(end - start)
-            if is_text_file(filename):
-                data = compress_data(data)
+
+class BlockHasher:
+    """Hashes a byte stream in fixed-size blocks, whatever the chunking of updates."""
+
+    def __init__(self, block_size=BLOCK_SIZE, algorithm=BLOCK_HASH):
+        self.block_size = block_size
+        self.algorithm = algorithm
+        self.digests = []
+        self.current = new_block_hash(algorithm)
+        self.filled = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        while view:
+            n = min(len(view), self.block_size - self.filled)
+            self.current.update(view[:n])
+            self.filled += n
+            view = view[n:]
+            if self.filled == self.block_size:
+                self.digests.append(self.current.hexdigest())
+                self.current = new_block_hash(self.algorithm)
+                self.filled = 0
+
+    def finish(self):
+        if self.filled:
+            self.digests.append(self.current.hexdigest())
+        return self.digests
+
+
+def manifest_root(digests, algorithm=BLOCK_HASH):
+    """Root of a list of block (or segment root) digests."""
+    root = new_block_hash(algorithm)
+    for digest in digests:
+        root.update(bytes.fromhex(digest))
+    return root.hexdigest()
+
+
+def tree_checksum(content_checksums):
+    """Root hash of a file: the MD5 of its segments' content digests, in order.
+
+    Clients rebuild it from the digests they compute while downloading, so the
+    whole file is verified without reading it back.
+    """
+    return hashlib.md5(b"".join(bytes.fromhex(c) for c in content_checksums)).hexdigest()
+
+
+def temp_path(path):
+    return f"{path}.{os.getpid()}.tmp"
+
+
+def publish_segment(temp_file, temp_sidecar, segment_file):
+    """Rename a segment written under temporary names, and its sidecar, into place.
+
+    A minor server still sending the previous version keeps reading it from
+    its open descriptor, so a rewrite never shortens or mixes a reply.
+    """
+    os.replace(temp_sidecar, segment_file + CHECKSUM_SUFFIX)
+    os.replace(temp_file, segment_file)
+
+
+def write_segment(src, segment_file, length, compress, buf, file_hash=None):
+    """Stream `length` bytes from `src` into `segment_file` through `buf`.
+
+    Returns the segment's checksums: `checksum` of the stored bytes,
+    `content_checksum` of its original content (the same for uncompressed
+    segments), and the manifest `blocks` hashes of the content with their
+    `root`. All of them, and `file_hash` if given, are updated chunk by chunk,
+    so memory use is bounded by the size of `buf` rather than the segment.
+    The stored checksum is also written to a sidecar file so minor servers
+    can send the segment as-is without hashing it per request. Both are
+    written under temporary names and then renamed into place.
+    """
+    view = memoryview(buf)
+    segment_hash = hashlib.md5()
+    content_hash = hashlib.md5() if compress else segment_hash
+    blocks = BlockHasher()
+    compressor = zlib.compressobj() if compress else None
+    temp_file = temp_path(segment_file)
+    with open(temp_file, "wb") as dst:
+        remaining = length
+        while remaining > 0:
+            n = src.readinto(view[: min(len(buf), remaining)])
+            if not n:
+                raise IOError(f"Unexpected end of file while writing {segment_file}")
+            remaining -= n
+            data = view[:n]
+            if file_hash is not None:
+                file_hash.update(data)
+            blocks.update(data)
+            if compressor:
+                content_hash.update(data)
+                data = compressor.compress(data)
+            segment_hash.update(data)
+            dst.write(data)
+        if compressor:
+            data = compressor.flush()
+            segment_hash.update(data)
             dst.write(data)
+    checksum = segment_hash.hexdigest()
+    temp_sidecar = temp_path(segment_file + CHECKSUM_SUFFIX)
+    with open(temp_sidecar, "w") as f:
+        f.write(checksum)
+    publish_segment(temp_file, temp_sidecar, segment_file)
+    block_digests = blocks.finish()
+    return {
+        "checksum": checksum,
+        "content_checksum": content_hash.hexdigest(),
+        "blocks": block_digests,
+        "root": manifest_root(block_digests),
+    }
+
+
+def segment_path(filename, segment, server=None):
+    server = server or segment["server"]
+    if "object" in segment:
+        return os.path.join(server["dir"], segment["object"])
+    return os.path.join(server["dir"], f"{filename}_segment_{segment['id']}")
+
+
+def replica_servers(segment):
+    """Servers holding a segment; entries cached before replication only have one."""
+    return segment.get("replicas") or [segment["server"]]
+
+
+def replicate_segment(segment_file, replica_files):
+    """Copy a freshly written segment and its checksum sidecar to the other replicas."""
+    for replica_file in replica_files:
+        temp_file = temp_path(replica_file)
+        temp_sidecar = temp_path(replica_file + CHECKSUM_SUFFIX)
+        shutil.copyfile(segment_file, temp_file)
+        shutil.copyfile(segment_file + CHECKSUM_SUFFIX, temp_sidecar)
+        publish_segment(temp_file, temp_sidecar, replica_file)
+
+
+def server_key(server):
+    return (server["host"], server["port"])
+
+
+class Placement:
+    """Chooses the minor servers holding each segment, and the order clients try them in.
+
+    Load is the segment bytes this server has recently pointed clients at,
+    decaying with LOAD_HALF_LIFE. New segments go to the least loaded
+    servers with disk space to spare, and every get_file_info reply lists a
+    segment's replicas least loaded first, so a hot file's downloads spread
+    over all of its copies.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.load = {}
+        self.updated = time.time()
+
+    def decay(self):
+        now = time.time()
+        factor = 0.5 ** ((now - self.updated) / LOAD_HALF_LIFE)
+        for key in self.load:
+            self.load[key] *= factor
+        self.updated = now
+
+    def free_space(self, server):
+        try:
+            return shutil.disk_usage(server["dir"]).free
+        except OSError:
+            return 0
+
+    def place(self, sizes, replication=None):
+        """Return a replica list, best first, for each segment size in `sizes`."""
+        replication = min(replication or REPLICATION_FACTOR, len(MINOR_SERVERS))
+        free = {server_key(s): self.free_space(s) for s in MINOR_SERVERS}
+        stored = {server_key(s): 0 for s in MINOR_SERVERS}
+        with self.lock:
+            self.decay()
+            load = {server_key(s): self.load.get(server_key(s), 0.0) for s in MINOR_SERVERS}
+        placements = []
+        for size in sizes:
+            candidates = [
+                s for s in MINOR_SERVERS if free[server_key(s)] - size >= MIN_FREE_SPACE
+            ]
+            if not candidates:
+                raise IOError("No minor server has enough free disk space")
+            # Spread the copies by bytes stored, then lead with the least loaded
+            candidates.sort(key=lambda s: (stored[server_key(s)], load[server_key(s)],
+                                           -free[server_key(s)]))
+            replicas = sorted(candidates[:replication], key=lambda s: load[server_key(s)])
+            load[server_key(replicas[0])] += size
+            for server in replicas:
+                stored[server_key(server)] += size
+                free[server_key(server)] -= size
+            placements.append(replicas)
+        return placements
+
+    def order(self, segments):
+        """Segments with their replicas least loaded first; the first one is charged for the download."""
+        ordered = []
+        with self.lock:
+            self.decay()
+            for segment in segments:
+                replicas = sorted(
+                    replica_servers(segment), key=lambda s: self.load.get(server_key(s), 0.0)
+                )
+                key = server_key(replicas[0])
+                self.load[key] = self.load.get(key, 0.0) + segment["end"] - segment["start"]
+                ordered.append(dict(segment, server=replicas[0], replicas=replicas))
+        return ordered
+
+
+placement = Placement()
+
+
+_segment_pool = None
+
+
+def start_segment_pool():
+    """Fork the SEGMENT_WORKERS segment builders now.
+
+    A forked child keeps only the thread that forked it, with every lock as
+    it was at that moment, so forking once request threads run could hand a
+    worker a logging or store lock that is never released. main() therefore
+    starts the pool before it starts any thread; the first submit forks all
+    of the workers at once.
+    """
+    global _segment_pool
+    _segment_pool = ProcessPoolExecutor(max_workers=SEGMENT_WORKERS)
+    _segment_pool.submit(int).result()
+    return _segment_pool
+
+
+def get_segment_pool():
+    # Started here only when server.py is used as a library (benches, tests)
+    if _segment_pool is None:
+        return start_segment_pool()
+    return _segment_pool
+
+
+def build_segment(file_path, segment_file, replica_files, start, length, compress):
+    """Pool worker: read one range of the source and write its segment files."""
+    buf = bytearray(max(1, min(READ_CHUNK_SIZE, length)))
+    with open(file_path, "rb") as src:
+        src.seek(start)
+        result = write_segment(src, segment_file, length, compress, buf)
+    replicate_segment(segment_file, replica_files)
+    return result
+
+
+def replica_paths(filename, segment):
+    return [segment_path(filename, segment, server) for server in segment["replicas"][1:]]
+
+
+def fixed_segment_size(file_size):
+    """Size of the equal segments a file of `file_size` bytes is cut into."""
+    num_segments = max(1, math.ceil(file_size / BASE_SEGMENT_SIZE))
+    return math.ceil(file_size / num_segments)
+
+
+def fixed_segments(file_path, filename, file_size, compress):
+    """Cut a file into equal segments of its own: (segments, segment size, file checksum)."""
+    num_segments = max(1, math.ceil(file_size / BASE_SEGMENT_SIZE))
+    segment_size = fixed_segment_size(file_size)
+
+    bounds = [
+        (i * segment_size, min((i + 1) * segment_size, file_size))
+        for i in range(num_segments)
+    ]
+    placements = placement.place([end - start for start, end in bounds])
+    segments = [
+        {"id": i + 1, "start": start, "end": end, "server": replicas[0], "replicas": replicas}
+        for i, ((start, end), replicas) in enumerate(zip(bounds, placements))
+    ]
+
+    file_hash = hashlib.md5()
+    write_segments(file_path, filename, segments, compress, file_hash)
+    return segments, segment_size, file_hash.hexdigest()
+
+
+def can_update(old, compress, file_size):
+    """Whether a changed file's previous fixed segments can be compared block by block.
+
+    Only while the old segment size stays close to the one a fresh
+    segmentation would pick: a small file that grew would otherwise be cut
+    into a great many tiny segments.
+    """
+    manifest = old.get("manifest") or {}
+    old_size = old.get("segment_size") or 0
+    new_size = fixed_segment_size(file_size)
+    return (
+        manifest.get("chunking", "fixed") == "fixed"
+        and new_size / UPDATE_SIZE_RATIO <= old_size <= new_size * UPDATE_SIZE_RATIO
+        and manifest.get("algorithm") == BLOCK_HASH
+        and manifest.get("block_size") == BLOCK_SIZE
+        and old["is_compressed"] == compress
+        and all("blocks" in segment for segment in old["segments"])
+    )
+
+
+def write_segments(file_path, filename, segments, compress, file_hash=None):
+    """Write the given segments of a file, in worker processes when SEGMENT_WORKERS allows.
+
+    `file_hash`, if given, is fed the whole source, so pass it only with all
+    of a file's segments.
+    """
+    if SEGMENT_WORKERS > 1 and len(segments) > 1:
+        # Workers compress and hash segments concurrently, each writing
+        # straight into its minor server directory, while this process
+        # streams the whole-file hash (MD5 cannot be split across workers).
+        pool = get_segment_pool()
+        futures = [
+            pool.submit(
+                build_segment,
+                file_path,
+                segment_path(filename, segment),
+                replica_paths(filename, segment),
+                segment["start"],
+                segment["end"] - segment["start"],
+                compress,
+            )
+            for segment in segments
+        ]
+        if file_hash is not None:
+            with open(file_path, "rb") as src:
+                for chunk in iter(lambda: src.read(READ_CHUNK_SIZE), b""):
+                    file_hash.update(chunk)
+        for segment, future in zip(segments, futures):
+            segment.update(future.result())
+        return
+
+    # Single sequential pass over the source: each chunk feeds the whole-file
+    # hash, the current segment's hash and its segment file.
+    buf = bytearray(READ_CHUNK_SIZE)
+    with open(file_path, "rb") as src:
+        for segment in segments:
+            src.seek(segment["start"])
+            segment.update(write_segment(
+                src,
+                segment_path(filename, segment),
+                segment["end"] - segment["start"],
+                compress,
+                buf,
+                file_hash,
+            ))
+            replicate_segment(segment_path(filename, segment), replica_paths(filename, segment))
+
+
+def update_segments(file_path, filename, file_size, compress, old):
+    """Re-segment a changed file, rewriting only the segments whose content changed.
+
+    The previous segment size is kept, so segments keep their ranges and an
+    edit only touches the segments it falls in. One pass hashes the new
+    content block by block; a segment whose range and block hashes match the
+    old one is kept as it is, with its replicas. The rest are written again
+    and renamed over the old files, so a client still fetching the old
+    version gets it whole and sees a checksum mismatch, never mixed content.
+    Returns (segments, segment size, file checksum, ids of rewritten segments).
+    """
+    segment_size = old["segment_size"]
+    num_segments = max(1, math.ceil(file_size / segment_size))
+    previous = {segment["id"]: segment for segment in old["segments"]}
+    file_hash = hashlib.md5()
+    segments = []
+    changed = []
+    with open(file_path, "rb") as src:
+        for i in range(num_segments):
+            start, end = i * segment_size, min((i + 1) * segment_size, file_size)
+            blocks = BlockHasher()
+            for chunk in iter(lambda: src.read(min(READ_CHUNK_SIZE, end - src.tell())), b""):
+                file_hash.update(chunk)
+                blocks.update(chunk)
+            segment = previous.get(i + 1)
+            if segment is None or (segment["start"], segment["end"]) != (start, end) \
+                    or segment["blocks"] != blocks.finish():
+                changed.append({"id": i + 1, "start": start, "end": end})
+                segment = changed[-1]
+            segments.append(segment)
+
+    new = [segment for segment in changed if segment["id"] not in previous]
+    for segment, replicas in zip(new, placement.place([s["end"] - s["start"] for s in new])):
+        segment.update(server=replicas[0], replicas=replicas)
+    for segment in changed:
+        if segment["id"] in previous:
+            old_segment = previous[segment["id"]]
+            segment.update(server=old_segment["server"], replicas=replica_servers(old_segment))
+    write_segments(file_path, filename, changed, compress)
+    return segments, segment_size, file_hash.hexdigest(), [s["id"] for s in changed]
+
+
+def find_cut(data, start):
+    """End of the content-defined chunk starting at `start` in `data`.
+
+    Candidate cut points are the positions just after a CDC_ANCHOR byte, at
+    least CDC_MIN_SIZE into the chunk; the first one whose preceding
+    CDC_WINDOW bytes hash with CDC_CUT_MASK clear ends the chunk. Finding
+    anchors with bytes.find and hashing only the windows before them keeps
+    the scan in C, unlike a rolling hash updated byte by byte. A cut depends
+    only on the bytes just before it, so after an edit the following cuts,
+    and the chunks between them, come out the same as before. Content with
+    no anchored cut before CDC_MAX_SIZE, such as binary formats or text
+    without newlines, is cut by a gear hash instead (see gear_cut). Without
+    either the chunk ends at CDC_MAX_SIZE or at the end of `data`.
+    """
+    limit = min(len(data), start + CDC_MAX_SIZE)
+    pos = start + CDC_MIN_SIZE
+    while pos < limit:
+        pos = data.find(CDC_ANCHOR, pos, limit)
+        if pos < 0:
+            break
+        pos += 1
+        if zlib.crc32(data[pos - CDC_WINDOW:pos]) & CDC_CUT_MASK == 0:
+            return pos
+    return gear_cut(data, start, limit) or limit
 
-        segment["checksum"] = calculate_checksum(data)
 
-    file_checksum = calculate_checksum(open(file_path, "rb").read())
+def gear_cut(data, start, limit):
+    """First gear-hash cut between CDC_MIN_SIZE into the chunk at `start` and `limit`, or None.
 
-    cache[filename] = {
+    The hash takes one shift and one table lookup per byte, and its top bits
+    depend on the last 64 bytes only, so a cut is found again after an edit
+    like an anchored one. It runs in Python, but only from CDC_MIN_SIZE on,
+    and a cut turns up about every CDC_CUT_MASK + 1 bytes.
+    """
+    pos = start + CDC_MIN_SIZE
+    if pos >= limit or data.count(data[pos:pos + 1], pos, limit) == limit - pos:
+        return None  # a run of one byte value hashes the same all along
+    h = 0
+    for byte in data[max(start, pos - CDC_WINDOW):pos]:
+        h = ((h << 1) + GEAR[byte]) & GEAR_BITS
+    for pos in range(pos, limit):
+        h = ((h << 1) + GEAR[data[pos]]) & GEAR_BITS
+        if not h & GEAR_CUT_MASK:
+            return pos + 1
+    return None
+
+
+def content_chunks(src):
+    """Yield the content-defined chunks of an open file in order; an empty file is one empty chunk."""
+    data, start, eof = b"", 0, False
+    while True:
+        # Keep at least one whole chunk buffered so cuts never depend on reads
+        while not eof and len(data) - start < CDC_MAX_SIZE:
+            more = src.read(4 * CDC_MAX_SIZE)
+            eof = not more
+            data, start = data[start:] + more, 0
+        end = find_cut(data, start)
+        yield data[start:end]
+        start = end
+        if eof and start == len(data):
+            return
+
+
+chunk_store_lock = Lock()  # held while chunks are added to or removed from the shared store
+
+
+def chunk_holders(name):
+    """Minor servers holding chunk `name`, with both its data and its sidecar in place."""
+    return [
+        s for s in MINOR_SERVERS
+        if os.path.exists(os.path.join(s["dir"], name))
+        and os.path.exists(os.path.join(s["dir"], name) + CHECKSUM_SUFFIX)
+    ]
+
+
+def store_chunk(chunk, compress, buf):
+    """Add one chunk to the shared store unless a minor server already holds it.
+
+    Returns its segment fields: the object name it is stored and requested
+    under, its content hash, the servers holding it and its checksums.
+    """
+    chunk_hash = new_block_hash(BLOCK_HASH)
+    chunk_hash.update(chunk)
+    digest = chunk_hash.hexdigest()
+    name = CHUNK_PREFIX + digest + (".z" if compress else "")
+    replicas = chunk_holders(name)
+    if replicas:
+        with open(os.path.join(replicas[0]["dir"], name) + CHECKSUM_SUFFIX) as f:
+            checksum = f.read().strip()
+        blocks = BlockHasher()
+        blocks.update(chunk)
+        block_digests = blocks.finish()
+        fields = {
+            "checksum": checksum,
+            "content_checksum": calculate_checksum(chunk),
+            "blocks": block_digests,
+            "root": manifest_root(block_digests),
+        }
+    else:
+        replicas = placement.place([len(chunk)])[0]
+        chunk_file = os.path.join(replicas[0]["dir"], name)
+        fields = write_segment(io.BytesIO(chunk), chunk_file, len(chunk), compress, buf)
+        replicate_segment(chunk_file, [os.path.join(s["dir"], name) for s in replicas[1:]])
+    return dict(fields, object=name, chunk=digest, server=replicas[0], replicas=replicas)
+
+
+def chunk_segments(file_path, compress):
+    """Cut a file into content-defined chunks, storing the ones no minor server has yet.
+
+    Returns the file's segments, one per chunk, and the file's checksum.
+    """
+    file_hash = hashlib.md5()
+    buf = bytearray(READ_CHUNK_SIZE)
+    segments = []
+    offset = 0
+    with open(file_path, "rb") as src, chunk_store_lock:
+        for chunk in content_chunks(src):
+            file_hash.update(chunk)
+            segment = {"id": len(segments) + 1, "start": offset, "end": offset + len(chunk)}
+            segment.update(store_chunk(chunk, compress, buf))
+            segments.append(segment)
+            offset += len(chunk)
+    return segments, file_hash.hexdigest()
+
+
+def source_stat(file_path):
+    """What identifies a version of a source file without reading it."""
+    stat = os.stat(file_path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "inode": stat.st_ino}
+
+
+def source_changed(filename, info):
+    """Whether a file in FILE_DIR may differ from what its cached segments were built from."""
+    try:
+        return info.get("source") != source_stat(os.path.join(FILE_DIR, filename))
+    except OSError:
+        return True
+
+
+def create_segments(filename):
+    """Segment a file, or bring the segments of a changed file up to date.
+
+    A file segmented before is compared with its old segments block by block
+    when it was cut into fixed segments, and only the changed segments are
+    rewritten. With content-defined chunking the file is chunked again, and
+    only chunks the store does not hold yet are written. Stored files the
+    new version no longer uses are removed.
+    """
+    started = time.perf_counter()
+    file_path = os.path.join(FILE_DIR, filename)
+    compress = is_text_file(filename)
+    source = source_stat(file_path)
+    old = store.get(filename)
+    if CHUNKING == "cdc":
+        segments, file_checksum = chunk_segments(file_path, compress)
+        file_size = segments[-1]["end"]
+        segment_size = max(s["end"] - s["start"] for s in segments)
+    elif old is not None and can_update(old, compress, source["size"]):
+        file_size = source["size"]
+        segments, segment_size, file_checksum, changed = update_segments(
+            file_path, filename, file_size, compress, old
+        )
+        logging.info(f"Updated {filename}: rewrote {len(changed)} of {len(segments)} segments")
+    else:
+        file_size = source["size"]
+        segments, segment_size, file_checksum = fixed_segments(file_path, filename, file_size, compress)
+
+    file_info = {
         "segments": segments,
-        "total_segments": num_segments,
+        "total_segments": len(segments),
         "segment_size": segment_size,
         "file_size": file_size,
-        "is_compressed": is_text_file(filename),
+        "is_compressed": compress,
         "last_accessed": time.time(),
         "checksum": file_checksum,
+        "version": file_checksum,
+        "source": source,
+        "tree_checksum": tree_checksum(s["content_checksum"] for s in segments),
+        "manifest": {
+            "algorithm": BLOCK_HASH,
+            "block_size": BLOCK_SIZE,
+            "root": manifest_root(s["root"] for s in segments),
+            "chunking": CHUNKING,
+        },
     }
-    save_cache(cache)
-    return cache[filename]
+    store.put(filename, file_info)
+    if old is not None:
+        remove_unreferenced(filename, old)
+    SEGMENTATION_SECONDS.observe(time.perf_counter() - started)
+    SEGMENTED_BYTES.inc(file_size)
+    return file_info
+
+
+def stored_files(filename, info):
+    """(server, path) of every file kept on minor servers for one segmented file."""
+    for segment in info["segments"]:
+        for server in replica_servers(segment):
+            segment_file = segment_path(filename, segment, server)
+            for path in (segment_file, segment_file + CHECKSUM_SUFFIX):
+                yield server, path
+
+
+def stored_bytes(filename, info, server):
+    total = 0
+    for holder, path in stored_files(filename, info):
+        if server_key(holder) == server_key(server) and os.path.exists(path):
+            total += os.path.getsize(path)
+    return total
+
+
+def directory_usage(path):
+    with os.scandir(path) as entries:
+        return sum(e.stat().st_size for e in entries if e.is_file())
+
+
+def remove_unreferenced(filename, info):
+    """Delete what `info` kept on minor servers that no stored file uses any more.
+
+    That is everything for an evicted file, and for a changed one whatever
+    its new version dropped. Only chunks are shared between files, so other
+    files are only looked at when `info` has some.
+    """
+    with chunk_store_lock:
+        others = store.items() if any("object" in s for s in info["segments"]) else []
+        current = store.get(filename)
+        if current is not None:
+            others.append((filename, current))
+        used = {path for other, other_info in others for _, path in stored_files(other, other_info)}
+        for _, path in stored_files(filename, info):
+            if path not in used and os.path.exists(path):
+                os.remove(path)
+
+
+def last_segment_read(filename, info):
+    """When a minor server last served a segment of the file, from its lease marker; 0 if never."""
+    holders = {server_key(s): s for segment in info["segments"] for s in replica_servers(segment)}
+    last = 0
+    for server in holders.values():
+        try:
+            last = max(last, os.stat(os.path.join(server["dir"], LEASE_DIR, filename)).st_mtime)
+        except OSError:
+            pass
+    return last
+
+
+def remove_lease_markers(filename, info):
+    holders = {server_key(s): s for segment in info["segments"] for s in replica_servers(segment)}
+    for server in holders.values():
+        try:
+            os.remove(os.path.join(server["dir"], LEASE_DIR, filename))
+        except FileNotFoundError:
+            pass
+
+
+def evict(filename):
+    """Drop a file's segments and metadata; return False if it is in use.
+
+    A file looked up, or with a segment served by a minor server, within
+    DOWNLOAD_LEASE may still be downloading, so it is kept. Minor servers
+    renew the lease as they serve segments, so a download that runs longer
+    than the lease keeps its file for as long as it keeps fetching. The
+    lookup check and the delete are one step in the store, so a lookup
+    either renews the lease first or finds the file gone. The segments are
+    removed under the file's lock, which segmentation also takes, so the
+    file is not segmented again until they are gone.
+    """
+    with store.file_lock(filename):
+        info = store.get(filename)
+        if info is None or time.time() - last_segment_read(filename, info) < DOWNLOAD_LEASE:
+            return False
+        info = store.delete_idle(filename, DOWNLOAD_LEASE)
+        if info is None:
+            return False
+        remove_unreferenced(filename, info)
+        remove_lease_markers(filename, info)
+    EVICTED_FILES.inc()
+    logging.info(f"Evicted segments of {filename}")
+    return True
+
+
+def eviction_order(items):
+    """Cached files, the first to evict first, according to EVICTION_POLICY."""
+    if EVICTION_POLICY == "lfu":
+        key = lambda item: (item[1].get("hits", 0), item[1]["last_accessed"])
+    else:
+        key = lambda item: item[1]["last_accessed"]
+    return sorted(items, key=key)
 
 
 def cleanup_unused_segments():
+    """One eviction sweep: expired files, then files over a directory's DISK_BUDGET."""
     current_time = time.time()
-    for filename, info in list(cache.items()):
+    for filename, info in store.items():
         if current_time - info["last_accessed"] > CACHE_EXPIRY:
-            for segment in info["segments"]:
-                segment_file = os.path.join(
-                    segment["server"]["dir"], f"{filename}_segment_{segment['id']}"
-                )
-                if os.path.exists(segment_file):
-                    os.remove(segment_file)
-            del cache[filename]
-    save_cache(cache)
+            evict(filename)
 
+    if DISK_BUDGET is None:
+        return
+    for server in MINOR_SERVERS:
+        if not os.path.isdir(server["dir"]):
+            continue
+        excess = directory_usage(server["dir"]) - DISK_BUDGET
+        if excess <= 0:
+            continue
+        for filename, info in eviction_order(store.items()):
+            held = stored_bytes(filename, info, server)
+            if held and evict(filename):
+                excess -= held
+                if excess <= 0:
+                    break
+        if excess > 0:
+            logging.warning(
+                f"{server['dir']} is {excess} bytes over its budget; "
+                f"the remaining files are in use"
+            )
 
-def list_available_files():
-    return [
-        {"name": f, "size": os.path.getsize(os.path.join(FILE_DIR, f))}
-        for f in os.listdir(FILE_DIR)
-        if os.path.isfile(os.path.join(FILE_DIR, f))
-    ]
 
+def eviction_daemon():
+    while True:
+        try:
+            cleanup_unused_segments()
+        except Exception as e:
+            logging.error(f"Error evicting segments: {e}")
+        time.sleep(EVICTION_INTERVAL)
+
+
+def list_files(request):
+    """One page of the available files, in name order.
+
+    `cursor` is the `next_cursor` of the previous page; `prefix` and the
+    glob `pattern` filter the names.
+    """
+    limit = request.get("limit")
+    limit = LIST_PAGE_SIZE if limit is None else int(limit)
+    if limit < 1:
+        raise ValueError(f"limit must be at least 1, got {limit}")
+    limit = min(limit, LIST_MAX_PAGE)
+    files, next_cursor = file_index.page(
+        request.get("cursor"), limit, request.get("prefix"), request.get("pattern")
+    )
+    return {"files": files, "next_cursor": next_cursor}
+
+
+_segmentations = {}  # filename -> Future of the create_segments call in progress
+_segmentations_lock = Lock()
+
+
+def segment_once(filename, timeout=SEGMENTATION_WAIT):
+    """Segment a file, or a changed file again, once however many requests ask for it at the same time.
+
+    The first request runs create_segments; the others wait on its result
+    for up to `timeout` seconds. Returns the file info, or None if it is
+    still being built when the wait runs out.
+    """
+    with _segmentations_lock:
+        file_info = store.get(filename)
+        if file_info is not None and not source_changed(filename, file_info):
+            return file_info  # finished just before we got the lock
+        future = _segmentations.get(filename)
+        leader = future is None
+        if leader:
+            future = _segmentations[filename] = Future()
+
+    if not leader:
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            return None
 
-def handle_client(client_socket):
     try:
-        data = client_socket.recv(1024).decode()
-        request = json.loads(data)
-        logging.info(f"Received request: {request}")
+        # Under the file's lock so an eviction cannot remove what is being written
+        with store.file_lock(filename):
+            future.set_result(create_segments(filename))
+    except Exception as e:
+        future.set_exception(e)
+    finally:
+        with _segmentations_lock:
+            del _segmentations[filename]
+    return future.result()
+
+
+def get_file_info(filename):
+    file_info = store.touch(filename)
+    # A stat is enough to notice that the source changed since it was segmented
+    if file_info is None or source_changed(filename, file_info):
+        if file_index.get(filename) is None:
+            METADATA_LOOKUPS.inc(result="not_found")
+            return {"error": "File not found"}
+        METADATA_LOOKUPS.inc(result="miss")
+        file_info = segment_once(filename)
+        if file_info is None:
+            return {"status": "segmenting", "retry_after": SEGMENTATION_POLL_HINT}
+    else:
+        METADATA_LOOKUPS.inc(result="hit")
+
+    return {
+        "filename": filename,
+        "total_segments": file_info["total_segments"],
+        "segment_size": file_info["segment_size"],
+        "file_size": file_info["file_size"],
+        "segments": placement.order(file_info["segments"]),
+        "is_compressed": file_info["is_compressed"],
+        "checksum": file_info["checksum"],
+        "version": file_info.get("version", file_info["checksum"]),
+        "tree_checksum": file_info.get("tree_checksum"),
+        "manifest": file_info.get("manifest"),
+    }
 
-        if request["type"] == "get_file_info":
-            filename = request["filename"]
-            if filename not in cache:
-                if filename not in [f["name"] for f in list_available_files()]:
-                    response = {"error": "File not found"}
-                else:
-                    file_info = create_segments(filename)
-            else:
-                file_info = cache[filename]
-                file_info["last_accessed"] = time.time()
-                save_cache(cache)
-
-            if "error" not in locals():
-                response = {
-                    "filename": filename,
-                    "total_segments": file_info["total_segments"],
-                    "segment_size": file_info["segment_size"],
-                    "file_size": file_info["file_size"],
-                    "segments": file_info["segments"],
-                    "is_compressed": file_info["is_compressed"],
-                    "checksum": file_info["checksum"],
-                }
-        elif request["type"] == "list_files":
-            files = list_available_files()
-            response = {"files": files}
+
+def summarize(response):
+    """A one-line description of a reply, for the log when LOG_PAYLOADS is off."""
+    if "error" in response:
+        return f"error: {response['error']}"
+    if "segments" in response:
+        return f"{response['filename']}: {response['total_segments']} segments"
+    if "files" in response:
+        return f"{len(response['files'])} files"
+    return str(response)
+
+
+def handle_request(request):
+    started = time.perf_counter()
+    if LOG_PAYLOADS:
+        logging.info(f"Received request: {request}")
+    try:
+        request_type = request["type"]
+        if request_type == "get_file_info":
+            response = get_file_info(request["filename"])
+        elif request_type == "list_files":
+            response = list_files(request)
         else:
+            request_type = "invalid"
             response = {"error": "Invalid request type"}
-
-        client_socket.sendall(json.dumps(response).encode())
+    except (KeyError, TypeError, ValueError) as e:
+        request_type = "invalid"
+        response = {"error": f"Invalid request: {e}"}
+    except OSError as e:
+        # No minor server with room for the segments, a source that vanished, ...
+        logging.error(f"Error answering {request}: {e}")
+        response = {"error": f"Server error: {e}"}
+    if LOG_PAYLOADS:
         logging.info(f"Sent response: {response}")
+    else:
+        logging.info(f"Answered {request_type}: {summarize(response)}")
+    result = "error" if "error" in response else response.get("status", "ok")
+    REQUESTS.inc(type=request_type, result=result)
+    REQUEST_SECONDS.observe(time.perf_counter() - started, type=request_type)
+    return response
+
+
+def read_bare_request(client_socket, data):
+    """Read an unframed JSON request that starts with `data`, however many reads it takes."""
+    while True:
+        try:
+            return json.loads(data)
+        except ValueError:
+            if len(data) > MAX_REQUEST_SIZE:
+                raise
+        chunk = client_socket.recv(4096)
+        if not chunk:
+            raise ValueError("Connection closed before the request was complete")
+        data += chunk
+
+
+def handle_client(client_socket):
+    OPEN_CONNECTIONS.inc()
+    try:
+        head = protocol.recv_exact(client_socket, len(protocol.MAIN_MAGIC))
+        if head != protocol.MAIN_MAGIC:
+            # An older client: one bare request, answered before closing
+            CONNECTIONS.inc(protocol="bare")
+            response = handle_request(read_bare_request(client_socket, head))
+            client_socket.sendall(json.dumps(response).encode())
+            return
+        CONNECTIONS.inc(protocol="framed")
+        client_socket.settimeout(IDLE_TIMEOUT)
+        while True:
+            try:
+                request = protocol.recv_message(client_socket, MAX_REQUEST_SIZE)
+            except (ConnectionError, socket.timeout):
+                return  # the client is done with the connection
+            client_socket.sendall(protocol.pack_message(handle_request(request)))
     except Exception as e:
         logging.error(f"Error handling client: {e}")
     finally:
+        OPEN_CONNECTIONS.dec()
         client_socket.close()
 
 
 def main():
+    global SEGMENT_WORKERS, REPLICATION_FACTOR, DISK_BUDGET, EVICTION_POLICY, EVICTION_INTERVAL, CHUNKING
+    global LOG_PAYLOADS
+
+    parser = argparse.ArgumentParser(description="Main file server")
+    parser.add_argument(
+        "--segment-workers",
+        type=int,
+        default=SEGMENT_WORKERS,
+        help="Worker processes used to build segments (1 = serial)",
+    )
+    parser.add_argument(
+        "--replication",
+        type=int,
+        default=REPLICATION_FACTOR,
+        help="Minor servers holding a copy of each new segment",
+    )
+    parser.add_argument(
+        "--disk-budget-mb",
+        type=int,
+        help="Most segment data kept in each minor server directory",
+    )
+    parser.add_argument(
+        "--eviction-policy",
+        choices=["lru", "lfu"],
+        default=EVICTION_POLICY,
+        help="Which files to evict first when a directory is over budget",
+    )
+    parser.add_argument(
+        "--eviction-interval",
+        type=int,
+        default=EVICTION_INTERVAL,
+        help="Seconds between eviction sweeps",
+    )
+    parser.add_argument(
+        "--chunking",
+        choices=["fixed", "cdc"],
+        default=CHUNKING,
+        help="Segment new files into fixed ranges, or content-defined chunks shared across files",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=METRICS_PORT,
+        help="Serve metrics on this local port",
+    )
+    parser.add_argument(
+        "--log-payloads",
+        action="store_true",
+        help="Log every request and reply in full instead of a one-line summary",
+    )
+    args = parser.parse_args()
+    SEGMENT_WORKERS = max(1, args.segment_workers)
+    REPLICATION_FACTOR = max(1, args.replication)
+    if args.disk_budget_mb is not None:
+        DISK_BUDGET = args.disk_budget_mb * 1024 * 1024
+    EVICTION_POLICY = args.eviction_policy
+    EVICTION_INTERVAL = args.eviction_interval
+    CHUNKING = args.chunking
+    LOG_PAYLOADS = LOG_PAYLOADS or args.log_payloads
+
     for server in MINOR_SERVERS:
         os.makedirs(server["dir"], exist_ok=True)
+    if SEGMENT_WORKERS > 1:
+        start_segment_pool()  # before any thread starts
+    store.start()
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
 
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.bind(("0.0.0.0", MAIN_SERVER_PORT))
     server_socket.listen(5)
     logging.info(f"Main server listening on port {MAIN_SERVER_PORT}")
 
-    cleanup_thread = Thread(target=cleanup_unused_segments)
+    cleanup_thread = Thread(target=eviction_daemon)
     cleanup_thread.daemon = True
     cleanup_thread.start()
 
@@ -181,3 +1063,8 @@ if __name__ == "__main__":
 
 # Example usage:
 # python server.py
+# python server.py --segment-workers 4
+# python server.py --replication 3
+# python server.py --disk-budget-mb 2048 --eviction-policy lfu
+# python server.py --chunking cdc
+# python server.py --metrics-port 9100
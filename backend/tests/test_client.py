@@ -0,0 +1,182 @@
+import os
+import socket
+import sys
+import time
+import unittest
+from threading import Event, Thread
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import client  # noqa: E402
+import protocol  # noqa: E402
+
+
+class RecordingSink:
+    def __init__(self):
+        self.data = bytearray()
+        self.closed = False
+
+    def write(self, chunk):
+        if self.closed:
+            raise AssertionError("write to a sink its requester already gave up on")
+        self.data += chunk
+
+    def satisfied(self):
+        return False
+
+    def finish(self):
+        pass
+
+
+class SlowMuxServer:
+    """Answers every request with `size` bytes, `chunk` at a time every `interval`.
+
+    With `hold_first`, the reply to the first request only starts once the
+    second request has arrived, as if the server had stalled until then.
+    Requests marked `"ignore": True` are never answered.
+    """
+
+    def __init__(self, size, chunk, interval, hold_first=False):
+        self.size, self.chunk, self.interval, self.hold_first = size, chunk, interval, hold_first
+        self.listener = socket.create_server(("localhost", 0))
+        self.port = self.listener.getsockname()[1]
+        self.finished = Event()
+        Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        conn, _ = self.listener.accept()
+        with conn:
+            protocol.recv_exact(conn, protocol.HELLO.size)
+            conn.sendall(protocol.pack_hello())
+            while True:
+                try:
+                    _, request_id, request, _ = protocol.recv_frame_header(conn)
+                    if request_id == 1 and self.hold_first:
+                        held = protocol.recv_frame_header(conn)[1]
+                        self.reply(conn, request_id)
+                        request_id = held
+                except ConnectionError:
+                    break
+                if not request.get("ignore"):
+                    self.reply(conn, request_id)
+        self.finished.set()
+
+    def reply(self, conn, request_id):
+        conn.sendall(protocol.pack_frame_header(
+            protocol.SEGMENT, request_id, {"checksum": "", "encoding": "identity"}, self.size))
+        for _ in range(self.size // self.chunk):
+            conn.sendall(b"x" * self.chunk)
+            time.sleep(self.interval)
+
+
+class MuxTimeoutTest(unittest.TestCase):
+    def setUp(self):
+        self.timeout = client.REQUEST_TIMEOUT
+        client.REQUEST_TIMEOUT = 0.5
+
+    def tearDown(self):
+        client.REQUEST_TIMEOUT = self.timeout
+
+    def test_reply_slower_than_timeout_completes_while_it_progresses(self):
+        server = SlowMuxServer(size=20 * 1024, chunk=1024, interval=0.1)  # about 2 s
+        connection = client.MuxConnection("localhost", server.port)
+        try:
+            sink = RecordingSink()
+            _, received = connection.request({"segment_id": 1}, lambda meta: sink)
+            self.assertIs(received, sink)
+            self.assertEqual(len(sink.data), 20 * 1024)
+        finally:
+            connection.close()
+
+    def test_abandoned_reply_is_drained_without_touching_its_sink(self):
+        server = SlowMuxServer(size=4 * 1024, chunk=1024, interval=0, hold_first=True)
+        connection = client.MuxConnection("localhost", server.port)
+        try:
+            stalled = RecordingSink()
+            with self.assertRaises(TimeoutError):
+                connection.request({"segment_id": 2}, lambda meta: stalled)
+            stalled.closed = True  # as the caller closing its file would
+            # The late reply is sent once the next request arrives, ahead of its own reply
+            sink = RecordingSink()
+            _, received = connection.request({"segment_id": 3}, lambda meta: sink)
+            self.assertEqual(len(received.data), 4 * 1024)
+            self.assertEqual(len(stalled.data), 0)
+        finally:
+            connection.close()
+
+    def test_unanswered_request_times_out_while_other_replies_arrive(self):
+        server = SlowMuxServer(size=20 * 1024, chunk=1024, interval=0.1)  # about 2 s
+        connection = client.MuxConnection("localhost", server.port)
+        timed_out = []
+
+        def unanswered():
+            try:
+                connection.request({"ignore": True}, lambda meta: RecordingSink())
+            except TimeoutError:
+                timed_out.append(time.monotonic())
+
+        try:
+            waiter = Thread(target=unanswered)
+            waiter.start()
+            connection.request({"segment_id": 2}, lambda meta: RecordingSink())
+            answered = time.monotonic()
+            waiter.join()
+            self.assertEqual(len(timed_out), 1)
+            self.assertLess(timed_out[0], answered)
+        finally:
+            connection.close()
+
+
+class StubDownloader:
+    """Stands in for a FileDownloader whose segments are never actually fetched."""
+
+    def __init__(self, filename, segments):
+        self.filename = filename
+        self.segments = segments
+        self.file_size = sum(s['end'] - s['start'] for s in segments)
+        self.downloaded_segments = set()
+        self.chunk_index = None
+        self.output_fd = None
+        self.pbar = self
+        self.scheduler = None
+
+    def resumed_bytes(self):
+        return 0
+
+    def open_output(self):
+        self.output_fd = -1
+
+    def close_output(self):
+        self.output_fd = None
+
+    def close(self):
+        pass
+
+    def finish_download(self):
+        return True
+
+
+class BatchSchedulerTest(unittest.TestCase):
+    def test_stolen_segment_is_claimed_for_its_file(self):
+        a = {"host": "a", "port": 1}
+        b = {"host": "b", "port": 2}
+        f0 = StubDownloader("f0", [
+            {"id": i, "start": i * 10, "end": i * 10 + 10, "server": a} for i in range(2)])
+        # f1 can only start on server B by being stolen from A's queue
+        f1 = StubDownloader("f1", [
+            {"id": i, "start": i * 10, "end": i * 10 + 10, "server": a, "replicas": [a, b]}
+            for i in range(3)])
+        scheduler = client.BatchScheduler([f0, f1], max_server_concurrency=2)
+        jobs = [scheduler.next_segment() for _ in range(3)]
+        key, entry = jobs[2]
+        self.assertEqual(key, client.server_key(b))
+        self.assertIs(entry.downloader, f1)
+        self.assertIsNotNone(f1.output_fd)
+        self.assertEqual(scheduler.file_in_flight, {f0: 2, f1: 1})
+        for key, entry in jobs:
+            scheduler.finish(key, entry, entry.size, 0.01)
+        self.assertEqual(scheduler.file_in_flight, {f0: 0, f1: 0})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,199 @@
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+import urllib.request
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC_DIR)
+
+import client  # noqa: E402
+import minor_server  # noqa: E402
+import protocol  # noqa: E402
+import server  # noqa: E402
+from file_index import FileIndex  # noqa: E402
+from metadata_store import MetadataStore  # noqa: E402
+from segment_cache import SegmentCache  # noqa: E402
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def start_minor_server(port, base_path, *flags):
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(SRC_DIR, "minor_server.py"), str(port), base_path, *flags],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("localhost", port), timeout=1).close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.kill()
+    raise RuntimeError(f"Minor server on port {port} did not start")
+
+
+class MinorServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.scratch = tempfile.TemporaryDirectory()
+        root = self.scratch.name
+        server.FILE_DIR = os.path.join(root, "data")
+        os.makedirs(server.FILE_DIR)
+        server.file_index = FileIndex(server.FILE_DIR)
+        server.store = MetadataStore(os.path.join(root, "segment_cache.json"))
+        server.SEGMENT_WORKERS = 1
+        server.REPLICATION_FACTOR = 1
+        self.port = free_port()
+        server.MINOR_SERVERS = [
+            {"host": "localhost", "port": self.port, "dir": os.path.join(root, "server1")}
+        ]
+        os.makedirs(server.MINOR_SERVERS[0]["dir"])
+
+    def tearDown(self):
+        self.scratch.cleanup()
+
+
+class EmptyFileTest(MinorServerTestCase):
+    def setUp(self):
+        super().setUp()
+        open(os.path.join(server.FILE_DIR, "empty.bin"), "wb").close()
+
+    def download(self, *flags):
+        """Download empty.bin; the minor server must count its one request as served."""
+        info = server.create_segments("empty.bin")
+        metrics_port = free_port()
+        proc = start_minor_server(self.port, server.MINOR_SERVERS[0]["dir"],
+                                  "--metrics-port", str(metrics_port), *flags)
+        try:
+            output = os.path.join(self.scratch.name, "out.bin")
+            downloader = client.FileDownloader("empty.bin", output, None, None, file_info=info)
+            self.assertTrue(downloader.download())
+            self.assertEqual(os.path.getsize(output), 0)
+            # The empty body is all the client sees either way, so ask the server
+            scraped = urllib.request.urlopen(f"http://127.0.0.1:{metrics_port}/metrics").read().decode()
+            self.assertIn('fdl_minor_requests_total{protocol="mux",result="ok"} 1', scraped)
+            self.assertNotIn('result="error"', scraped)
+        finally:
+            proc.terminate()
+            proc.wait()
+
+    def test_threaded_engine(self):
+        self.download()
+
+    def test_async_engine(self):
+        self.download("--async")
+
+
+class SlowReaderTest(MinorServerTestCase):
+    STALLED_CONNECTIONS = 12
+    REQUESTS_PER_CONNECTION = 8
+
+    def setUp(self):
+        super().setUp()
+        with open(os.path.join(server.FILE_DIR, "big.bin"), "wb") as f:
+            f.write(os.urandom(4 * 1024 * 1024))
+        self.info = server.create_segments("big.bin")
+
+    def request(self, sock, request_id):
+        request = {"filename": "big.bin", "segment_id": self.info["segments"][0]["id"],
+                   "is_compressed": False}
+        sock.sendall(protocol.pack_frame_header(protocol.REQUEST, request_id, request))
+
+    def connect(self, rcvbuf=None):
+        sock = socket.create_connection(("localhost", self.port), timeout=10)
+        if rcvbuf is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        sock.sendall(protocol.pack_hello())
+        protocol.unpack_hello(protocol.recv_exact(sock, protocol.HELLO.size))
+        return sock
+
+    def check_not_starved(self, *flags):
+        """Connections that never read their replies must not hold up another client's request."""
+        proc = start_minor_server(self.port, server.MINOR_SERVERS[0]["dir"], *flags)
+        stalled = []
+        try:
+            for _ in range(self.STALLED_CONNECTIONS):
+                sock = self.connect(rcvbuf=4096)
+                stalled.append(sock)
+                for request_id in range(1, self.REQUESTS_PER_CONNECTION + 1):
+                    self.request(sock, request_id)
+            time.sleep(0.5)  # let the stalled replies fill the socket buffers
+            sock = self.connect()
+            stalled.append(sock)
+            self.request(sock, 1)
+            kind, request_id, _, length = protocol.recv_frame_header(sock)
+            self.assertEqual((kind, request_id), (protocol.SEGMENT, 1))
+            self.assertEqual(len(protocol.recv_exact(sock, length)), length)
+        finally:
+            for sock in stalled:
+                sock.close()
+            proc.terminate()
+            proc.wait()
+
+    def test_threaded_engine(self):
+        self.check_not_starved()
+
+    def test_async_engine(self):
+        self.check_not_starved("--async")
+
+
+class FailedRequestTest(MinorServerTestCase):
+    def check_error_reply(self, *flags):
+        """A request the server fails to serve is answered with an ERROR frame, not left hanging."""
+        proc = start_minor_server(self.port, server.MINOR_SERVERS[0]["dir"], *flags)
+        try:
+            with socket.create_connection(("localhost", self.port), timeout=10) as sock:
+                sock.sendall(protocol.pack_hello())
+                protocol.unpack_hello(protocol.recv_exact(sock, protocol.HELLO.size))
+                sock.sendall(protocol.pack_frame_header(protocol.REQUEST, 7, {"segment_id": 1}))
+                kind, request_id, meta, length = protocol.recv_frame_header(sock)
+                self.assertEqual((kind, request_id, length), (protocol.ERROR, 7, 0))
+                self.assertIn("Server error", meta["error"])
+        finally:
+            proc.terminate()
+            proc.wait()
+
+    def test_threaded_engine(self):
+        self.check_error_reply()
+
+    def test_async_engine(self):
+        self.check_error_reply("--async")
+
+
+class SegmentCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.scratch = tempfile.TemporaryDirectory()
+        self.cache = SegmentCache(1024 * 1024)
+
+    def tearDown(self):
+        self.scratch.cleanup()
+
+    def write(self, name, content):
+        # As server.py publishes files: written aside, then renamed into place
+        path = os.path.join(self.scratch.name, name)
+        with open(path + ".tmp", "wb") as f:
+            f.write(content)
+        os.replace(path + ".tmp", path)
+
+    def checksum(self):
+        return minor_server.read_segment(self.scratch.name, "f", 1, False, cache=self.cache).checksum
+
+    def test_rewritten_sidecar_is_not_served_from_the_cache(self):
+        self.write("f_segment_1" + minor_server.CHECKSUM_SUFFIX, b"old")
+        self.write("f_segment_1", b"x" * 100)
+        self.assertEqual(self.checksum(), "old")
+        # The sidecar of a rewrite lands before its data
+        self.write("f_segment_1" + minor_server.CHECKSUM_SUFFIX, b"new")
+        self.assertEqual(self.checksum(), "new")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+import io
+import os
+import random
+import string
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import minor_server  # noqa: E402
+import server  # noqa: E402
+from file_index import FileIndex  # noqa: E402
+from metadata_store import MetadataStore  # noqa: E402
+
+
+class ServerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.scratch = tempfile.TemporaryDirectory()
+        root = self.scratch.name
+        server.FILE_DIR = os.path.join(root, "data")
+        os.makedirs(server.FILE_DIR)
+        server.file_index = FileIndex(server.FILE_DIR)
+        server.store = MetadataStore(os.path.join(root, "segment_cache.json"))
+        server.SEGMENT_WORKERS = 1
+        server.REPLICATION_FACTOR = 1
+        server.CHUNKING = "fixed"
+        server.MINOR_SERVERS = [{"host": "localhost", "port": 1, "dir": os.path.join(root, "server1")}]
+        os.makedirs(server.MINOR_SERVERS[0]["dir"])
+
+    def tearDown(self):
+        self.scratch.cleanup()
+
+    def write_source(self, name, data):
+        path = os.path.join(server.FILE_DIR, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        # Make sure the change shows in the mtime even on coarse clocks
+        stamp = time.time_ns() + len(data)
+        os.utime(path, ns=(stamp, stamp))
+
+
+class UpdateSegmentsTest(ServerTestCase):
+    def test_segment_being_sent_keeps_its_old_bytes(self):
+        old = os.urandom(256 * 1024)
+        self.write_source("file.bin", old)
+        info = server.create_segments("file.bin")
+        path = server.segment_path("file.bin", info["segments"][0])
+        with open(path, "rb") as sending:  # as a minor server's sendfile holds it
+            new = bytearray(old)
+            new[1000:1010] = os.urandom(10)
+            self.write_source("file.bin", bytes(new))
+            server.create_segments("file.bin")
+            self.assertEqual(sending.read(), old)
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), bytes(new))
+        leftovers = [n for n in os.listdir(server.MINOR_SERVERS[0]["dir"]) if n.endswith(".tmp")]
+        self.assertEqual(leftovers, [])
+
+
+class EvictionTest(ServerTestCase):
+    def test_segment_reads_renew_the_download_lease(self):
+        self.write_source("file.bin", os.urandom(1024))
+        server.create_segments("file.bin")
+        server.store.get("file.bin")["last_accessed"] = 0  # looked up long ago
+        minor_server.lease_renewed.clear()
+        base_path = server.MINOR_SERVERS[0]["dir"]
+        segment = minor_server.timed_read_segment(base_path, "file.bin", 1, False)
+        self.assertIsNotNone(segment)
+        segment.close()
+        self.assertFalse(server.evict("file.bin"))
+
+        marker = os.path.join(base_path, server.LEASE_DIR, "file.bin")
+        expired = time.time() - server.DOWNLOAD_LEASE - 1
+        os.utime(marker, (expired, expired))
+        self.assertTrue(server.evict("file.bin"))
+        self.assertFalse(os.path.exists(marker))
+
+
+class ListFilesTest(ServerTestCase):
+    def list_files(self, **request):
+        return server.handle_request(dict(request, type="list_files"))
+
+    def test_limit(self):
+        for name in ("a.bin", "b.bin", "c.bin"):
+            self.write_source(name, b"x")
+        self.assertEqual([f["name"] for f in self.list_files(limit=2)["files"]], ["a.bin", "b.bin"])
+        self.assertEqual(len(self.list_files()["files"]), 3)
+        for limit in (0, -1, "two"):
+            self.assertTrue(self.list_files(limit=limit)["error"].startswith("Invalid request"))
+
+
+class ContentChunksTest(unittest.TestCase):
+    def setUp(self):
+        self.sizes = server.CDC_MIN_SIZE, server.CDC_MAX_SIZE
+        server.CDC_MIN_SIZE, server.CDC_MAX_SIZE = 16 * 1024, 128 * 1024
+
+    def tearDown(self):
+        server.CDC_MIN_SIZE, server.CDC_MAX_SIZE = self.sizes
+
+    def shared_after_insert(self, data):
+        before = list(server.content_chunks(io.BytesIO(data)))
+        after = list(server.content_chunks(io.BytesIO(data[:50000] + b"inserted" + data[50000:])))
+        self.assertEqual(b"".join(before), data)
+        return len(set(before) & set(after)), len(before)
+
+    def test_text_without_newlines_keeps_its_chunks_after_an_insert(self):
+        rng = random.Random(1)
+        data = "".join(rng.choice(string.ascii_uppercase) for _ in range(1024 * 1024)).encode()
+        shared, total = self.shared_after_insert(data)
+        self.assertGreaterEqual(shared, total - 2)
+
+    def test_binary_data_keeps_its_chunks_after_an_insert(self):
+        data = random.Random(2).randbytes(1024 * 1024)
+        shared, total = self.shared_after_insert(data)
+        self.assertGreaterEqual(shared, total - 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,5 @@
-import { exec } from 'child_process';
 import { NextRequest, NextResponse } from 'next/server';
-import { EventEmitter } from 'events';
-import { Readable } from 'stream';
-
-const downloadEmitter = new EventEmitter();
+import { daemonUrl } from '../../../lib/daemon';
 
 export async function POST(req: NextRequest) {
     const { filename, action } = await req.json();
@@ -12,32 +8,27 @@ export async function POST(req: NextRequest) {
         return NextResponse.json({ error: 'Filename is required' }, { status: 400 });
     }
 
+    let url: string;
+    let body: string | undefined;
     if (action === 'start') {
-        const outputFile = `downloads/${filename}`;
-        const command = `python client.py "${filename}" "${outputFile}"`;
-
-        const child = exec(command);
-
-        child.stdout?.on('data', (data) => {
-            downloadEmitter.emit('progress', { filename, data: data.toString() });
-        });
-
-        child.stderr?.on('data', (data) => {
-            downloadEmitter.emit('error', { filename, error: data.toString() });
-        });
-
-        child.on('close', (code) => {
-            downloadEmitter.emit('complete', { filename, code });
-        });
-
-        return NextResponse.json({ message: 'Download started' });
+        url = daemonUrl('downloads');
+        body = JSON.stringify({ filename });
     } else if (action === 'pause' || action === 'resume' || action === 'cancel') {
-        // These actions would require modifications to the Python client
-        // For now, we'll just return a message
-        return NextResponse.json({ message: `${action} action received for ${filename}` });
+        url = daemonUrl('downloads', filename, action);
     } else {
         return NextResponse.json({ error: 'Invalid action' }, { status: 400 });
     }
+
+    try {
+        const response = await fetch(url, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body,
+        });
+        return NextResponse.json(await response.json(), { status: response.status });
+    } catch (error) {
+        return NextResponse.json({ error: 'Download daemon unreachable' }, { status: 502 });
+    }
 }
 
 export async function GET(req: NextRequest) {
@@ -48,36 +39,18 @@ export async function GET(req: NextRequest) {
         return NextResponse.json({ error: 'Filename is required' }, { status: 400 });
     }
 
-    const stream = new ReadableStream({
-        start(controller) {
-            const listener = ({ data }: { data: string }) => {
-                controller.enqueue(`data: ${JSON.stringify({ filename, progress: data })}\n\n`);
-            };
-
-            downloadEmitter.on('progress', listener);
-
-            const errorListener = ({ error }: { error: string }) => {
-                controller.enqueue(`data: ${JSON.stringify({ filename, error })}\n\n`);
-            };
-
-            downloadEmitter.on('error', errorListener);
-
-            const completeListener = ({ code }: { code: number }) => {
-                controller.enqueue(`data: ${JSON.stringify({ filename, complete: true, code })}\n\n`);
-                controller.close();
-            };
-
-            downloadEmitter.on('complete', completeListener);
-
-            return () => {
-                downloadEmitter.off('progress', listener);
-                downloadEmitter.off('error', errorListener);
-                downloadEmitter.off('complete', completeListener);
-            };
-        },
-    });
+    // The daemon already sends structured events, so its stream is passed through
+    let upstream: Response;
+    try {
+        upstream = await fetch(`${daemonUrl('events')}?filename=${encodeURIComponent(filename)}`, {
+            cache: 'no-store',
+            signal: req.signal,
+        });
+    } catch (error) {
+        return NextResponse.json({ error: 'Download daemon unreachable' }, { status: 502 });
+    }
 
-    return new NextResponse(stream, {
+    return new NextResponse(upstream.body, {
         headers: {
             'Content-Type': 'text/event-stream',
             'Cache-Control': 'no-cache',
@@ -85,4 +58,3 @@ export async function GET(req: NextRequest) {
         },
     });
 }
-
@@ -9,6 +9,7 @@ import argparse
 import hashlib
 from tqdm import tqdm
 import zlib
+import mmap
 
 logging.basicConfig(
     level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
@@ -18,6 +19,52 @@ MAIN_SERVER_HOST = "localhost"
 MAIN_SERVER_PORT = 8000
 MAX_RETRIES = 3
 RESUME_FILE = "download_resume.json"
+MAIN_MAGIC = b"FDMJ"  # starts a framed connection to the main server, see backend/src/protocol.py
+MESSAGE_HEADER = struct.Struct("!I")  # length of each framed JSON message
+
+
+def recv_exact(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed by the main server")
+        data += chunk
+    return bytes(data)
+
+
+def main_server_request(sock, request):
+    """Send one request on a framed main server connection and return the whole reply."""
+    data = json.dumps(request).encode()
+    sock.sendall(MESSAGE_HEADER.pack(len(data)) + data)
+    (length,) = MESSAGE_HEADER.unpack(recv_exact(sock, MESSAGE_HEADER.size))
+    return json.loads(recv_exact(sock, length))
+
+
+class OutputSink:
+    """The output file, opened once and memory-mapped for the whole download.
+
+    Workers copy their segments into the map at their own offsets, so writes
+    to different ranges run concurrently without a lock or a reopen per
+    segment. Everything is flushed to disk in one step by `close()`.
+    """
+
+    def __init__(self, path, size):
+        self.size = size
+        self.file = open(path, "r+b" if os.path.exists(path) else "w+b")
+        self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size) if size else None
+
+    def write(self, offset, data):
+        if offset < 0 or offset + len(data) > self.size:
+            raise ValueError(f"Write of {len(data)} bytes at {offset} is outside the file")
+        self.map[offset : offset + len(data)] = data
+
+    def close(self):
+        if self.map is not None:
+            self.map.flush()
+            self.map.close()
+        self.file.close()
 
 
 class FileDownloader:
@@ -37,6 +84,7 @@ class FileDownloader:
             self.segments = self.file_info["segments"]
             self.is_compressed = self.file_info["is_compressed"]
             self.checksum = self.file_info.get("checksum")
+            self.sink = None
             self.downloaded_segments = set()
             self.pbar = tqdm(
                 total=self.file_size, unit="B", unit_scale=True, desc=self.filename
@@ -45,12 +93,16 @@ class FileDownloader:
 
     def get_file_info(self):
         if self.filename != "nil":
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.connect((self.main_server_host, self.main_server_port))
-                request = {"type": "get_file_info", "filename": self.filename}
-                s.send(json.dumps(request).encode())
-                response = json.loads(s.recv(4096).decode())
-            return response
+            while True:
+                with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                    s.connect((self.main_server_host, self.main_server_port))
+                    s.sendall(MAIN_MAGIC)
+                    request = {"type": "get_file_info", "filename": self.filename}
+                    response = main_server_request(s, request)
+                # Another client's request may still be segmenting the file
+                if response.get("status") != "segmenting":
+                    return response
+                time.sleep(response["retry_after"])
         else:
             return {}
 
@@ -115,10 +167,8 @@ class FileDownloader:
                         logging.warning(f"Checksum mismatch for segment {segment_id}")
                         continue
 
+                self.sink.write(segment["start"], segment_data)
                 with self.lock:
-                    with open(self.output_file, "r+b") as f:
-                        f.seek(segment["start"])
-                        f.write(segment_data)
                     self.downloaded_segments.add(segment_id)
                     self.save_resume_data()
                     self.pbar.update(len(segment_data))
@@ -138,20 +188,19 @@ class FileDownloader:
         return False
 
     def download(self):
-        if not os.path.exists(self.output_file):
-            with open(self.output_file, "wb") as f:
-                f.seek(self.file_size - 1)
-                f.write(b"\0")
-
-        threads = []
-        for segment in self.segments:
-            if segment["id"] not in self.downloaded_segments:
-                thread = Thread(target=self.download_segment, args=(segment,))
-                thread.start()
-                threads.append(thread)
+        self.sink = OutputSink(self.output_file, self.file_size)
+        try:
+            threads = []
+            for segment in self.segments:
+                if segment["id"] not in self.downloaded_segments:
+                    thread = Thread(target=self.download_segment, args=(segment,))
+                    thread.start()
+                    threads.append(thread)
 
-        for thread in threads:
-            thread.join()
+            for thread in threads:
+                thread.join()
+        finally:
+            self.sink.close()
 
         self.pbar.close()
 
@@ -180,12 +229,18 @@ class FileDownloader:
             logging.error("File integrity check failed")
 
     def get_all_files(self):
+        files = []
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
             s.connect((self.main_server_host, self.main_server_port))
+            s.sendall(MAIN_MAGIC)
             request = {"type": "list_files"}
-            s.send(json.dumps(request).encode())
-            response = json.loads(s.recv(4096).decode())
-        return response.get("files", [])
+            # The list comes a page at a time
+            while True:
+                response = main_server_request(s, request)
+                files.extend(response.get("files", []))
+                if response.get("next_cursor") is None:
+                    return files
+                request["cursor"] = response["next_cursor"]
 
 
 if __name__ == "__main__":
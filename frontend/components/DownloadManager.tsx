@@ -1,4 +1,4 @@
-import { useState, useEffect } from 'react'
+import { useState, useEffect, useRef } from 'react'
 import { Button } from "@/components/ui/button"
 import { Progress } from "@/components/ui/progress"
 import { Play, Pause, RotateCcw, XCircle } from 'lucide-react'
@@ -14,10 +14,17 @@ export function DownloadManager({ filename, onComplete }: DownloadManagerProps)
     const [status, setStatus] = useState<'idle' | 'downloading' | 'paused' | 'completed' | 'failed'>('idle')
     const [error, setError] = useState<string | null>(null)
     const { toast } = useToast()
+    // Kept open across status changes, so pausing does not drop the event stream
+    const eventSourceRef = useRef<EventSource | null>(null)
 
     useEffect(() => {
-        let eventSource: EventSource | null = null;
+        return () => {
+            eventSourceRef.current?.close();
+            eventSourceRef.current = null;
+        };
+    }, [filename]);
 
+    useEffect(() => {
         const startDownload = async () => {
             try {
                 const response = await fetch('/api/download', {
@@ -31,21 +38,25 @@ export function DownloadManager({ filename, onComplete }: DownloadManagerProps)
                 }
 
                 setStatus('downloading');
-                eventSource = new EventSource(`/api/download?filename=${encodeURIComponent(filename)}`);
+                eventSourceRef.current?.close();
+                const eventSource = new EventSource(`/api/download?filename=${encodeURIComponent(filename)}`);
+                eventSourceRef.current = eventSource;
 
                 eventSource.onmessage = (event) => {
+                    // { filename, output_file, state, downloaded, total, error? }
                     const data = JSON.parse(event.data);
-                    if (data.progress) {
-                        setProgress(parseFloat(data.progress));
-                    } else if (data.error) {
-                        setError(data.error);
+                    if (data.total > 0) {
+                        setProgress(data.downloaded / data.total * 100);
+                    }
+                    if (data.state === 'failed') {
+                        setError(data.error ?? 'Download failed');
                         setStatus('failed');
                         toast({
                             title: "Error",
-                            description: data.error,
+                            description: data.error ?? 'Download failed',
                             variant: "destructive",
                         })
-                    } else if (data.complete) {
+                    } else if (data.state === 'done') {
                         setStatus('completed');
                         onComplete();
                         toast({
@@ -78,12 +89,6 @@ export function DownloadManager({ filename, onComplete }: DownloadManagerProps)
         if (status === 'idle') {
             startDownload();
         }
-
-        return () => {
-            if (eventSource) {
-                eventSource.close();
-            }
-        };
     }, [filename, status, onComplete, toast]);
 
     const handlePause = async () => {
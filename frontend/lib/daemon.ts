@@ -0,0 +1,6 @@
+// Address of backend/src/download_daemon.py, which runs every download
+export const DAEMON_URL = process.env.DOWNLOAD_DAEMON_URL ?? 'http://127.0.0.1:8010';
+
+export function daemonUrl(...parts: string[]): string {
+    return `${DAEMON_URL}/${parts.map(encodeURIComponent).join('/')}`;
+}